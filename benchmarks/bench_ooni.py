@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""Benchmark the processing of OONI measurements.
+
+Compares the time taken per row by `ooni.process_results' with that of the
+implementation it replaced, which built a dict with all the fields of each row
+and encoded its link as the row was read, on synthetic rows in the format
+returned by the database query.
+
+Usage: python3 benchmarks/bench_ooni.py [--rows N] [--inputs N]
+"""
+
+import argparse
+import collections
+import datetime
+import random
+import time
+import urllib.parse
+
+from cescout.projects import ooni
+
+BLOCKING = ("false", "false", "false", "dns", "tcp_ip", "http-failure", None)
+
+
+def synthetic_rows(rows, inputs, seed=0, countries=("CN", )):
+    """Return :param rows: rows over :param inputs: distinct inputs.
+
+    The rows are spread over :param countries: in turn.
+    """
+    rng = random.Random(seed)
+    urls = ["https://{0}.wikipedia.org/wiki/Page_{1}".format(
+        rng.choice(("en", "fr", "zh", "fa", "tr")), i) for i in range(inputs)]
+    start = datetime.datetime(2020, 2, 1)
+    return [{"measurement_start_time": start + datetime.timedelta(seconds=i),
+             "report_id": "20200201T000000Z_AS{0}_{1:016x}".format(
+                 rng.randrange(1, 65536), rng.getrandbits(64)),
+             "probe_asn": rng.randrange(1, 65536),
+             "probe_cc": countries[i % len(countries)],
+             "probe_ip": None,
+             "test_name": "web_connectivity",
+             "input": rng.choice(urls),
+             "blocking": rng.choice(BLOCKING),
+             "http_experiment_failure": None}
+            for i in range(rows)]
+
+
+def previous_process_results(result):
+    """The implementation that `ooni.process_results' replaced."""
+    all_measurements = collections.defaultdict(list)
+    all_measurements["len_all"] = 0
+    all_measurements["len_blocking"] = 0
+    for measurement in result:
+        data = {
+            "measurement_time": str(measurement["measurement_start_time"]),
+            "report_id": measurement["report_id"],
+            "asn": measurement["probe_asn"],
+            "country": measurement["probe_cc"],
+            "ip": measurement["probe_ip"],
+            "url": measurement["input"],
+            "blocking": measurement["blocking"],
+            "http_failure": measurement["http_experiment_failure"]
+        }
+        data["report_link"] = ooni.EXPLORER_LINK.format(
+            data["report_id"], urllib.parse.quote(data["url"]))
+        all_measurements["len_all"] += 1
+        if not data["blocking"] == "false":
+            all_measurements["len_blocking"] += 1
+        all_measurements["measurements"].append({"url": data["report_link"],
+                                                "blocking": data["blocking"]})
+    return all_measurements
+
+
+def measure(function, rows, repeat):
+    """Return the best time per row (in ns) of :param repeat: runs."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(iter(rows))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(rows) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000,
+                        help="number of synthetic rows (default: 1000000)")
+    parser.add_argument("--inputs", type=int, default=1000,
+                        help="number of distinct inputs (default: 1000)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of runs, the best is kept (default: 3)")
+    args = parser.parse_args()
+
+    rows = synthetic_rows(args.rows, args.inputs)
+    assert previous_process_results(rows) == ooni.process_results(rows)
+
+    previous = measure(previous_process_results, rows, args.repeat)
+    current = measure(ooni.process_results, rows, args.repeat)
+    print("{0} rows, {1} inputs".format(args.rows, args.inputs))
+    print("previous: {0:8.0f} ns/row".format(previous))
+    print("current:  {0:8.0f} ns/row ({1:.1f}x)".format(
+        current, previous / current))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""Benchmark the startup time of `cescout'.
+
+Reports the time taken to import `cescout.main' (as measured by `python -X
+importtime') and the wall-clock time of `cescout --version' and `cescout
+--help', each minus the startup time of the interpreter itself, and exits
+with status 1 if the import takes longer than the budget.
+
+Usage: python3 benchmarks/bench_startup.py [--repeat N] [--budget MS]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Maximum time (in milliseconds) `import cescout.main' may take.
+BUDGET = 50
+
+
+def run(args):
+    """Run the interpreter with :param args: and return the elapsed time."""
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable] + args, cwd=ROOT,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, check=True)
+    return time.perf_counter() - start, process.stderr.decode()
+
+
+def import_time(module):
+    """Return the time taken to import a module and its imports, in seconds.
+
+    :param module: name of the module
+    :return float: cumulative time reported by `-X importtime' for the module
+    """
+    _, output = run(["-X", "importtime", "-c", "import {0}".format(module)])
+    for line in output.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1e6
+    raise ValueError("{0} not found in the output of -X importtime".format(
+        module))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="number of runs, the best is kept (default: 10)")
+    parser.add_argument("--budget", type=float, default=BUDGET,
+                        help="maximum time (in ms) to import `cescout.main'"
+                             " (default: {0})".format(BUDGET))
+    args = parser.parse_args()
+
+    interpreter = min(run(["-c", "pass"])[0] for _ in range(args.repeat))
+    imported = min(import_time("cescout.main") for _ in range(args.repeat))
+    print("{0:<24} {1:>8.1f} ms".format("interpreter", interpreter * 1e3))
+    print("{0:<24} {1:>8.1f} ms (budget: {2:.0f} ms)".format(
+        "import cescout.main", imported * 1e3, args.budget))
+    for command in ("--version", "--help"):
+        elapsed = min(run(["-m", "cescout.main", command])[0]
+                      for _ in range(args.repeat))
+        print("{0:<24} {1:>8.1f} ms".format(
+            "cescout {0}".format(command), (elapsed - interpreter) * 1e3))
+
+    if imported * 1e3 > args.budget:
+        print("Importing cescout.main takes longer than the budget",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+"""Benchmark the parsing and report hot paths at production sizes.
+
+Each stage runs on synthetic inputs: IODA alerts for all the countries, rows in
+the format returned by `metadb', the prefixes of a country with hundreds of
+ASNs, and the report of a country with all of them. The throughput (items per
+second, best of `--repeat' runs) and peak memory (traced by `tracemalloc' in a
+separate run) of each stage are written as JSON, so that the results of two
+commits can be compared with `--compare'. No network access or database is
+needed.
+
+Usage: python3 benchmarks/bench_suite.py [--scale N] [--stage NAME]
+                                         [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from bench_ooni import synthetic_rows
+
+import iso3166
+
+from cescout.main import generate_report, measurement_data, render_report
+from cescout.projects import ioda, ooni, ooni_api, ripe
+
+# Sizes of the inputs at `--scale 1'.
+ALERTS = 1000000
+ROWS = 1000000
+INPUTS = 1000
+ASNS = 500
+PREFIXES = 200
+REPORT_ROWS = 100000
+
+COUNTRIES = [country.alpha2 for country in iso3166.countries]
+REPORT_COUNTRY = "IR"
+DOMAINS = ["wikipedia.org", "wikimedia.org", "wikidata.org"]
+SINCE = datetime.datetime(2020, 2, 1)
+UNTIL = datetime.datetime(2020, 2, 8)
+
+Stage = collections.namedtuple("Stage", ["name", "items", "run"])
+
+
+def synthetic_alerts(alerts, seed=0):
+    """Return IODA's response with :param alerts: alerts, as bytes.
+
+    The alerts are spread over all the countries and the time period; most are
+    `region' alerts at the `normal' level.
+    """
+    rng = random.Random(seed)
+    start, end = ioda.time_epoch(SINCE, UNTIL)
+    parts = []
+    for _ in range(alerts):
+        country = rng.choice(COUNTRIES)
+        region = rng.randrange(1000, 5000)
+        alert = {"fqid": "bgp.v4.visibility_threshold.min_50%",
+                 "time": rng.randrange(start, end),
+                 "level": rng.choices(("normal", "warning", "critical"),
+                                      (90, 6, 4))[0],
+                 "method": "last_value",
+                 "condition": "< historical * 0.5",
+                 "value": rng.randrange(100),
+                 "historyValue": rng.randrange(100),
+                 "metaType": "region" if rng.random() < 0.8 else "asn",
+                 "metaCode": str(region),
+                 "meta": {"name": "Region {0}".format(region),
+                          "attrs": {"fqid": "geo.netacuity.AS.{0}.{1}".format(
+                                        country, region),
+                                    "country_name": country,
+                                    "country_code": country}}}
+        parts.append(json.dumps(alert))
+    return ('{"type": "watchtower.alerts", "data": {"alerts": ['
+            + ", ".join(parts) + "]}}").encode()
+
+
+def chunks(data, size=ioda.CHUNK_SIZE):
+    """Yield :param data: in chunks, as read from the API's response."""
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def synthetic_prefixes(asns, prefixes, seed=0):
+    """Return the announced prefixes of :param asns: ASNs, with timelines.
+
+    Each ASN announces about :param prefixes: prefixes on average, in the
+    format returned by RIPEstat's announced-prefixes; some of them are only
+    visible for part of the time period.
+
+    :return dict: ASN mapped to a list of prefixes
+    """
+    rng = random.Random(seed)
+    start, end = ripe.epoch(SINCE), ripe.epoch(UNTIL)
+
+    def iso(epoch):
+        return datetime.datetime.utcfromtimestamp(epoch).isoformat()
+
+    all_prefixes = {}
+    for asn in range(64512, 64512 + asns):
+        announced = []
+        for _ in range(rng.randrange(1, 2 * prefixes)):
+            length = rng.choice((16, 20, 22, 23, 24, 24, 24))
+            address = rng.getrandbits(32) & ~((1 << (32 - length)) - 1)
+            prefix = "{0}.{1}.{2}.{3}/{4}".format(
+                *address.to_bytes(4, "big"), length)
+            timelines = [{"starttime": iso(start), "endtime": iso(end)}]
+            if rng.random() < 0.1:
+                gap = rng.randrange(start, end)
+                timelines = [{"starttime": iso(start), "endtime": iso(gap)},
+                             {"starttime": iso(gap + 3600),
+                              "endtime": iso(end)}]
+            announced.append({"prefix": prefix, "timelines": timelines})
+        all_prefixes[asn] = announced
+    return all_prefixes
+
+
+def withdrawn(announced, seed=0):
+    """Return the prefixes still announced at the end of the time period."""
+    rng = random.Random(seed)
+    return [each["prefix"] for each in announced if rng.random() >= 0.05]
+
+
+def ioda_stages(scale):
+    alerts = max(1, int(ALERTS * scale))
+    data = synthetic_alerts(alerts)
+    index = ioda.index_alerts(ioda.iter_alerts(chunks(data)))
+    return [Stage("ioda.decode", alerts,
+                  lambda: ioda.index_alerts(ioda.iter_alerts(chunks(data)))),
+            Stage("ioda.detect",
+                  sum(len(each["region"]) for each in index.values()),
+                  lambda: {country: ioda.parse_response(index, country)
+                           for country in index})]
+
+
+def ooni_stages(scale):
+    rows = synthetic_rows(max(1, int(ROWS * scale)), INPUTS,
+                          countries=COUNTRIES)
+    bucket = "hour"
+    return [Stage("ooni.process", len(rows),
+                  lambda: ooni.process_batch_results(rows, COUNTRIES)),
+            Stage("ooni.breakdown", len(rows),
+                  lambda: ooni.breakdowns(
+                      ooni_api.breakdown_rows(rows, ooni.BUCKETS[bucket]),
+                      COUNTRIES, DOMAINS, bucket))]
+
+
+def ripe_stages(scale):
+    all_prefixes = synthetic_prefixes(max(1, int(ASNS * scale)), PREFIXES)
+    until_prefixes = {asn: withdrawn(announced)
+                      for asn, announced in all_prefixes.items()}
+
+    def changes():
+        return {asn: ripe.prefix_changes(
+                    ripe.prefix_ranges(each["prefix"] for each in announced),
+                    ripe.prefix_ranges(until_prefixes[asn]))
+                for asn, announced in all_prefixes.items()}
+
+    def history():
+        return {asn: ripe.prefix_history(*ripe.visibility_series(
+                    announced, SINCE.isoformat(), UNTIL.isoformat()))
+                for asn, announced in all_prefixes.items()}
+
+    return [Stage("ripe.prefixes",
+                  sum(map(len, all_prefixes.values()))
+                  + sum(map(len, until_prefixes.values())), changes),
+            Stage("ripe.history",
+                  sum(len(each["timelines"])
+                      for announced in all_prefixes.values()
+                      for each in announced), history)]
+
+
+def report_stages(scale):
+    rows = synthetic_rows(max(1, int(REPORT_ROWS * scale)), INPUTS,
+                          countries=(REPORT_COUNTRY, ))
+    ooni_data = ooni.process_results(rows)
+    ooni_data["breakdown"] = ooni.breakdowns(
+        ooni_api.breakdown_rows(rows, ooni.BUCKETS["hour"]),
+        [REPORT_COUNTRY], DOMAINS, "hour")[REPORT_COUNTRY]
+
+    index = ioda.index_alerts(ioda.iter_alerts(chunks(synthetic_alerts(
+        max(1, int(ALERTS * scale))))), [REPORT_COUNTRY])
+    ioda_data = ioda.parse_response(index, REPORT_COUNTRY)
+    ioda_data["url"] = ioda.IODA_VIEW_URL.format(REPORT_COUNTRY,
+                                                 *ioda.time_epoch(SINCE,
+                                                                  UNTIL))
+
+    ripe_data = {}
+    for asn, announced in synthetic_prefixes(max(1, int(ASNS * scale)),
+                                             PREFIXES).items():
+        until_prefixes = withdrawn(announced)
+        ripe_data[asn] = {
+            "current": len(until_prefixes),
+            "since": len(announced),
+            "until": len(until_prefixes),
+            "prefixes": ripe.prefix_changes(
+                ripe.prefix_ranges(each["prefix"] for each in announced),
+                ripe.prefix_ranges(until_prefixes)),
+            "history": ripe.prefix_history(*ripe.visibility_series(
+                announced, SINCE.isoformat(), UNTIL.isoformat()))}
+
+    args = {"asns": list(ripe_data), "since": SINCE, "until": UNTIL}
+    measurements = {
+        **measurement_data(REPORT_COUNTRY, args,
+                           {"ooni": {"domains": DOMAINS}}),
+        "projects": {"ooni": {"ran_test": True, "data": ooni_data},
+                     "ioda": {"ran_test": True, "data": ioda_data},
+                     "ripe": {"ran_test": True, "data": ripe_data}}}
+    items = len(rows) + len(ripe_data)
+    with open(os.devnull, "w") as devnull:
+        yield Stage("report.render", items,
+                    lambda: generate_report(measurements))
+        yield Stage("report.stream", items,
+                    lambda: render_report(measurements, devnull))
+
+
+# Stages that share their inputs, by prefix of their names.
+GROUPS = {"ioda": ioda_stages, "ooni": ooni_stages, "ripe": ripe_stages,
+          "report": report_stages}
+
+
+def measure(stage, repeat, memory=True):
+    """Run a stage and return its results.
+
+    :return dict: the stage's `items', best time in `seconds',
+                  `items_per_second' and `peak_bytes' (None if not measured)
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage.run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            stage.run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {"stage": stage.name,
+            "items": stage.items,
+            "seconds": round(best, 6),
+            "items_per_second": round(stage.items / best, 1),
+            "peak_bytes": peak}
+
+
+def git_commit():
+    """Return the current commit of the repository, if any."""
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.decode().strip()
+
+
+def compare(baseline, results, tolerance):
+    """Print the change in throughput and memory of each stage.
+
+    :param baseline: results of an earlier run (as written by this script)
+    :param results: results of this run
+    :param tolerance: fraction of throughput that may be lost
+    :return bool: True if any stage is slower than the tolerance allows
+    """
+    previous = {each["stage"]: each for each in baseline["stages"]}
+    regressed = False
+    print("{0:<16} {1:>14} {2:>14} {3:>8} {4:>8}".format(
+        "stage", "before (/s)", "after (/s)", "speed", "memory"),
+        file=sys.stderr)
+    for each in results["stages"]:
+        before = previous.get(each["stage"])
+        if before is None:
+            continue
+        speed = each["items_per_second"] / before["items_per_second"]
+        memory = "-"
+        if each["peak_bytes"] and before["peak_bytes"]:
+            memory = "{0:.2f}x".format(each["peak_bytes"]
+                                       / before["peak_bytes"])
+        slower = speed < 1 - tolerance
+        regressed = regressed or slower
+        print("{0:<16} {1:>14.0f} {2:>14.0f} {3:>7.2f}x {4:>8}{5}".format(
+            each["stage"], before["items_per_second"],
+            each["items_per_second"], speed, memory,
+            "  slower" if slower else ""), file=sys.stderr)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="scale the sizes of the inputs (default: 1, that"
+                             " is {0} alerts and {1} rows)".format(
+                                 ALERTS, ROWS))
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of runs, the best is kept (default: 3)")
+    parser.add_argument("--stage", action="append", metavar="NAME",
+                        help="only run the stages starting with NAME (such"
+                             " as `ioda' or `ooni.process'); can be repeated")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="do not measure the peak memory")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results to FILE instead of stdout")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare with the results in FILE and exit with"
+                             " status 1 if a stage is slower")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction of throughput a stage may lose before"
+                             " it is reported as slower (default: 0.1)")
+    args = parser.parse_args()
+
+    results = {"commit": git_commit(),
+               "python": platform.python_version(),
+               "scale": args.scale,
+               "repeat": args.repeat,
+               "stages": []}
+    for prefix, group in GROUPS.items():
+        if args.stage and not any(name.startswith(prefix)
+                                  or prefix.startswith(name)
+                                  for name in args.stage):
+            continue
+        stages = group(args.scale)
+        for stage in stages:
+            if args.stage and not stage.name.startswith(tuple(args.stage)):
+                continue
+            result = measure(stage, args.repeat, args.memory)
+            print("{stage:<16} {items:>9} items {items_per_second:>14,.0f}/s"
+                  " {0}".format("" if result["peak_bytes"] is None else
+                                "{0:,} bytes peak".format(
+                                    result["peak_bytes"]),
+                                **result), file=sys.stderr)
+            results["stages"].append(result)
+        # Free the inputs of the group before building the next one.
+        del stages
+
+    document = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(document + "\n")
+    else:
+        print(document)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,21 @@
-from pkg_resources import get_distribution, DistributionNotFound
+def __getattr__(name):
+    # The version is read from the package metadata when it is first used
+    # (such as by `--version'), as that is slow and not needed otherwise.
+    global __version__
+    if name == "__version__":
+        try:
+            from importlib.metadata import version, PackageNotFoundError
+        except ImportError:    # pragma: no cover (Python 3.7)
+            from pkg_resources import DistributionNotFound \
+                as PackageNotFoundError, get_distribution
 
-# This is from setuptools_scm.
-try:
-    __version__ = get_distribution(__name__).version
-except DistributionNotFound:    # pragma: no cover
-    pass
+            def version(name):
+                return get_distribution(name).version
+        # This is from setuptools_scm.
+        try:
+            __version__ = version(__name__)
+            return __version__
+        except PackageNotFoundError:    # pragma: no cover
+            pass
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(
+        __name__, name))
@@ -0,0 +1,187 @@
+"""On-disk caches for data fetched from the measurement projects.
+
+Some of the data we fetch never changes once it is in the past (such as the
+routing state of an ASN at a given time), so there is no need to fetch it again
+on every run. The caches are SQLite databases in the directory specified by the
+`cache' section of `cescout.cfg' and are only used if that section is present.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Default maximum number of entries in a cache, if not set in `cescout.cfg'.
+MAX_ENTRIES = 100000
+
+# Caches kept open between runs by path (see `keep_open'), or None if every run
+# opens and closes its own caches.
+_SHARED = None
+_SHARED_LOCK = threading.Lock()
+
+
+class DiskCache:
+    """Key-value cache stored in an SQLite database.
+
+    Values are stored as JSON and can have an optional time-to-live; entries
+    without one never expire. When there are more than :param max_entries:
+    entries, the least recently used are evicted. The number of entries is
+    counted when the cache is opened and then kept up to date as entries are
+    added, so that it is only counted again when it goes over the limit. The
+    cache can be shared between threads.
+
+    :param path: path to the SQLite database (created if it does not exist)
+    :param max_entries=MAX_ENTRIES: maximum number of entries to keep
+    """
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache ("
+                               " key TEXT PRIMARY KEY,"
+                               " value TEXT NOT NULL,"
+                               " expires REAL,"
+                               " accessed REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed"
+                               " ON cache (accessed)")
+            self._count = self._conn.execute("SELECT count(*)"
+                                             " FROM cache").fetchone()[0]
+
+    def get(self, key):
+        """Return the value for :param key: or None if it is not cached.
+
+        :param key: key to look up (string)
+        :return value: cached value, or None if it was not found or expired
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value, expires FROM cache"
+                                     " WHERE key = ?", (key, )).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE cache SET accessed = ?"
+                               " WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        """Store :param value: for :param key:.
+
+        :param key: key to store the value under (string)
+        :param value: value to store (must be serializable to JSON)
+        :param ttl=None: time-to-live in seconds (never expires if None)
+        """
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        value = json.dumps(value)
+        with self._lock, self._conn:
+            updated = self._conn.execute("UPDATE cache SET value = ?,"
+                                         " expires = ?, accessed = ?"
+                                         " WHERE key = ?",
+                                         (value, expires, now, key)).rowcount
+            if updated:
+                return
+            self._conn.execute("INSERT OR REPLACE INTO cache"
+                               " (key, value, expires, accessed)"
+                               " VALUES (?, ?, ?, ?)",
+                               (key, value, expires, now))
+            self._count += 1
+            if self._count <= self.max_entries:
+                return
+            # Count again, as other processes may use the same database.
+            count = self._conn.execute("SELECT count(*)"
+                                       " FROM cache").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute("DELETE FROM cache WHERE key IN"
+                                   " (SELECT key FROM cache"
+                                   "  ORDER BY accessed LIMIT ?)",
+                                   (count - self.max_entries, ))
+            self._count = min(count, self.max_entries)
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
+
+
+def cache_directory(**config):
+    """Return the directory of the caches, if caching is configured.
+
+    :param config: configuration parameters; `directory' in the `cache' section
+    :return path: expanded path of the directory, or None
+    """
+    directory = (config.get("cache") or {}).get("directory")
+    return os.path.expanduser(directory) if directory else None
+
+
+def open_cache(name, **config):
+    """Open the cache called :param name: as configured in `cescout.cfg'.
+
+    :param name: name of the cache (used as the name of the database file)
+    :param config: configuration parameters; the `cache' section sets the
+                   `directory' of the caches and their `max_entries'
+    :return cache: DiskCache object, or None if caching is not configured or
+                   the cache could not be opened
+    """
+    directory = cache_directory(**config)
+    if directory is None:
+        return None
+
+    cache_config = config["cache"]
+    path = os.path.join(directory, "{0}.sqlite".format(name))
+    with _SHARED_LOCK:
+        if _SHARED is not None and path in _SHARED:
+            return _SHARED[path]
+        try:
+            os.makedirs(directory, exist_ok=True)
+            cache = DiskCache(path, cache_config.get("max_entries",
+                                                     MAX_ENTRIES))
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("Unable to open cache {0}: {1}".format(path, e))
+            return None
+        if _SHARED is not None:
+            _SHARED[path] = cache
+    logging.debug("Using cache {0}".format(path))
+    return cache
+
+
+def close_cache(cache):
+    """Close a cache returned by `open_cache', unless it is kept open.
+
+    :param cache: DiskCache object
+    """
+    with _SHARED_LOCK:
+        if _SHARED is not None and _SHARED.get(cache.path) is cache:
+            return
+    cache.close()
+
+
+def keep_open():
+    """Keep the caches open between runs.
+
+    Once called, `open_cache' returns the same DiskCache object for a cache
+    every time and `close_cache' leaves it open, so that a long-running process
+    (see `daemon') does not reopen its caches on every run; `close_shared'
+    closes them.
+    """
+    global _SHARED
+    with _SHARED_LOCK:
+        if _SHARED is None:
+            _SHARED = {}
+
+
+def close_shared():
+    """Close the caches kept open by `keep_open' and stop sharing them."""
+    global _SHARED
+    with _SHARED_LOCK:
+        shared, _SHARED = _SHARED or {}, None
+    for cache in shared.values():
+        cache.close()
@@ -0,0 +1,224 @@
+"""HTTP client shared by the projects that query an API over HTTP.
+
+Each project has one Client, which keeps a pooled `requests' session so that
+connections are kept alive and reused across requests (and threads), and adds
+what the projects need from every request:
+
+- connect and read timeouts, so that a hung connection fails instead of
+  stalling the run;
+- retries with an exponential backoff (or the delay in `Retry-After') on
+  connection errors, timeouts and 429/5xx responses;
+- compressed responses (`Accept-Encoding: gzip, deflate'), which `requests'
+  decodes;
+- conditional requests: responses with an `ETag' or `Last-Modified' header are
+  kept (up to MAX_VALIDATED) and the same request is then sent with
+  `If-None-Match' or `If-Modified-Since', so that a `304 Not Modified' reuses
+  the response instead of transferring it again.
+
+The timeouts and retries can be set in the `http' section of `cescout.cfg'.
+Every attempt is recorded in the metrics of the project (see `metrics').
+"""
+
+import collections
+import copy
+import logging
+import threading
+import time
+
+import requests
+import requests.adapters
+
+from . import metrics
+
+# Timeouts (in seconds) to connect and to read (between bytes received).
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# Number of retries of a request, and delay (in seconds) before the first one;
+# the delay doubles with each retry, up to MAX_DELAY.
+RETRIES = 3
+BACKOFF = 1
+MAX_DELAY = 60
+RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+# Maximum number of responses kept for conditional requests (per client).
+MAX_VALIDATED = 128
+
+# Time taken by a request: number of attempts, seconds from the first attempt
+# until the response headers of the last one (including the delays between
+# attempts), and whether the response was reused after a `304 Not Modified'.
+Timing = collections.namedtuple("Timing", ["attempts", "seconds",
+                                           "not_modified"])
+
+
+def retry_delay(response, attempt, backoff=BACKOFF):
+    """Return the delay before retrying a request.
+
+    :param response: response of the failed attempt, or None if no response
+                     was received
+    :param attempt: number of the failed attempt (starting at 1)
+    :param backoff=BACKOFF: delay (in seconds) before the first retry
+    :return float: seconds to wait; the delay in `Retry-After' (in seconds) if
+                   set, or :param backoff: doubled with each attempt, up to
+                   MAX_DELAY
+    """
+    if response is not None:
+        try:
+            return min(float(response.headers["Retry-After"]), MAX_DELAY)
+        except (KeyError, ValueError):
+            pass
+    return min(backoff * 2 ** (attempt - 1), MAX_DELAY)
+
+
+class HTTPAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter that records the requests of a project.
+
+    Mount it on the `requests' session of a project so that every request is
+    timed and counted (see `metrics.HTTP_DURATION' and
+    `metrics.HTTP_REQUESTS').
+
+    :param project: name of the project (label of the samples)
+    :param kwargs: arguments of `requests.adapters.HTTPAdapter'
+    """
+
+    def __init__(self, project, **kwargs):
+        self.project = project
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.HTTP_REQUESTS.inc(project=self.project, status="error")
+            raise
+        finally:
+            metrics.HTTP_DURATION.observe(time.perf_counter() - start,
+                                          project=self.project)
+        metrics.HTTP_REQUESTS.inc(
+            project=self.project,
+            status="{0}xx".format(response.status_code // 100))
+        return response
+
+
+class Client:
+    """HTTP client of a project (see the module's documentation).
+
+    :param project: name of the project (label of its metrics)
+    :param pool_maxsize=10: maximum number of connections kept open, that is
+                            the number of threads making requests at a time
+    :param rate_limit=None: common.TokenBucket to take a token from before
+                            each attempt, if the API is rate limited
+    :param sleep=time.sleep: function used to wait between attempts
+    """
+
+    def __init__(self, project, pool_maxsize=10, rate_limit=None,
+                 sleep=time.sleep):
+        self.project = project
+        self.rate_limit = rate_limit
+        self.sleep = sleep
+        self.timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        self.retries = RETRIES
+        self.backoff = BACKOFF
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        adapter = HTTPAdapter(project, pool_connections=1,
+                              pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._validated = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, **config):
+        """Set the timeouts and retries from the `http' section of the config.
+
+        :param config: config settings; `connect_timeout', `read_timeout',
+                       `retries' and `backoff' in the `http' section
+        """
+        http_config = config.get("http") or {}
+        self.timeout = (http_config.get("connect_timeout", CONNECT_TIMEOUT),
+                        http_config.get("read_timeout", READ_TIMEOUT))
+        self.retries = http_config.get("retries", RETRIES)
+        self.backoff = http_config.get("backoff", BACKOFF)
+
+    def get(self, url, params=None, stream=False):
+        """Send a GET request, retrying it if it fails.
+
+        Responses are not checked for errors other than those that are
+        retried: call `raise_for_status' on the response.
+
+        :param url: URL to request
+        :param params=None: dict of query parameters
+        :param stream=False: if True, the body is not read (see
+                             `requests.Response.iter_content') and the
+                             response is not kept for conditional requests
+        :return response: requests.Response, with a `timing' attribute (see
+                          Timing)
+        :raises requests.exceptions.RequestException: if no response was
+                                                      received after all the
+                                                      retries
+        """
+        key = requests.Request("GET", url, params=params).prepare().url
+        headers = {}
+        validated = None
+        if not stream:
+            with self._lock:
+                validated = self._validated.get(key)
+                if validated is not None:
+                    self._validated.move_to_end(key)
+        if validated is not None:
+            if "ETag" in validated.headers:
+                headers["If-None-Match"] = validated.headers["ETag"]
+            if "Last-Modified" in validated.headers:
+                headers["If-Modified-Since"] = \
+                    validated.headers["Last-Modified"]
+
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.rate_limit is not None:
+                self.rate_limit.acquire()
+            try:
+                response = self.session.get(url, params=params,
+                                            headers=headers, stream=stream,
+                                            timeout=self.timeout)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                if attempt > self.retries:
+                    raise
+                error, response = e, None
+            else:
+                if (response.status_code not in RETRY_STATUS
+                        or attempt > self.retries):
+                    break
+                error = response.status_code
+                response.close()
+            delay = retry_delay(response, attempt, self.backoff)
+            logging.debug("Request to {0} failed ({1}); retrying in {2:.1f}s"
+                          .format(key, error, delay))
+            self.sleep(delay)
+        seconds = time.perf_counter() - start
+
+        not_modified = (response.status_code == 304
+                        and validated is not None)
+        if not_modified:
+            response.close()
+            response = copy.copy(validated)
+        elif (not stream and response.status_code == 200
+              and ("ETag" in response.headers
+                   or "Last-Modified" in response.headers)):
+            # Read the body, which is kept with the response.
+            response.content
+            with self._lock:
+                self._validated[key] = response
+                self._validated.move_to_end(key)
+                while len(self._validated) > MAX_VALIDATED:
+                    self._validated.popitem(last=False)
+        response.timing = Timing(attempt, seconds, not_modified)
+        logging.debug("Requested {0}: {1} in {2:.3f}s ({3} attempts{4})"
+                      .format(key, response.status_code, seconds, attempt,
+                              ", not modified" if not_modified else ""))
+        return response
+
+    def close(self):
+        """Close the connections of the session."""
+        self.session.close()
@@ -1,8 +1,8 @@
 import logging
+import threading
+import time
 from datetime import datetime, timezone
 
-import iso3166
-
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
 
@@ -24,28 +24,88 @@ def time_now():
     return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
 
+def time_utc(epoch):
+    """Return the date and time in UTC for an epoch, or "-" if it is None.
+
+    :param epoch: time in seconds since the epoch (UTC)
+    :return string: date and time formatted as "YYYY-MM-DD HH:MM:SS"
+    """
+    if epoch is None:
+        return "-"
+    date = datetime.fromtimestamp(epoch, timezone.utc)
+    return str(date.replace(tzinfo=None))
+
+
 def validate_date(date):
     """Validate a date string and convert it to a datetime object.
 
     If the conversion to ISO format is successful, return a datetime object
     otherwise raise ValueError that indicates an invalid date was passed.
+    Dates are in UTC, without a time zone: a date with one (such as
+    `2020-02-01T00:00:00+08:00') cannot be compared with the others and is
+    rejected.
 
     :param date: string to convert to a datetime object
     :return: datetime object
     """
     try:
-        return datetime.fromisoformat(date)
+        value = datetime.fromisoformat(date)
+        if value.tzinfo is not None:
+            raise ValueError("time zones are not supported")
+        return value
     except ValueError:
         logging.error("Invalid date: {0}. See --help".format(date))
         raise
 
 
+def validate_country(country):
+    """Validate a two-letter country code and normalize it.
+
+    The projects match country codes exactly (such as OONI's `probe_cc'), so
+    the code is upper-cased and checked against ISO 3166.
+
+    :param country: two-letter country code
+    :return country: upper-case two-letter country code
+    """
+    # Imported here as it is slow to import (see `country_name').
+    import iso3166
+
+    code = country.strip().upper()
+    if code not in iso3166.countries_by_alpha2:
+        logging.error("Invalid country code: {0}. See --help".format(country))
+        raise ValueError("invalid country code: {0}".format(country))
+    return code
+
+
+def read_country_file(path):
+    """Read a list of two-letter country codes from a file.
+
+    The file has one country code per line; empty lines and lines starting
+    with `#' (after any indentation) are ignored. Each code is validated (see
+    `validate_country').
+
+    :param path: path to the file with the country codes
+    :return countries: list of two-letter country codes
+    """
+    try:
+        with open(path, 'r') as f:
+            lines = [line.strip() for line in f]
+    except IOError as e:
+        logging.error("Unable to read country file {0}: {1}".format(path, e))
+        raise ValueError(e)
+    return [validate_country(line) for line in lines
+            if line and not line.startswith("#")]
+
+
 def country_name(country):
     """Return the full name of a country from its two-letter code.
 
     :param country: two-letter country code
     :return country_name: name of a country
     """
+    # Imported here as it is only needed for reports (see `cescout.main').
+    import iso3166
+
     try:
         country_name = iso3166.countries.get(country).name
     except KeyError:
@@ -53,3 +113,51 @@ def country_name(country):
         country_name = "Unknown"
 
     return country_name
+
+
+class TokenBucket:
+    """Token bucket rate limiter that can be shared between threads.
+
+    Tokens are added at :param rate: per second, up to :param capacity:, and
+    each call to `acquire' takes one token, waiting for it if necessary.
+
+    :param rate: number of tokens added per second
+    :param capacity=None: maximum number of tokens (burst); defaults to
+                          :param rate:
+    """
+
+    def __init__(self, rate, capacity=None):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def set_rate(self, rate, capacity=None):
+        """Change the rate (and capacity) of the bucket.
+
+        The bucket is not refilled: the tokens added so far are kept, up to
+        the new capacity, so that changing the rate does not allow a burst.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens
+                               + (now - self._updated) * self.rate)
+            self._updated = now
+            self.rate = rate
+            self.capacity = capacity or rate
+            self._tokens = min(self.capacity, self._tokens)
+
+    def acquire(self):
+        """Take a token from the bucket, waiting until one is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens
+                                   + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
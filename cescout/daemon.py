@@ -0,0 +1,354 @@
+"""Run `cescout' as a daemon for a watchlist of countries.
+
+Instead of running `cescout' from cron, `cescout daemon' reads a watchlist of
+countries (and their ASNs) from the `daemon' section of `cescout.cfg' and runs
+each entry of the watchlist every `interval' seconds over the last `window'
+hours, writing one report per country and run to the `output' directory.
+
+The configuration is read and the project modules are imported once, and the
+connections (to `metadb' and the APIs) and the on-disk caches are kept open and
+reused across runs. Runs are spread out with a random delay (`jitter') and the
+number of concurrent runs of each project is limited (`concurrency'), so that
+a long watchlist does not overload the projects.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import signal
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+from . import cache
+from . import common
+from . import main
+from . import metrics
+from . import projects
+
+# Default settings, if not set in the `daemon' section of `cescout.cfg'.
+OUTPUT_DIR = "~/.local/share/cescout/reports"
+WORKERS = 4
+JITTER = 60
+INTERVAL = 3600
+WINDOW = 24
+
+Entry = collections.namedtuple("Entry", ["countries", "asns", "interval",
+                                         "window", "skip"])
+
+
+def load_watchlist(daemon_config):
+    """Read the watchlist from the `daemon' section of `cescout.cfg'.
+
+    Invalid entries are logged and skipped.
+
+    :param daemon_config: dict with the `daemon' section of `cescout.cfg'
+    :return entries: list of Entry
+    """
+    entries = []
+    for i, each in enumerate(daemon_config.get("watchlist") or []):
+        try:
+            countries = each["countries"]
+            if isinstance(countries, str):
+                countries = [countries]
+            entry = Entry(countries=[country.upper() for country in countries],
+                          asns=each.get("asns"),
+                          interval=float(each.get("interval", INTERVAL)),
+                          window=float(each.get("window", WINDOW)),
+                          skip=frozenset(each.get("skip") or ()))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            logging.error("Invalid watchlist entry {0} ({1!r}); skipping;"
+                          " see `cescout.cfg'".format(i, e))
+            continue
+        if not entry.countries or entry.interval <= 0 or entry.window <= 0:
+            logging.error("Invalid watchlist entry {0}: `countries' must not"
+                          " be empty and `interval' and `window' must be"
+                          " positive; skipping".format(i))
+            continue
+        unknown = entry.skip.difference(projects.__all__)
+        if unknown:
+            logging.warning("Unknown projects in `skip' of watchlist entry"
+                            " {0}: {1}".format(i, ", ".join(sorted(unknown))))
+        entries.append(entry)
+    return entries
+
+
+def project_limits(daemon_config):
+    """Return a semaphore per project from `concurrency' in `cescout.cfg'.
+
+    :param daemon_config: dict with the `daemon' section of `cescout.cfg'
+    :return limits: dict of project mapped to a BoundedSemaphore, for the
+                    projects whose number of concurrent runs is limited
+    """
+    return {project: threading.BoundedSemaphore(limit)
+            for project, limit in (daemon_config.get("concurrency")
+                                   or {}).items()
+            if limit and limit > 0}
+
+
+def limited(runner, limits):
+    """Wrap a project runner so that it respects the per-project limits.
+
+    :param runner: function that runs a project (see `main.run_projects')
+    :param limits: dict of project mapped to a semaphore (see
+                   `project_limits')
+    :return function: runner that waits for the semaphore of the project
+    """
+    def run(module, project, args, config):
+        with limits.get(project) or contextlib.nullcontext():
+            return runner(module, project, args, config)
+    return run
+
+
+def write_report(output, country, until, measurements, raw=False):
+    """Write the report of a country to the output directory.
+
+    The report is written to a temporary file that is then renamed, so that a
+    report is never read half-written.
+
+    :param output: directory the report is written to
+    :param country: two-letter country code
+    :param until: end of the time period of the report (datetime)
+    :param measurements: measurement results (see `main.get_measurements')
+    :param raw=False: write the raw JSON results instead of the report
+    :return path: path of the report
+    """
+    path = os.path.join(output, "{0}-{1}.{2}".format(
+        country, until.strftime("%Y%m%dT%H%M%S"), "json" if raw else "txt"))
+    fd, tmp_path = tempfile.mkstemp(dir=output, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            if raw:
+                json.dump(measurements, f)
+            else:
+                main.render_report(measurements, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def run_entry(entry, modules, config, limits, output, raw=False):
+    """Run the projects for a watchlist entry and write its reports.
+
+    :param entry: Entry of the watchlist
+    :param modules: dict of project mapped to its module
+    :param config: dict with configuration data from `cescout.cfg'
+    :param limits: dict of project mapped to a semaphore (see
+                   `project_limits')
+    :param output: directory the reports are written to
+    :param raw=False: write the raw JSON results instead of the reports
+    :return paths: list of paths of the reports, one per country
+    """
+    until = common.date_today()
+    args = {"countries": entry.countries,
+            "asns": entry.asns,
+            "since": until - timedelta(hours=entry.window),
+            "until": until}
+    for project in projects.__all__:
+        args["skip_{0}".format(project)] = project in entry.skip
+    selected = {project: m for project, m in modules.items()
+                if project not in entry.skip}
+
+    logging.info("Running watchlist entry {0}".format(
+        ", ".join(entry.countries)))
+    results = main.run_projects(limited(main.run_project_batch, limits),
+                                selected, args, config)
+
+    paths = []
+    current = str(until)
+    for country in entry.countries:
+        measurements = {
+            **main.measurement_data(country, args, config, current),
+            **main.project_measurements(projects.__all__, args, results,
+                                        data_for=country)}
+        paths.append(write_report(output, country, until, measurements, raw))
+    logging.info("Wrote {0}".format(", ".join(paths)))
+    metrics.export(**config)
+    return paths
+
+
+class Scheduler:
+    """Run the entries of the watchlist at their intervals.
+
+    Entries are kept in a heap ordered by the time of their next run and up to
+    `workers' entries run at a time. An entry is scheduled again once its run
+    finishes: `interval' seconds after its previous run was due (or right away,
+    if that is already past), plus a random delay of up to `jitter' seconds.
+    Runs of the same entry therefore never overlap.
+
+    :param run_entry: function called with an Entry to run it
+    :param workers=WORKERS: maximum number of entries that run at a time
+    :param jitter=JITTER: maximum random delay (in seconds) of each run
+    :param clock=time.monotonic: function that returns the current time
+    """
+
+    def __init__(self, run_entry, workers=WORKERS, jitter=JITTER,
+                 clock=time.monotonic):
+        self.run_entry = run_entry
+        self.jitter = jitter
+        self.clock = clock
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self.queue = []
+        self.counter = itertools.count()
+        self.running = 0
+        self.once = False
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def schedule(self, entry, due):
+        """Schedule the next run of an entry.
+
+        :param entry: Entry of the watchlist
+        :param due: time of the run (see `clock')
+        """
+        with self.condition:
+            heapq.heappush(self.queue, (due, next(self.counter), entry))
+            self.condition.notify_all()
+
+    def run_pending(self):
+        """Start the runs that are due.
+
+        :return int: number of runs started
+        """
+        now = self.clock()
+        pending = []
+        with self.condition:
+            while self.queue and self.queue[0][0] <= now:
+                due, _, entry = heapq.heappop(self.queue)
+                pending.append((due, entry))
+            self.running += len(pending)
+        for due, entry in pending:
+            future = self.executor.submit(self.run_entry, entry)
+            future.add_done_callback(functools.partial(self.finished, entry,
+                                                       due))
+        return len(pending)
+
+    def finished(self, entry, due, future):
+        """Log the outcome of a run and schedule the next one."""
+        try:
+            future.result()
+        except Exception:
+            logging.exception("Run of watchlist entry {0} failed".format(
+                ", ".join(entry.countries)))
+        with self.condition:
+            self.running -= 1
+            if not (self.stopped or self.once):
+                next_due = max(due + entry.interval, self.clock())
+                heapq.heappush(self.queue, (
+                    next_due + random.uniform(0, self.jitter),
+                    next(self.counter), entry))
+            self.condition.notify_all()
+
+    def run(self, entries, once=False):
+        """Run the entries until `stop' is called.
+
+        :param entries: list of Entry
+        :param once=False: run each entry once, right away, and return
+        """
+        self.once = once
+        now = self.clock()
+        for entry in entries:
+            self.schedule(entry, now if once else
+                          now + random.uniform(0, self.jitter))
+        try:
+            while True:
+                self.run_pending()
+                with self.condition:
+                    if self.stopped or (once and not self.queue
+                                        and not self.running):
+                        break
+                    timeout = None
+                    if self.queue:
+                        timeout = max(self.queue[0][0] - self.clock(), 0)
+                    self.condition.wait(timeout)
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def stop(self):
+        """Stop scheduling runs; the runs in progress are finished."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+def arg_parser(args):
+    """Initialize argument parser to process the daemon's arguments.
+
+    :param args: list of arguments to parse
+    :return parser: populated namespace of arguments
+    """
+    descr = ("cescout daemon runs cescout for the watchlist of countries in"
+             " the `daemon' section of `cescout.cfg' at their intervals and"
+             " writes the reports to a directory.")
+    parser = argparse.ArgumentParser(prog="cescout daemon", description=descr)
+    parser.add_argument("--once",
+                        action="store_true",
+                        help="run each entry of the watchlist once and exit")
+    parser.add_argument("-v", "--verbose",
+                        action="store_true",
+                        help="enable verbose output (logging.DEBUG)")
+    return parser.parse_args(args)
+
+
+def run(argv=None):
+    """Entry point for `cescout daemon'.
+
+    :param argv: optional list of command-line arguments (after `daemon')
+    """
+    main.enable_logging()
+
+    args = arg_parser(argv)
+    if args.verbose:
+        logging.getLogger().setLevel("DEBUG")
+
+    config = main.load_config() or {}
+    daemon_config = config.get("daemon") or {}
+    entries = load_watchlist(daemon_config)
+    if not entries:
+        logging.error("No countries to watch; see the `daemon' section of"
+                      " `cescout.cfg'")
+        return
+
+    output = os.path.expanduser(daemon_config.get("output", OUTPUT_DIR))
+    try:
+        os.makedirs(output, exist_ok=True)
+    except OSError as e:
+        logging.error("Unable to create output directory {0}: {1}".format(
+            output, e))
+        return
+
+    modules = main.import_projects(projects.__all__, {
+        "skip_{0}".format(project): False for project in projects.__all__})
+    runner = functools.partial(run_entry, modules=modules, config=config,
+                               limits=project_limits(daemon_config),
+                               output=output,
+                               raw=daemon_config.get("raw", False))
+    scheduler = Scheduler(runner,
+                          workers=daemon_config.get("workers", WORKERS),
+                          jitter=daemon_config.get("jitter", JITTER))
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: scheduler.stop())
+
+    cache.keep_open()
+    logging.info("Watching {0} entries; reports are written to {1}".format(
+        len(entries), output))
+    try:
+        scheduler.run(entries, once=args.once)
+    finally:
+        cache.close_shared()
+        for m in modules.values():
+            if hasattr(m, "close_pool"):
+                m.close_pool()
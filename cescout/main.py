@@ -18,25 +18,40 @@ to correlate information from OONI and IODA.
 
 import argparse
 import collections
+import concurrent.futures
 import importlib
 import json
 import logging
 import os
+import sys
+import threading
+import time
 
-import jinja2
-
-import yaml
-
-from . import __version__
+from . import cache
 from . import common
+from . import metrics
+from . import profiling
 from . import projects
 
+# Commands that can be passed as the first argument, mapped to their module;
+# each module has a `run' function that takes the remaining arguments.
+COMMANDS = {"daemon": "daemon", "serve": "server"}
+
+# Jinja environments by template directory (see `template_environment').
+_ENVIRONMENTS = {}
+_ENVIRONMENTS_LOCK = threading.Lock()
 
+
+@profiling.phase("load_config")
 def load_config():
     """Reads a YAML file and returns the configuration data.
 
     :return config_data: dict with configuration data from `cescout.cfg'
     """
+    # yaml, jinja2 and the projects' modules (see `import_projects') are
+    # imported when first needed so that `--help' and `--version' start fast.
+    import yaml
+
     config_data = {}
 
     config_file = os.path.join(config_dir(), "cescout.cfg")
@@ -59,6 +74,19 @@ def load_config():
     return config_data
 
 
+class VersionAction(argparse.Action):
+    """Print the version and exit, reading the version only then."""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS, help=None):
+        super().__init__(option_strings, dest, nargs=0, default=default,
+                         help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from . import __version__
+        parser.exit(message="{0} {1}\n".format(parser.prog, __version__))
+
+
 def arg_parser(args, projects):
     """Initialize argument parser to process command-line arguments.
 
@@ -72,9 +100,21 @@ def arg_parser(args, projects):
              ", RIPE (stat.ripe.net)"
              " for a given country (and its ASNs) and generates a report.")
     parser = argparse.ArgumentParser(description=descr)
-    parser.add_argument("-c", "--country",
-                        required=True,
-                        help="two-letter country code to run query against")
+    country = parser.add_mutually_exclusive_group(required=True)
+    country.add_argument("-c", "--country",
+                         type=common.validate_country,
+                         help="two-letter country code to run query against")
+    country.add_argument("--countries",
+                         nargs='+',
+                         metavar="COUNTRY",
+                         type=common.validate_country,
+                         help="list of two-letter country codes to run query"
+                              " against (one report per country)")
+    country.add_argument("--country-file",
+                         dest="countries",
+                         type=common.read_country_file,
+                         help="file with one two-letter country code per line"
+                              " to run query against (same as `--countries')")
     parser.add_argument("-s", "--since",
                         metavar=common.TIME_FORMAT,
                         type=common.validate_date,
@@ -87,21 +127,36 @@ def arg_parser(args, projects):
     parser.add_argument("-a", "--asns",
                         nargs='+',
                         type=int,
-                        help="list of ASNs in country to query for")
+                        help="list of ASNs in country to query for (only"
+                             " with `--country')")
     parser.add_argument("-v", "--verbose",
                         action="store_true",
                         help="enable verbose output (logging.DEBUG)")
     parser.add_argument("-r", "--raw",
                         action="store_true",
                         help="return the raw JSON results instead of a report")
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="print the time taken by each phase of the run"
+                             " to stderr")
+    parser.add_argument("--profile-output",
+                        metavar="FILE",
+                        help="profile the run with cProfile and write the"
+                             " statistics to FILE (implies `--profile')")
     parser.add_argument("--version",
-                        action="version",
-                        version="%(prog)s {0}".format(__version__))
+                        action=VersionAction,
+                        help="show program's version number and exit")
     for project in projects:
         parser.add_argument("--skip-{0}".format(project),
                             action="store_true",
                             help="skip measurements from {0}".format(project))
-    return parser.parse_args(args)
+    parsed = parser.parse_args(args)
+    # The ASNs are checked against the country, so they cannot be applied to
+    # a list of countries.
+    if parsed.asns and parsed.countries:
+        parser.error("argument -a/--asns: not allowed with argument"
+                     " --countries/--country-file")
+    return parsed
 
 
 def enable_logging():
@@ -110,6 +165,63 @@ def enable_logging():
                         level=logging.INFO)
 
 
+def template_environment(template_path, bytecode_dir=None):
+    """Return the Jinja environment for the templates in a directory.
+
+    Environments are created once per process and cached, along with the
+    templates they compile, so that a process that generates many reports
+    (such as `cescout daemon') only compiles each template once. Templates are
+    still reloaded if they change.
+
+    :param template_path: directory of the templates
+    :param bytecode_dir=None: directory the compiled templates are also cached
+                              in (see `jinja2.FileSystemBytecodeCache'), so
+                              that they are not compiled on each run
+    :return env: jinja2.Environment
+    """
+    import jinja2
+
+    key = (template_path, bytecode_dir)
+    with _ENVIRONMENTS_LOCK:
+        env = _ENVIRONMENTS.get(key)
+        if env is not None:
+            return env
+        bytecode_cache = None
+        if bytecode_dir is not None:
+            try:
+                os.makedirs(bytecode_dir, exist_ok=True)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_dir)
+            except OSError as e:
+                logging.warning("Unable to cache compiled templates in {0}:"
+                                " {1}".format(bytecode_dir, e))
+        logging.debug("Loading templates from {0}".format(template_path))
+        env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(template_path),
+            bytecode_cache=bytecode_cache, trim_blocks=True,
+            lstrip_blocks=True)
+        env.filters["time_utc"] = common.time_utc
+        _ENVIRONMENTS[key] = env
+    return env
+
+
+def report_template(data, template_name="report.template"):
+    """Return the compiled template of the report.
+
+    :param data: dict with measurement data; compiled templates are cached in
+                 the `templates' subdirectory of the cache directory (see
+                 `cache.cache_directory') set in its `config', if any
+    :param template_name=report.template: Jinja2 template that specifies the
+                                          report format
+    :return template: jinja2.Template
+    """
+    directory = cache.cache_directory(**(data.get("config") or {}))
+    bytecode_dir = (os.path.join(directory, "templates")
+                    if directory is not None else None)
+    env = template_environment(config_dir(), bytecode_dir)
+    return env.get_template(template_name)
+
+
+@profiling.phase("generate_report")
 def generate_report(data, template_name="report.template"):
     """Generate a report based on data formatted to a Jinja template.
 
@@ -118,53 +230,232 @@ def generate_report(data, template_name="report.template"):
                                           report format
     :return template: formatted template based on :param data:
     """
-    template_path = config_dir()
-    logging.debug("Loading template {0} from {1}".format(template_name,
-                                                         template_path))
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_path),
-                             trim_blocks=True, lstrip_blocks=True)
-    template = env.get_template(template_name)
+    return report_template(data, template_name).render(data=data)
 
-    return template.render(data=data)
 
+@profiling.phase("render_report")
+def render_report(data, f, template_name="report.template"):
+    """Write a report to a file as it is rendered (see `generate_report').
 
-def get_measurements(projects, args):
-    """Fetch measurements from projects based on input parameters.
+    The report is written a part at a time, so that the report of a country
+    with many measurements is never held in memory as a whole.
 
-    :param projects: list of measurement projects to query the script for
-    :param args: dict of command-line arguments
-    :return dict: measurement results from :param projects:
+    :param data: dict with measurement data to generate a report against
+    :param f: file object (opened for writing text) to write the report to
+    :param template_name=report.template: Jinja2 template that specifies the
+                                          report format
     """
-    config = load_config()
+    f.writelines(report_template(data, template_name).generate(data=data))
 
-    measurement_data = {
-        "country": common.country_name(args["country"]),
-        "asns": args["asns"],
-        "current": str(common.date_today()),
-        "since": str(args["since"]), "until": str(args["until"]),
-        "config": config
-    }
 
-    measurements = collections.defaultdict(dict)
+def import_projects(projects, args):
+    """Import the modules of the projects that were not skipped.
+
+    :param projects: list of measurement projects to query the script for
+    :param args: dict of command-line arguments
+    :return modules: dict of project mapped to its module (projects that were
+                     skipped or do not have a `run' function are left out)
+    """
+    modules = {}
     for project in projects:
-        measurements["projects"][project] = {}
         if not args["skip_{0}".format(project)]:
             m = importlib.import_module("cescout.projects.{0}".format(project))
-            logging.info("Fetching data from `{0}'".format(project))
-            try:
-                data = getattr(m, "run")(args["country"], args["asns"],
-                                         args["since"], args["until"],
-                                         **config)
-                measurements["projects"][project]["data"] = (None if not data
-                                                             else data)
-                measurements["projects"][project]["ran_test"] = True
-            except AttributeError:
+            if not hasattr(m, "run"):
                 logging.error("No function `run' in `{0}'".format(project))
+                continue
+            modules[project] = m
         else:
-            measurements["projects"][project]["ran_test"] = False
             logging.warning("Skipping `{0}' as asked by user".format(project))
+    return modules
+
+
+def run_project(module, project, args, config):
+    """Run the `run' function of a project module and time it.
+
+    :param module: imported project module (`cescout.projects.<project>')
+    :param project: name of the project
+    :param args: dict of command-line arguments
+    :param config: dict with configuration data from `cescout.cfg'
+    :return tuple: (data returned by the project, elapsed time in seconds)
+    """
+    logging.info("Fetching data from `{0}'".format(project))
+    start = time.monotonic()
+    with metrics.timed(metrics.PROJECT_DURATION, metrics.PROJECT_RUNS,
+                       project=project), \
+            profiling.phase("{0}.run".format(project)):
+        data = getattr(module, "run")(args["country"], args["asns"],
+                                      args["since"], args["until"], **config)
+    elapsed = time.monotonic() - start
+    logging.debug("`{0}' finished in {1:.3f}s".format(project, elapsed))
+    return data, elapsed
+
+
+def run_project_batch(module, project, args, config):
+    """Run a project for a list of countries and time it.
+
+    Projects that can share their upstream queries between countries provide a
+    `run_batch' function that takes a list of countries and returns a dict of
+    country mapped to its data; for other projects, `run' is called once per
+    country.
+
+    :param module: imported project module (`cescout.projects.<project>')
+    :param project: name of the project
+    :param args: dict of command-line arguments (with `countries')
+    :param config: dict with configuration data from `cescout.cfg'
+    :return tuple: (dict of country mapped to the data returned by the project,
+                    elapsed time in seconds)
+    """
+    logging.info("Fetching data from `{0}' for {1} countries".format(
+        project, len(args["countries"])))
+    start = time.monotonic()
+    with metrics.timed(metrics.PROJECT_DURATION, metrics.PROJECT_RUNS,
+                       project=project), \
+            profiling.phase("{0}.run_batch".format(project)):
+        if hasattr(module, "run_batch"):
+            data = getattr(module, "run_batch")(args["countries"],
+                                                args["asns"], args["since"],
+                                                args["until"], **config)
+        else:
+            data = {country: getattr(module, "run")(country, args["asns"],
+                                                    args["since"],
+                                                    args["until"], **config)
+                    for country in args["countries"]}
+    elapsed = time.monotonic() - start
+    logging.debug("`{0}' finished in {1:.3f}s".format(project, elapsed))
+    return data, elapsed
 
-    return {**measurement_data, **measurements}
+
+def run_projects(runner, modules, args, config):
+    """Run projects concurrently, one thread per project.
+
+    :param runner: function that runs a project (`run_project' or
+                   `run_project_batch')
+    :param modules: dict of project mapped to its module
+    :param args: dict of command-line arguments
+    :param config: dict with configuration data from `cescout.cfg'
+    :return results: dict of project mapped to a tuple of (data, elapsed);
+                     the data of a project that failed is None, so that the
+                     results of the other projects still reach the report
+    """
+    if not modules:
+        return {}
+
+    start = time.monotonic()
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(modules)) as executor:
+        futures = {project: executor.submit(runner, m, project, args, config)
+                   for project, m in modules.items()}
+        for project, future in futures.items():
+            try:
+                results[project] = future.result()
+            except Exception:
+                logging.exception("Unable to fetch data from `{0}'".format(
+                    project))
+                # The time until the failure was noticed.
+                results[project] = (None, time.monotonic() - start)
+    return results
+
+
+def project_measurements(projects, args, results, data_for=None):
+    """Build the `projects' part of the measurements from the results.
+
+    :param projects: list of measurement projects to query the script for
+    :param args: dict of command-line arguments
+    :param results: dict of project mapped to a tuple of (data, elapsed)
+    :param data_for=None: if set, the data of each project is a dict of
+                          country mapped to its data, and only the data for
+                          this country is used
+    :return measurements: defaultdict with the measurements of each project
+    """
+    measurements = collections.defaultdict(dict)
+    for project in projects:
+        measurements["projects"][project] = {}
+        if args["skip_{0}".format(project)]:
+            measurements["projects"][project]["ran_test"] = False
+        elif project in results:
+            data, elapsed = results[project]
+            if data_for is not None:
+                data = data.get(data_for) if data else None
+            measurements["projects"][project]["data"] = (None if not data
+                                                         else data)
+            measurements["projects"][project]["ran_test"] = True
+            measurements["projects"][project]["elapsed"] = round(elapsed, 3)
+    return measurements
+
+
+def measurement_data(country, args, config, current=None):
+    """Build the part of the measurements that does not come from projects.
+
+    :param country: two-letter country code
+    :param args: dict of command-line arguments
+    :param config: dict with configuration data from `cescout.cfg'
+    :param current=None: current date (string); defaults to today
+    :return dict: country name, ASNs, dates and configuration data
+    """
+    return {
+        "country": common.country_name(country),
+        "asns": args["asns"],
+        "current": current or str(common.date_today()),
+        "since": str(args["since"]), "until": str(args["until"]),
+        "config": config
+    }
+
+
+def get_measurements(projects, args, config=None):
+    """Fetch measurements from projects based on input parameters.
+
+    Projects that are not skipped are run concurrently, one thread per project,
+    so that the total time taken is that of the slowest project and not the
+    sum of all of them.
+
+    :param projects: list of measurement projects to query the script for
+    :param args: dict of command-line arguments
+    :param config=None: dict with configuration data from `cescout.cfg'; read
+                        with `load_config' if not set
+    :return dict: measurement results from :param projects:
+    """
+    if config is None:
+        config = load_config()
+
+    modules = import_projects(projects, args)
+    results = run_projects(run_project, modules, args, config)
+    measurements = project_measurements(projects, args, results)
+
+    return {**measurement_data(args["country"], args, config),
+            **measurements}
+
+
+def get_batch_measurements(projects, args, config=None):
+    """Fetch measurements from projects for a list of countries.
+
+    The configuration is read once and every project is run once for all the
+    countries, so that projects that support it (see `run_project_batch') can
+    share their upstream queries between the countries.
+
+    :param projects: list of measurement projects to query the script for
+    :param args: dict of command-line arguments (with `countries')
+    :param config=None: dict with configuration data from `cescout.cfg'; read
+                        with `load_config' if not set
+    :return list: measurement results from :param projects:, one dict per
+                  country in the same format as `get_measurements'
+    """
+    if config is None:
+        config = load_config()
+
+    modules = import_projects(projects, args)
+    results = run_projects(run_project_batch, modules, args, config)
+
+    all_measurements = []
+    current = str(common.date_today())
+    for country in args["countries"]:
+        measurements = project_measurements(projects, args, results,
+                                            data_for=country)
+        all_measurements.append({
+            **measurement_data(country, args, config, current),
+            **measurements})
+
+    return all_measurements
 
 
 def run(argv=None):
@@ -173,10 +464,22 @@ def run(argv=None):
     This function sets up the required arguments and calls other functions that
     fetch the measurements and generate a report.
 
+    With `daemon' or `serve' as the first argument, `cescout' runs as a daemon
+    (see `daemon.run') or serves reports over HTTP (see `server.run') instead.
+
     :param argv: optional list of command-line arguments (defaults to sys.argv)
     :return print: report with measurement results (if args.raw is False)
                    raw results in JSON format (if args.raw is True)
+                   one report (or JSON document per line) per country
     """
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] and argv[0] in COMMANDS:
+        # Imported here as the commands use the functions of this module.
+        command = importlib.import_module("cescout.{0}".format(
+            COMMANDS[argv[0]]))
+        return command.run(argv[1:])
+
     enable_logging()
 
     args = arg_parser(argv, projects.__all__)
@@ -186,14 +489,30 @@ def run(argv=None):
         args.until = common.date_today()
         logging.debug("`--until' not passed; assuming current time in UTC")
 
-    measurements = get_measurements(projects.__all__, vars(args))
-
-    if not args.raw:
-        output = generate_report(measurements)
-        print(output)
-    else:
-        logging.debug("--raw passed; report will not be generated.")
-        print(json.dumps(measurements))
+    if args.profile or args.profile_output:
+        profiling.start(profile=args.profile_output is not None)
+    try:
+        config = load_config()
+        if args.country is not None:
+            all_measurements = [get_measurements(projects.__all__,
+                                                 vars(args), config)]
+        else:
+            all_measurements = get_batch_measurements(projects.__all__,
+                                                      vars(args), config)
+        metrics.export(**(config or {}))
+
+        if args.raw:
+            logging.debug("--raw passed; report will not be generated.")
+        for measurements in all_measurements:
+            if not args.raw:
+                render_report(measurements, sys.stdout)
+                print()
+            else:
+                print(json.dumps(measurements))
+    finally:
+        if args.profile or args.profile_output:
+            phases = profiling.stop(args.profile_output)
+            print(profiling.format_phases(phases), file=sys.stderr)
 
 
 def config_dir():
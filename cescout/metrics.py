@@ -0,0 +1,262 @@
+"""Metrics of the runs of the projects, in Prometheus' text format.
+
+The time taken by the `run' of each project, by each request to the projects'
+APIs and by each database query is recorded in histograms, along with counters
+of the runs, requests (by status class), queries and rows. The metrics are
+kept in memory and can be exported in Prometheus' text exposition format:
+written to a file after each run (`file' in the `metrics' section of
+`cescout.cfg', for node_exporter's textfile collector) or served on `/metrics'
+by `cescout serve'.
+
+This is a minimal implementation of counters and histograms so that
+`prometheus_client' is not required.
+"""
+
+import bisect
+import contextlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# Upper bounds (in seconds) of the buckets of the latency histograms.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value):
+    """Format a sample value as in Prometheus' text format."""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(labels):
+    """Format a dict of labels as in Prometheus' text format."""
+    if not labels:
+        return ""
+    escaped = ('{0}="{1}"'.format(name, str(value).replace("\\", "\\\\")
+                                  .replace("\n", "\\n").replace('"', '\\"'))
+               for name, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+class Registry:
+    """Collection of metrics that are exported together."""
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+
+    def expose(self):
+        """Return the metrics in Prometheus' text exposition format.
+
+        :return string: one `HELP' and `TYPE' line per metric, followed by its
+                        samples
+        """
+        with self._lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {0} {1}".format(metric.name,
+                                                 metric.documentation))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                lines.append("{0}{1}{2} {3}".format(
+                    metric.name, suffix, format_labels(labels),
+                    format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the metrics to a file, replacing it atomically.
+
+        :param path: path of the file
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                        prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.expose())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    """Base class of the metrics, with one value per set of label values.
+
+    :param name: name of the metric
+    :param documentation: description of the metric (`HELP')
+    :param labelnames=(): names of the labels
+    :param registry=REGISTRY: registry the metric is exported with
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Labels of {0} must be: {1}".format(
+                self.name, ", ".join(self.labelnames)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+
+class Counter(Metric):
+    """Counter that only goes up."""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increment the counter for :param labels: by :param amount:."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Return the value of the counter for :param labels:."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield "", self._labels(key), value
+
+
+class Histogram(Metric):
+    """Histogram of observed values, with cumulative buckets.
+
+    :param buckets=BUCKETS: upper bounds of the buckets (`+Inf' is added)
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY,
+                 buckets=BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"), )
+
+    def observe(self, value, **labels):
+        """Record :param value: for :param labels:."""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets),
+                                                      0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        """Return the number of values observed for :param labels:."""
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ((), 0))
+            return sum(counts)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", {**labels, "le": format_value(bound)}, \
+                    cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+
+@contextlib.contextmanager
+def timed(histogram, counter, **labels):
+    """Time a block and count it by outcome (`ok' or `error').
+
+    :param histogram: Histogram the duration (in seconds) is recorded in
+    :param counter: Counter with an `outcome' label, in addition to
+                    :param labels:
+    :param labels: labels of the samples
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        counter.inc(outcome="error", **labels)
+        raise
+    else:
+        counter.inc(outcome="ok", **labels)
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+PROJECT_DURATION = Histogram(
+    "cescout_project_duration_seconds",
+    "Time taken by the run of a project.", ["project"])
+PROJECT_RUNS = Counter(
+    "cescout_project_runs_total",
+    "Runs of a project, by outcome.", ["project", "outcome"])
+HTTP_DURATION = Histogram(
+    "cescout_http_request_duration_seconds",
+    "Time taken by a request to a project's API, until the response headers"
+    " are received.", ["project"])
+HTTP_REQUESTS = Counter(
+    "cescout_http_requests_total",
+    "Requests to a project's API, by status class (`error' if no response"
+    " was received).", ["project", "status"])
+DB_DURATION = Histogram(
+    "cescout_db_query_duration_seconds",
+    "Time taken by a database query, including reading its rows.", ["query"])
+DB_QUERIES = Counter(
+    "cescout_db_queries_total",
+    "Database queries, by outcome.", ["query", "outcome"])
+DB_ROWS = Counter(
+    "cescout_db_rows_total",
+    "Rows returned by database queries.", ["query"])
+# Only the measurements kept for the report are counted: those that are not
+# useful are filtered out by the database query (see `ooni.DB_FILTER') and are
+# never seen by the processing.
+PROCESSED_ROWS = Counter(
+    "cescout_processed_rows_total",
+    "Rows of measurements kept for the report (rows filtered out by the"
+    " database query are not counted).", ["project"])
+
+
+def export(**config):
+    """Write the metrics to the file set in `cescout.cfg', if any.
+
+    :param config: config settings; `file' in the `metrics' section is the
+                   path of the file
+    """
+    path = (config.get("metrics") or {}).get("file")
+    if not path:
+        return
+    path = os.path.expanduser(path)
+    try:
+        REGISTRY.write(path)
+    except OSError as e:
+        logging.warning("Unable to write metrics to {0}: {1}".format(path, e))
+        return
+    logging.debug("Wrote metrics to {0}".format(path))
@@ -0,0 +1,138 @@
+"""Time the phases of a run (`--profile').
+
+The phases of a run (loading the configuration, the `run' of each project, the
+requests to the projects' APIs, the database query, the processing of the
+measurements and the rendering of the report) are wrapped in `phase', which
+does nothing unless profiling was started with `start'. Each phase is then
+timed (wall-clock time) and `format_phases' summarizes the calls, total and
+longest time of each one.
+
+Phases overlap: the projects run concurrently, and the time of a phase includes
+that of the phases it calls (such as `fetch_data' in the `run' of a project).
+Rows of the `metadb' query are read as they are processed, so the time taken
+to transfer them is included in `ooni.process_results'.
+
+With a file, the run is also profiled with `cProfile', in the main thread and
+in every thread started while profiling, and the statistics are written to the
+file for offline analysis (see the `pstats' module). Before Python 3.12, each
+thread gets its own profiler; since 3.12, `cProfile' uses `sys.monitoring',
+which sees every thread but only allows one active profiler, so the profiler
+of the main thread is used alone.
+"""
+
+import contextlib
+import logging
+import sys
+import threading
+import time
+
+# Phases timed since `start' (name mapped to [calls, total, longest]), or
+# None if profiling is disabled; profilers of each thread, if any.
+_PHASES = None
+_PROFILES = None
+_LOCK = threading.Lock()
+# Whether each thread needs its own profiler (see above).
+_THREAD_PROFILES = sys.version_info < (3, 12)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time a phase of the run, if profiling is enabled.
+
+    This can also be used as a decorator, to time every call to a function.
+
+    :param name: name of the phase (such as `ioda.fetch_data')
+    """
+    phases = _PHASES
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _LOCK:
+            timing = phases.setdefault(name, [0, 0, 0])
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+
+
+def _profile_thread(*args):
+    # Set with `threading.setprofile': called on the first event of every new
+    # thread, it replaces itself with a profiler for the thread.
+    import cProfile
+
+    profile = cProfile.Profile()
+    with _LOCK:
+        if _PROFILES is None:
+            return
+        _PROFILES.append(profile)
+    profile.enable()
+
+
+def start(profile=False):
+    """Start timing the phases of the run.
+
+    :param profile=False: also profile the run with `cProfile' (see `stop')
+    """
+    global _PHASES, _PROFILES
+    # cProfile and pstats are only imported when profiling, as they are slow
+    # to import.
+    import cProfile
+
+    with _LOCK:
+        _PHASES = {}
+        _PROFILES = [cProfile.Profile()] if profile else None
+    if profile:
+        if _THREAD_PROFILES:
+            threading.setprofile(_profile_thread)
+        _PROFILES[0].enable()
+
+
+def stop(path=None):
+    """Stop timing the phases and write the profile, if any.
+
+    :param path=None: file to write the `cProfile' statistics to (for
+                      `pstats.Stats'), if the run was profiled
+    :return phases: dict of phase mapped to a tuple of (calls, total time,
+                    longest time), in seconds
+    """
+    global _PHASES, _PROFILES
+    if _THREAD_PROFILES:
+        threading.setprofile(None)
+    with _LOCK:
+        phases, profiles = _PHASES, _PROFILES
+        _PHASES = _PROFILES = None
+    if profiles:
+        import pstats
+
+        profiles[0].disable()
+        stats = pstats.Stats(profiles[0])
+        for each in profiles[1:]:
+            stats.add(each)
+        if path is not None:
+            try:
+                stats.dump_stats(path)
+            except OSError as e:
+                logging.error("Unable to write profile to {0}: {1}".format(
+                    path, e))
+            else:
+                logging.info("Wrote profile to {0}".format(path))
+    return {name: tuple(timing) for name, timing in (phases or {}).items()}
+
+
+def format_phases(phases):
+    """Format the timings of the phases as a table, slowest first.
+
+    :param phases: dict returned by `stop'
+    :return string: one line per phase with its calls, total and longest time
+    """
+    lines = ["{0:<32} {1:>7} {2:>11} {3:>11}".format("phase", "calls",
+                                                     "total (s)", "max (s)")]
+    for name, (calls, total, longest) in sorted(phases.items(),
+                                                key=lambda item: -item[1][1]):
+        lines.append("{0:<32} {1:>7} {2:>11.3f} {3:>11.3f}".format(
+            name, calls, total, longest))
+    return "\n".join(lines)
@@ -5,104 +5,303 @@ result to extract internet outage data. It does this by detecting transitions
 between "normal" to "warning" or "critical" levels and marks a country to be
 affected by an outage event if it detects such a transition. This method is not
 documented on the website or the API but was suggested by the IODA developers
-and meets their definition of what constitutes an "outage" event.
+and meets their definition of what constitutes an "outage" event. Each outage
+is reported as an interval, from the transition until the level goes back to
+"normal".
 
 For more information about CAIDA's IODA project and their methodology, please
 visit the website: https://ioda.caida.org/ioda.
 """
 
+import codecs
 import collections
-import itertools
+import json
 import logging
+import sys
 from datetime import timezone
 
 import requests
 
+from .. import client
+from .. import profiling
+
 IODA_API_URL = ("https://ioda.caida.org/ioda/data/alerts?"
                 "human=true&from={0}&until={1}&annotateMeta=true")
 IODA_VIEW_URL = ("https://ioda.caida.org/ioda/dashboard#"
                  "view=inspect&entity=country/{0}&"
                  "lastView=overview&from={1}&until={2}")
+# Size of the chunks (in bytes) in which the API response is read.
+CHUNK_SIZE = 64 * 1024
+# Severity of the levels returned by the API, used to find the peak level of an
+# outage.
+LEVELS = {"normal": 0, "warning": 1, "critical": 2}
+# Characters that can follow a complete JSON number.
+_NUMBER_DELIMITERS = frozenset(",]} \t\r\n")
 
+# Requests to IODA share this client so that the connection is kept alive and
+# reused across runs (see `daemon').
+CLIENT = client.Client("ioda", pool_maxsize=1)
 
-def pair(iterable):
-    """Create pairs of items from an iterator.
 
-    If the iterable is (1, 2, 3), this function returns [(1, 2), (2, 3)]. We
-    use this to to pair the levels returned by the API so that we can detect
-    transitions between them.
+class _StreamDecoder:
+    """Decode JSON values one at a time from an iterable of byte chunks.
 
-    :param iterable: an iterable object to create pairs from
-    :return list: a list of pair of tuples from the iterable
+    Only the part of the input that has not been decoded yet is kept in
+    memory, so that large documents can be walked without loading them.
     """
-    if len(iterable) < 2:
-        return None
-    first, second = itertools.tee(iterable)
-    next(second, None)
-    return list(zip(first, second))
 
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
 
-def parse_response(response, country):
-    """Parse IODA's API response to extract outage information.
+    def _fill(self):
+        """Read the next chunk into the buffer; return False at the end."""
+        for chunk in self._chunks:
+            text = self._utf8.decode(chunk)
+            if text:
+                self._buf = self._buf[self._pos:] + text
+                self._pos = 0
+                return True
+        return False
 
-    :param response: JSON response returned by IODA's API
-    :param country: two-letter country code to check for outage events
-    :return outage: dict with a single key `is_outage' that specifies if an
-                    outage event was detected for :param country:
+    def peek(self):
+        """Return the next non-whitespace character without consuming it."""
+        while True:
+            buf = self._buf
+            while self._pos < len(buf) and buf[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(buf):
+                return buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        """Consume the next non-whitespace character if it is :param char:."""
+        if self.peek() != char:
+            raise ValueError("Expected {0!r} at position {1}".format(
+                char, self._pos))
+        self._pos += 1
+
+    def value(self):
+        """Decode and return the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A number may continue in the next chunk (such as "1." and "5"),
+            # so only accept it once it is followed by a delimiter or there
+            # is nothing left to read.
+            if isinstance(value, (int, float)) \
+                    and not isinstance(value, bool) \
+                    and self._buf[end:end + 1] not in _NUMBER_DELIMITERS \
+                    and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def items(self):
+        """Iterate over the keys of the next JSON object.
+
+        The caller must consume the value of each key (with `value', `items'
+        or `elements') before moving to the next key.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self._pos += 1
+            else:
+                self.expect("}")
+                return
+
+    def elements(self):
+        """Iterate over the elements of the next JSON array."""
+        self.expect("[")
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ",":
+                self._pos += 1
+            else:
+                self.expect("]")
+                return
+
+
+def iter_alerts(chunks):
+    """Decode the alerts (`data.alerts') from IODA's API response lazily.
+
+    The response is decoded as it is read, one alert at a time, so that the
+    whole response is never held in memory.
+
+    :param chunks: iterable of bytes with the JSON response returned by IODA's
+                   API (such as `requests.Response.iter_content')
+    :return generator: alerts (dicts) in the order returned by the API
     """
-    all_events = collections.defaultdict(list)
-    for each in response["data"]["alerts"]:
-        # IODA tracks both country- and AS-level outages but for our purpose,
-        # we only care about country-wide outages and therefore filter the
-        # `metaType` and get the results for countries (`region').
-        if each["metaType"] == "region":
-            country_code = each["meta"]["attrs"]["country_code"]
-            if country_code == country:
-                fqid = each["meta"]["attrs"]["fqid"]
-                logging.debug("Logging fqid {0}".format(fqid))
-                all_events[country_code].append({"time": each["time"],
-                                                 "level": each["level"],
-                                                 "fqid": fqid})
-    logging.debug("Fetched measurements from IODA")
+    decoder = _StreamDecoder(chunks)
+    for key in decoder.items():
+        if key != "data" or decoder.peek() != "{":
+            decoder.value()
+            continue
+        for data_key in decoder.items():
+            if data_key == "alerts" and decoder.peek() == "[":
+                yield from decoder.elements()
+            else:
+                decoder.value()
 
-    outage = {}
-    for country, data in all_events.items():
-        # Get the levels and sort them by when they happened.
-        levels = [each["level"] for each in
-                  sorted(data, key=lambda value: value["time"])]
-        levels_pairs = pair(levels)
-        # IODA categorizes an event as an "outage" if there is at least one
-        # transition from (normal, warning) or (normal, critical) during the
-        # specified time interval.
-        #
-        # Note that there can be multiple such transitions but even one
-        # transition is indicative of an outage.
-        if levels_pairs is not None:
-            if ("normal", "warning") in levels_pairs \
-                    or ("normal", "critical") in levels_pairs:
-                outage["is_outage"] = True
+
+def index_alerts(alerts, countries=None, meta_types=("region", )):
+    """Build an index of alerts by country and metaType in one pass.
+
+    Only the fields needed to detect outages are kept for each alert, as a
+    tuple of (time, level, fqid).
+
+    :param alerts: iterable of alerts (see `iter_alerts')
+    :param countries=None: list of two-letter country codes to index (all
+                           countries are indexed if not set)
+    :param meta_types=("region", ): metaTypes to index; IODA tracks both
+                                    country- and AS-level outages but for our
+                                    purpose, we only care about country-wide
+                                    outages (`region')
+    :return index: dict of country mapped to a dict of metaType mapped to a
+                   list of (time, level, fqid) tuples
+    """
+    index = collections.defaultdict(lambda: collections.defaultdict(list))
+    for each in alerts:
+        if each.get("metaType") not in meta_types:
+            continue
+        attrs = each.get("meta", {}).get("attrs", {})
+        country_code = attrs.get("country_code")
+        if country_code is None:
+            continue
+        if countries is not None and country_code not in countries:
+            continue
+        # Levels and fqids repeat across alerts, so share the strings.
+        index[country_code][each["metaType"]].append(
+            (each["time"], sys.intern(each["level"]),
+             sys.intern(attrs["fqid"])))
+    logging.debug("Indexed IODA alerts for {0} countries".format(len(index)))
+    return index
+
+
+def outage_intervals(events):
+    """Find the outage intervals in the events of a country.
+
+    IODA categorizes an event as an "outage" if there is a transition from
+    (normal, warning) or (normal, critical). We walk the events in the order
+    they happened and open an interval on such a transition; the interval is
+    closed when the level goes back to normal. This is done in a single pass.
+
+    :param events: list of (time, level, fqid) tuples
+    :return intervals: list of dicts, one per outage, with the `start' and
+                       `end' time (epoch; `end' is None if the outage did not
+                       end in the time period), the peak `level' and the
+                       `fqids' that reported it
+    """
+    intervals = []
+    current = None
+    previous = None
+    for time, level, fqid in sorted(events, key=lambda value: value[0]):
+        if current is not None:
+            if level == "normal":
+                current["end"] = time
+                intervals.append(current)
+                current = None
             else:
-                outage["is_outage"] = False
+                if LEVELS.get(level, 0) > LEVELS.get(current["level"], 0):
+                    current["level"] = level
+                current["fqids"].setdefault(fqid)
+        elif previous == "normal" and level in ("warning", "critical"):
+            current = {"start": time, "end": None, "level": level,
+                       "fqids": {fqid: None}}
+        previous = level
+    if current is not None:
+        intervals.append(current)
+
+    for interval in intervals:
+        interval["fqids"] = list(interval["fqids"])
+    return intervals
+
+
+def detect_outage(events):
+    """Detect an outage from the events of a country.
+
+    :param events: list of (time, level, fqid) tuples
+    :return outage: dict with `is_outage', that specifies if an outage event
+                    was detected, and the outage `intervals' (see
+                    `outage_intervals'); empty if there are not enough events
+                    to tell
+    """
+    outage = {}
+    # Note that there can be multiple outages but even one is indicative of
+    # an outage in the time period.
+    if len(events) > 1:
+        intervals = outage_intervals(events)
+        outage["is_outage"] = bool(intervals)
+        outage["intervals"] = intervals
 
     logging.debug(outage)
     return outage
 
 
-def fetch_data(request_url):
-    """Query IODA's API and return the JSON response.
+def parse_response(index, country):
+    """Parse the indexed alerts to extract outage information.
+
+    :param index: alerts indexed by country (see `index_alerts')
+    :param country: two-letter country code to check for outage events
+    :return outage: dict with the outage information for :param country: (see
+                    `detect_outage')
+    """
+    events = index.get(country, {}).get("region", [])
+    return detect_outage(events)
+
+
+@profiling.phase("ioda.fetch_data")
+def fetch_data(request_url, countries=None):
+    """Query IODA's API and index the alerts in the response.
+
+    The response is streamed and decoded incrementally (see `iter_alerts'),
+    keeping only the alerts for :param countries:.
 
     :param request_url: IODA_API_URL formatted with the date range
-    :return response: JSON object from the API request
+    :param countries=None: list of two-letter country codes to keep (all
+                           countries are kept if not set)
+    :return index: alerts indexed by country (see `index_alerts')
     """
     logging.debug("Requested URL is {0}".format(request_url))
     try:
-        req = requests.get(request_url)
+        req = CLIENT.get(request_url, stream=True)
         req.raise_for_status()
-    except requests.exceptions.HTTPError as e:
+    except requests.exceptions.RequestException as e:
         logging.error(e)
         return {}
-    response = req.json()
-    return response
+    try:
+        alerts = iter_alerts(req.iter_content(chunk_size=CHUNK_SIZE))
+        index = index_alerts(alerts, countries)
+    except ValueError as e:
+        logging.error("Unable to decode IODA's response: {0}".format(e))
+        return {}
+    except requests.exceptions.RequestException as e:
+        # The body is streamed: the connection can still time out or drop
+        # while the alerts are read.
+        logging.error("Unable to read IODA's response: {0}".format(e))
+        return {}
+    finally:
+        req.close()
+    return index
 
 
 def time_epoch(start_date, end_date):
@@ -125,14 +324,42 @@ def run(country, asns, *date_range, **config):
     :param asns: list of ASNs to query for (checked against :param country:)
                  not used for IODA measurements
     :param date_range: tuple of date (since, until)
-    :param config: (optional) other configuration parameters
-                   not used for IODA measurements
-    :return outage_data: dict with two keys: outage state and a link to IODA's
-                         web interface for the measurement period
+    :param config: (optional) other configuration parameters; only the
+                   `http' section is used (see `client.Client.configure')
+    :return outage_data: dict with the outage state, the outage intervals and a
+                         link to IODA's web interface for the measurement
+                         period
     """
+    CLIENT.configure(**config)
     since, until = time_epoch(*date_range)
-    response = fetch_data(IODA_API_URL.format(since, until))
+    index = fetch_data(IODA_API_URL.format(since, until), [country])
 
-    outage_data = parse_response(response, country)
+    outage_data = parse_response(index, country)
     outage_data["url"] = IODA_VIEW_URL.format(country, since, until)
     return outage_data
+
+
+def run_batch(countries, asns, *date_range, **config):
+    """Entry point for the IODA module for a list of countries.
+
+    The alerts are fetched and indexed once for the date range and the index is
+    used to answer all the countries.
+
+    :param countries: list of two-letter country codes to run query against
+    :param asns: not used for IODA measurements
+    :param date_range: tuple of date (since, until)
+    :param config: (optional) other configuration parameters; only the
+                   `http' section is used (see `client.Client.configure')
+    :return all_outage_data: dict of country mapped to its outage data (see
+                             `run')
+    """
+    CLIENT.configure(**config)
+    since, until = time_epoch(*date_range)
+    index = fetch_data(IODA_API_URL.format(since, until), countries)
+
+    all_outage_data = {}
+    for country in countries:
+        outage_data = parse_response(index, country)
+        outage_data["url"] = IODA_VIEW_URL.format(country, since, until)
+        all_outage_data[country] = outage_data
+    return all_outage_data
@@ -3,18 +3,53 @@
 This script queries (a local copy of) OONI's `metadb' for specified domains
 (see `cescout.cfg`) to check for anomalous measurements. It assumes you have a
 local copy of OONI's `metadb' that is running and actively synced as that is
-used to make read-only queries to the database.
+used to make read-only queries to the database. Alternatively, measurements can
+be fetched from OONI's API (see `ooni_api'), instead of `metadb' or when it is
+unavailable.
 """
 
 import collections
+import datetime
 import logging
+import operator
+import threading
+import time
 import urllib.parse
 
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 
-DB_QUERY = """
-   SELECT measurement.measurement_start_time AS measurement_start_time,
+from . import ooni_api
+from .. import cache
+from .. import common
+from .. import metrics
+from .. import profiling
+from .. import store
+
+# Measurements with 0 as the ASN are not useful for us: these measurements are
+# also missing the country so there isn't much we can do. Measurements with an
+# `unknown_failure' are false-positives resulting from a bug in an earlier
+# version of OONI Probe (see https://github.com/ooni/probe-legacy/issues/38).
+# Both are filtered out in the database.
+DB_FILTER = """
+     FROM measurement
+     JOIN input ON input.input_no = measurement.input_no
+     JOIN report ON report.report_no = measurement.report_no
+     JOIN http_verdict ON http_verdict.msm_no = measurement.msm_no
+    WHERE test_name = 'web_connectivity'
+      AND measurement.input_no = ANY(%s)
+      AND probe_cc = ANY(%s)
+      AND test_start_time >= %s
+      AND test_start_time <= %s
+      AND report.probe_asn <> 0
+      AND (http_verdict.http_experiment_failure IS NULL
+           OR http_verdict.http_experiment_failure
+              NOT LIKE '%%unknown_failure%%')"""
+
+DB_COLUMNS = """
+          measurement.measurement_start_time AS measurement_start_time,
           report.report_id,
           report.probe_asn,
           report.probe_cc,
@@ -22,123 +57,847 @@ DB_QUERY = """
           report.test_name,
           input.input,
           http_verdict.blocking,
-          http_verdict.http_experiment_failure
-     FROM measurement
-     JOIN input ON input.input_no = measurement.input_no
-     JOIN report ON report.report_no = measurement.report_no
-     JOIN http_verdict ON http_verdict.msm_no = measurement.msm_no
-    WHERE test_name = 'web_connectivity'
-      AND input.input LIKE ANY(%s)
-      AND probe_cc = %s
-      AND test_start_time >= %s
-      AND test_start_time <= %s;
+          http_verdict.http_experiment_failure"""
+
+DB_QUERY = """
+   SELECT""" + DB_COLUMNS + DB_FILTER + """;
+"""
+
+# The local store (see `sync_store') is synced with the measurements added
+# since the last run, up to the highest `msm_no' at the time.
+DB_MAX_MEASUREMENT = "SELECT max(msm_no) FROM measurement;"
+# As with the inputs (see INPUT_OVERLAP), measurements can appear below the
+# watermark once their transaction commits: the last MEASUREMENT_OVERLAP
+# measurements below the watermark are fetched again on each sync.
+MEASUREMENT_OVERLAP = 10000
+
+DB_SYNC_QUERY = """
+   SELECT measurement.msm_no,
+          test_start_time,""" + DB_COLUMNS + DB_FILTER + """
+      AND measurement.msm_no > %s
+      AND measurement.msm_no <= %s;
+"""
+
+# We consider a measurement as anomalous when the blocking is *not* "false",
+# indicated by a blocking type like "dns" or "tcp_ip".
+DB_SUMMARY_QUERY = """
+   SELECT report.probe_cc,
+          count(*) AS len_all,
+          count(*) FILTER (WHERE http_verdict.blocking
+                           IS DISTINCT FROM 'false') AS len_blocking""" + \
+    DB_FILTER + """
+ GROUP BY report.probe_cc;
 """
 
+# The measurements are counted by time bucket (`date_trunc' to the hour or
+# day), ASN, input and blocking type in one query with grouping sets; the
+# bitmask returned by GROUPING tells which set a row belongs to.
+DB_BREAKDOWN_QUERY = """
+   SELECT probe_cc,
+          GROUPING(bucket, probe_asn, input, blocking) AS grouping,
+          bucket,
+          probe_asn,
+          input,
+          blocking,
+          count(*) AS len_all,
+          count(*) FILTER (WHERE blocking
+                           IS DISTINCT FROM 'false') AS len_blocking
+     FROM (SELECT date_trunc(%s, test_start_time) AS bucket,
+                  report.probe_cc,
+                  report.probe_asn,
+                  input.input,
+                  http_verdict.blocking""" + DB_FILTER + """) AS filtered
+ GROUP BY probe_cc,
+          GROUPING SETS ((bucket), (probe_asn), (input), (blocking));
+"""
+DB_GROUPINGS = {0b0111: ("time", "bucket"), 0b1011: ("asn", "probe_asn"),
+                0b1101: ("input", "input"), 0b1110: ("blocking", "blocking")}
+# Sizes of the time buckets of the breakdowns (`breakdown' in the `ooni'
+# section of `cescout.cfg') and the length of their keys.
+BUCKETS = {"hour": 16, "day": 10}
+
+# The inputs (URLs) that match the configured domains are resolved to their
+# `input_no' before the measurements are queried (see `resolve_inputs'): the
+# substring match cannot use an index, so it is only run on the inputs added
+# since the last run, up to the highest `input_no' at the time, and for all the
+# domains at once. The matching inputs are then mapped back to the domains.
+DB_MAX_INPUT = "SELECT max(input_no) FROM input;"
+
+DB_INPUT_QUERY = """
+   SELECT input_no,
+          input
+     FROM input
+    WHERE input_no > %s
+      AND input_no <= %s
+      AND input LIKE ANY(%s);
+"""
+# An `input_no' is assigned when the input is inserted but only visible once
+# its transaction commits, so inputs can appear below the watermark after it
+# was read. The last INPUT_OVERLAP inputs below the watermark are matched
+# again on each run to pick these up.
+INPUT_OVERLAP = 1000
+
+# Connections to `metadb' are pooled and shared by all the queries run by the
+# process (see `get_pool'); `minconn' connections are kept open between queries
+# and at most `maxconn' are open at a time. Both can be set in the `pool'
+# subsection of the `ooni' section of `cescout.cfg'.
+POOL_MINCONN = 1
+POOL_MAXCONN = 4
+_POOL = None
+_POOL_CONFIG = None
+_POOL_LOCK = threading.Lock()
+
 EXPLORER_LINK = "https://explorer.ooni.io/measurement/{0}?input={1}"
+# Fields of a row that are needed for the report: a measurement is kept as a
+# Measurement record (a tuple) with only these fields instead of the whole row.
+ROW_FIELDS = operator.itemgetter("report_id", "input", "blocking")
+Measurement = collections.namedtuple("Measurement",
+                                     ("report_id", "input", "blocking"))
+# Number of rows fetched at a time from the server-side cursor; can be set with
+# `itersize' in the `ooni' section of `cescout.cfg'.
+ITERSIZE = 2000
 
 
-def run_query(country, *date_range, **query):
-    """Run a Postgres query based on input parameters.
+class PreparedConnection(psycopg2.extensions.connection):
+    """Database connection that keeps track of the statements prepared on it.
 
-    Query parameters are specified by the `cescout.cfg' file and include the
-    name of the database and the user, and the list of domains that will be
-    used to query OONI's `metadb'.
+    Prepared statements only exist in the session that prepared them, so each
+    pooled connection prepares a statement the first time it runs it (see
+    `execute_prepared').
+    """
 
-    Note that if a local copy of `metadb' is not found or if the script was
-    unable to connect to the database, we just return an empty result. There is
-    no fallback mechanism, such as running a query against the API, at least
-    not yet.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
 
-    :param country: two-letter country code to run query against
-    :param date_range: tuple of date: since, until (ISO format)
-    :param query: dict with db information: name, user, domains
-    :return result: database query result
+
+def get_pool(db_config, minconn=POOL_MINCONN, maxconn=POOL_MAXCONN):
+    """Return the connection pool to `metadb', creating it if needed.
+
+    The pool is created once per process and shared between threads; it is
+    replaced if the database settings change.
+
+    :param db_config: dict with the connection parameters (`ooni.database')
+    :param minconn=POOL_MINCONN: number of connections kept open
+    :param maxconn=POOL_MAXCONN: maximum number of connections
+    :return pool: psycopg2.pool.ThreadedConnectionPool object
+    """
+    global _POOL, _POOL_CONFIG
+    pool_config = (dict(db_config), minconn, maxconn)
+    with _POOL_LOCK:
+        if _POOL is not None and (_POOL.closed or _POOL_CONFIG != pool_config):
+            if not _POOL.closed:
+                _POOL.closeall()
+            _POOL = None
+        if _POOL is None:
+            _POOL = psycopg2.pool.ThreadedConnectionPool(
+                minconn, maxconn, connection_factory=PreparedConnection,
+                **db_config)
+            _POOL_CONFIG = pool_config
+            logging.debug("Created connection pool ({0} to {1})".format(
+                minconn, maxconn))
+        return _POOL
+
+
+def close_pool():
+    """Close all the connections in the pool, if any."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None and not _POOL.closed:
+            _POOL.closeall()
+        _POOL = None
+
+
+def release(conn, close=False):
+    """Return a connection to the pool.
+
+    :param conn: connection returned by `connect'
+    :param close=False: close the connection instead of keeping it open (such
+                        as when it is broken)
+    """
+    with _POOL_LOCK:
+        pool = _POOL
+    if pool is None or pool.closed:
+        conn.close()
+        return
+    try:
+        pool.putconn(conn, close=close)
+    except psycopg2.pool.PoolError:
+        # The connection belongs to a pool that was since replaced.
+        conn.close()
+
+
+def connect(**query):
+    """Get a connection to `metadb' and read the domains to query for.
+
+    :param query: dict with db information: name, user, domains (and the
+                  `pool' settings, see `get_pool')
+    :return tuple: (connection, list of domains), or None if the config
+                   settings are missing or if we were unable to connect to the
+                   database; the connection must be returned with `release'
     """
     try:
         db_config = query["ooni"]["database"]
-        domains = ["%{0}%".format(each) for each in query["ooni"]["domains"]]
+        domains = list(query["ooni"]["domains"])
     except KeyError:
         logging.error("Unable to read config settings for OONI's test."
                       " See `cescout.cfg` for an example.")
         return
+    pool_config = query["ooni"].get("pool") or {}
 
     try:
-        conn = psycopg2.connect(**db_config)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        pool = get_pool(db_config,
+                        pool_config.get("minconn", POOL_MINCONN),
+                        pool_config.get("maxconn", POOL_MAXCONN))
+        conn = pool.getconn()
+        if conn.closed:
+            # The server closed the connection while it was in the pool.
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
     except psycopg2.OperationalError as e:
         logging.error("Unable to connect to the database: {0}.".format(e))
         return
+    except psycopg2.pool.PoolError as e:
+        logging.error("Unable to get a database connection: {0}.".format(e))
+        return
+
+    return conn, domains
+
+
+def execute_prepared(conn, cur, name, statement, params=()):
+    """Execute a statement as a prepared statement.
 
-    cur.execute(DB_QUERY, (domains, country, *date_range))
-    logging.debug("Query: {0}".format(cur.query))
+    The statement is prepared (parsed and planned) the first time it is run on
+    a connection; since connections are pooled, later runs only execute it.
 
-    result = cur.fetchall()
+    :param conn: connection returned by `connect'
+    :param cur: cursor of :param conn: to execute the statement on
+    :param name: name of the prepared statement
+    :param statement: SQL statement with `%s' placeholders
+    :param params=(): tuple of parameters for the placeholders
+    """
+    with metrics.timed(metrics.DB_DURATION, metrics.DB_QUERIES, query=name):
+        if name not in conn.prepared:
+            placeholders = tuple("${0}".format(i + 1)
+                                 for i in range(len(params)))
+            cur.execute("PREPARE {0} AS {1}".format(name,
+                                                    statement % placeholders))
+            conn.prepared.add(name)
+        if params:
+            cur.execute("EXECUTE {0} ({1});".format(
+                name, ", ".join(["%s"] * len(params))), params)
+        else:
+            cur.execute("EXECUTE {0};".format(name))
+
+
+def resolve_inputs(conn, domains, input_cache=None):
+    """Resolve the domains to the `input_no' of the inputs that contain them.
+
+    The `input_no' matched by each domain is cached along with the highest
+    `input_no' that was checked (the watermark), so that the next run only
+    matches the inputs that were added since (and the last INPUT_OVERLAP
+    below the watermark). Inputs are never removed from `metadb', so the
+    cached numbers remain valid.
+
+    Domains checked up to the same point (all of them, unless domains were
+    added) are matched in one query.
+
+    :param conn: connection returned by `connect'
+    :param domains: list of domains
+    :param input_cache=None: DiskCache object (see `cache.open_cache'); if not
+                             set, all inputs are matched on every run
+    :return resolved: dict of domain mapped to a sorted list of `input_no'
+    """
+    cur = conn.cursor()
+    execute_prepared(conn, cur, "cescout_max_input", DB_MAX_INPUT)
+    watermark = cur.fetchone()[0] or 0
+
+    resolved = {}
+    groups = collections.defaultdict(list)
+    for domain in domains:
+        key = "inputs:{0}".format(domain)
+        cached = input_cache.get(key) if input_cache is not None else None
+        if cached is None:
+            cached = {"watermark": 0, "input_nos": []}
+        resolved[domain] = cached["input_nos"]
+        checked = max(0, cached["watermark"] - INPUT_OVERLAP) \
+            if cached["watermark"] else 0
+        if checked < watermark:
+            groups[checked].append(domain)
+
+    for checked, group in groups.items():
+        execute_prepared(conn, cur, "cescout_inputs", DB_INPUT_QUERY,
+                         (checked, watermark,
+                          ["%{0}%".format(domain) for domain in group]))
+        matched = {domain: set() for domain in group}
+        for input_no, url in cur.fetchall():
+            for domain in group:
+                if domain in url:
+                    matched[domain].add(input_no)
+        for domain in group:
+            new = matched[domain].difference(resolved[domain])
+            logging.debug("{0} new inputs for {1} ({2} to {3})".format(
+                len(new), domain, checked, watermark))
+            resolved[domain] = sorted(new.union(resolved[domain]))
+            if input_cache is not None:
+                input_cache.set("inputs:{0}".format(domain),
+                                {"watermark": watermark,
+                                 "input_nos": resolved[domain]})
     cur.close()
-    conn.close()
 
-    return result
+    return resolved
 
 
-def process_results(result):
-    """Process the results of a database query and return measurement data.
+def input_numbers(conn, domains, **query):
+    """Return the `input_no' of the inputs that match any of the domains.
+
+    :param conn: connection returned by `connect'
+    :param domains: list of domains
+    :param query: configuration parameters (the `cache' section is used to
+                  cache the inputs of each domain, see `resolve_inputs')
+    :return list: sorted list of `input_no'
+    """
+    input_cache = cache.open_cache("ooni", **query)
+    try:
+        resolved = resolve_inputs(conn, domains, input_cache)
+    finally:
+        if input_cache is not None:
+            cache.close_cache(input_cache)
+    return sorted(set().union(*resolved.values()))
+
 
-    :param result: database query returned by `run_query'
-    :return all_measurements: dict of country mapped to its measurements
-    """
-    query = []
-    for measurement in result:
-        data = {
-            "measurement_time": str(measurement["measurement_start_time"]),
-            "report_id": measurement["report_id"],
-            "asn": measurement["probe_asn"],
-            "country": measurement["probe_cc"],
-            "ip": measurement["probe_ip"],
-            "url": measurement["input"],
-            "blocking": measurement["blocking"],
-            "http_failure": measurement["http_experiment_failure"]
-        }
-        # Encode the link to create an OONI Explorer URL for easy access. This
-        # is also the URL we present in the final report.
-        encode_link = EXPLORER_LINK.format(data["report_id"],
-                                           urllib.parse.quote(data["url"]))
-        data["report_link"] = encode_link
-
-        # Ignore measurements that have 0 as the ASN as these are not useful
-        # for us: these measurements are also missing the country so there
-        # isn't much we can do.
-        if data["asn"] == 0:
-            logging.debug("Skipped test {0}: "
-                          "invalid ASN".format(data["report_id"]))
+def stream_rows(conn, cur, start):
+    """Yield the rows of a cursor, then close it and release the connection.
+
+    The query is timed until all its rows are read (see `metrics'). The
+    generator first yields None, which `run_query' consumes: once started, the
+    connection is released when the generator is closed or garbage collected,
+    even if its rows are never read.
+
+    :param conn: connection returned by `connect'
+    :param cur: named cursor on which a query was executed
+    :param start: time the query was executed at (`time.perf_counter')
+    :return generator: rows returned by the query
+    """
+    count = 0
+    broken = False
+    try:
+        yield
+        for row in cur:
+            count += 1
+            yield row
+    except psycopg2.Error:
+        broken = True
+        metrics.DB_QUERIES.inc(query=cur.name, outcome="error")
+        raise
+    else:
+        metrics.DB_QUERIES.inc(query=cur.name, outcome="ok")
+    finally:
+        try:
+            cur.close()
+        except psycopg2.Error:
+            broken = True
+        release(conn, close=broken)
+        metrics.DB_DURATION.observe(time.perf_counter() - start,
+                                    query=cur.name)
+        metrics.DB_ROWS.inc(count, query=cur.name)
+
+
+@profiling.phase("ooni.run_query")
+def run_query(countries, *date_range, **query):
+    """Run a Postgres query based on input parameters.
+
+    Query parameters are specified by the `cescout.cfg' file and include the
+    name of the database and the user, and the list of domains that will be
+    used to query OONI's `metadb'.
+
+    The query runs on a named (server-side) cursor: rows are transferred
+    `itersize' at a time as they are consumed, so that the rows themselves are
+    never held in memory as a whole (but see `process_results'). The
+    connection is returned to the pool once all the rows are consumed or the
+    generator is closed. Server-side cursors cannot be declared for prepared
+    statements, so unlike the other queries, this one is planned on each run.
+
+    Note that if a local copy of `metadb' is not found or if the script was
+    unable to connect to the database, we just return an empty result; OONI's
+    API is then used instead if `fallback' is set (see `run_batch').
+
+    :param countries: list of two-letter country codes to run query against
+    :param date_range: tuple of date: since, until (ISO format)
+    :param query: dict with db information: name, user, domains, itersize
+                  (and the `cache' section, see `input_numbers')
+    :return result: generator of rows returned by the database query
+    """
+    connection = connect(**query)
+    if connection is None:
+        return
+    conn, domains = connection
+
+    rows = None
+    try:
+        inputs = input_numbers(conn, domains, **query)
+        cur = conn.cursor(name="cescout",
+                          cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.itersize = query["ooni"].get("itersize", ITERSIZE)
+
+        start = time.perf_counter()
+        cur.execute(DB_QUERY, (inputs, countries, *date_range))
+        logging.debug("Query: {0}".format(cur.query))
+
+        # From here on, the connection is released by the generator.
+        rows = stream_rows(conn, cur, start)
+        next(rows)
+    except psycopg2.Error as e:
+        logging.error("Unable to query the database: {0}.".format(e))
+        return
+    finally:
+        if rows is None:
+            release(conn, close=True)
+
+    return rows
+
+
+def run_summary_query(countries, *date_range, **query):
+    """Count the measurements and anomalous measurements in the database.
+
+    This runs the same query as `run_query' but only returns the counts, which
+    are computed by the database, so that the measurements themselves are not
+    transferred.
+
+    :param countries: list of two-letter country codes to run query against
+    :param date_range: tuple of date: since, until (ISO format)
+    :param query: dict with db information: name, user, domains (and the
+                  `cache' section, see `input_numbers')
+    :return summary: dict of country mapped to a dict with `len_all' and
+                     `len_blocking'
+    """
+    connection = connect(**query)
+    if connection is None:
+        return
+    conn, domains = connection
+
+    broken = True
+    try:
+        inputs = input_numbers(conn, domains, **query)
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        execute_prepared(conn, cur, "cescout_summary", DB_SUMMARY_QUERY,
+                         (inputs, countries, *date_range))
+        logging.debug("Query: {0}".format(cur.query))
+        rows = cur.fetchall()
+        cur.close()
+        broken = False
+    except psycopg2.Error as e:
+        logging.error("Unable to query the database: {0}.".format(e))
+        return
+    finally:
+        release(conn, close=broken)
+
+    summary = {}
+    metrics.DB_ROWS.inc(len(rows), query="cescout_summary")
+    for row in rows:
+        summary[row["probe_cc"]] = {"len_all": row["len_all"],
+                                    "len_blocking": row["len_blocking"]}
+
+    return summary
+
+
+def sync_ranges(coverage, since, until):
+    """Return the ranges of measurements to fetch for a time period.
+
+    The parts of the time period that are covered are fetched above their
+    watermark (less MEASUREMENT_OVERLAP), and the other parts in full.
+
+    :param coverage: time periods covered (see
+                     `store.MeasurementStore.coverage')
+    :param since: start of the time period
+    :param until: end of the time period
+    :return list: tuples of (since, until, above `msm_no')
+    """
+    ranges = []
+    start = since
+    for first, last, covered in coverage:
+        if last < since or first > until:
             continue
+        if start < first:
+            ranges.append((start, first, 0))
+        ranges.append((max(first, since), min(last, until),
+                       max(0, covered - MEASUREMENT_OVERLAP)))
+        start = max(start, last)
+    if start < until or not ranges:
+        ranges.append((start, until, 0))
+    return ranges
 
-        # Ignore false-positive measurements resulting from a bug in an
-        # earlier version of OONI Probe.
-        # See https://github.com/ooni/probe-legacy/issues/38
-        if data["http_failure"] is not None:
-            if "unknown_failure" in data["http_failure"]:
-                logging.debug("Skipped test {0}: "
-                              "HTTP error".format(data["report_id"]))
-                continue
 
-        query.append(data)
+def sync_store(measurement_store, countries, since, until, **query):
+    """Fetch the measurements that are missing from the local store.
 
-    len_all_measurements = len(query)
-    # Length of all anomalous measurements. We consider a measurement as
-    # anomalous when the blocking is *not* "false", indicated by a blocking
-    # type like "dns" or "tcp_ip".
-    len_anomalous_measurements = len([each["blocking"] for each in query
-                                      if not each["blocking"] == "false"])
+    For each country, the store records the time periods it covers and the
+    highest `msm_no' fetched for each of them (the watermark). Only the
+    measurements of the time period that are missing are fetched (see
+    `sync_ranges') and countries that were synced to the same point are
+    fetched with one query. Measurements older than `retention' days (in the
+    `ooni' section of `cescout.cfg') are pruned first, apart from those of the
+    time period.
 
-    all_measurements = collections.defaultdict(list)
-    all_measurements["len_all"] = len_all_measurements
-    all_measurements["len_blocking"] = len_anomalous_measurements
-    for each in query:
-        all_measurements["measurements"].append({"url": each['report_link'],
-                                                "blocking": each['blocking']})
+    :param measurement_store: store.MeasurementStore object
+    :param countries: list of two-letter country codes to sync
+    :param since: start of the time period
+    :param until: end of the time period
+    :param query: dict with db information: name, user, domains, itersize
+    :return bool: True if the store was synced, False if we were unable to
+                  query the database
+    """
+    connection = connect(**query)
+    if connection is None:
+        return False
+    conn, domains = connection
+    itersize = query["ooni"].get("itersize", ITERSIZE)
+    retention = query["ooni"].get("retention", store.RETENTION_DAYS)
+
+    broken = True
+    try:
+        measurement_store.check_domains(domains)
+        measurement_store.prune(min(since, common.date_today() -
+                                    datetime.timedelta(days=retention)))
+        groups = collections.defaultdict(list)
+        for country in countries:
+            ranges = sync_ranges(measurement_store.coverage(country), since,
+                                 until)
+            groups[tuple(ranges)].append(country)
+
+        inputs = input_numbers(conn, domains, **query)
+        cur = conn.cursor()
+        execute_prepared(conn, cur, "cescout_max_measurement",
+                         DB_MAX_MEASUREMENT)
+        watermark = cur.fetchone()[0] or 0
+        cur.close()
+
+        for ranges, group in groups.items():
+            for first, last, above in ranges:
+                if above >= watermark:
+                    continue
+                cur = conn.cursor(
+                    name="cescout_sync",
+                    cursor_factory=psycopg2.extras.RealDictCursor)
+                cur.itersize = itersize
+                with metrics.timed(metrics.DB_DURATION, metrics.DB_QUERIES,
+                                   query="cescout_sync"):
+                    cur.execute(DB_SYNC_QUERY, (inputs, group, first, last,
+                                                above, watermark))
+                    count = measurement_store.add(cur)
+                cur.close()
+                metrics.DB_ROWS.inc(count, query="cescout_sync")
+                logging.debug("Added {0} measurements for {1} to the"
+                              " store".format(count, ", ".join(group)))
+            measurement_store.set_coverage(group, since, until, watermark)
+        broken = False
+    except psycopg2.Error as e:
+        logging.error("Unable to sync the store: {0}.".format(e))
+        return False
+    finally:
+        release(conn, close=broken)
+
+    return True
+
+
+def open_synced_store(countries, since, until, **config):
+    """Open the local store, if configured, and sync it for countries.
+
+    :param countries: list of two-letter country codes
+    :param since: start of the time period
+    :param until: end of the time period
+    :param config: config settings (see `run')
+    :return tuple: (measurement_store, synced): store.MeasurementStore object,
+                   or None if the store is not configured (`store' in the
+                   `ooni' section of `cescout.cfg'), and False if the store
+                   could not be synced
+    """
+    measurement_store = store.open_store(**config)
+    if measurement_store is None:
+        return None, True
+    synced = sync_store(measurement_store, countries, since, until, **config)
+    if not synced:
+        logging.warning("Unable to sync the store; results may be incomplete")
+    return measurement_store, synced
+
+
+def fetch_results(measurement_store, countries, *date_range, **config):
+    """Return the measurements of countries from the store or the database.
+
+    :param measurement_store: store returned by `open_synced_store'; if None,
+                              the database is queried (see `run_query')
+    :param countries: list of two-letter country codes
+    :param date_range: tuple of date (since, until)
+    :param config: config settings (see `run')
+    :return result: iterable of rows, or None if there are no results
+    """
+    if measurement_store is None:
+        return run_query(countries, *date_range, **config)
+    return measurement_store.rows(countries, *date_range)
+
+
+def fetch_summary(measurement_store, countries, *date_range, **config):
+    """Return the counts of measurements from the store or the database.
+
+    :param measurement_store: store returned by `open_synced_store'; if None,
+                              the database is queried (see
+                              `run_summary_query')
+    :param countries: list of two-letter country codes
+    :param date_range: tuple of date (since, until)
+    :param config: config settings (see `run')
+    :return summary: dict of country mapped to a dict with `len_all' and
+                     `len_blocking', or None if there are no results
+    """
+    if measurement_store is None:
+        return run_summary_query(countries, *date_range, **config)
+    return measurement_store.summary(countries, *date_range)
+
+
+def breakdown_bucket(**config):
+    """Return the size of the time buckets of the breakdowns.
+
+    :param config: config settings (`breakdown' in the `ooni' section)
+    :return bucket: size of the time buckets (see BUCKETS), or None if
+                    breakdowns are not enabled or the size is invalid
+    """
+    bucket = (config.get("ooni") or {}).get("breakdown")
+    if not bucket:
+        return
+    if bucket not in BUCKETS:
+        logging.error("Invalid breakdown `{0}'; must be one of: {1}".format(
+            bucket, ", ".join(BUCKETS)))
+        return
+    return bucket
+
+
+def fetch_breakdowns(measurement_store, countries, *date_range, **config):
+    """Return the breakdowns of measurements from the store or the database.
 
+    :param measurement_store: store returned by `open_synced_store'; if None,
+                              the database is queried (see
+                              `run_breakdown_query')
+    :param countries: list of two-letter country codes
+    :param date_range: tuple of date (since, until)
+    :param config: config settings (see `run')
+    :return all_breakdowns: dict of country mapped to its breakdown (see
+                            `breakdowns'), or None if breakdowns are not
+                            enabled or there are no results
+    """
+    bucket = breakdown_bucket(**config)
+    if bucket is None:
+        return
+
+    if measurement_store is None:
+        rows = run_breakdown_query(countries, bucket, *date_range, **config)
+    else:
+        rows = measurement_store.breakdown(countries, *date_range, bucket)
+    if rows is None:
+        return
+    return breakdowns(rows, countries, config["ooni"]["domains"], bucket)
+
+
+def run_breakdown_query(countries, bucket, *date_range, **query):
+    """Count the measurements in the database by time, ASN, input and blocking.
+
+    :param countries: list of two-letter country codes to run query against
+    :param bucket: size of the time buckets (see BUCKETS)
+    :param date_range: tuple of date: since, until (ISO format)
+    :param query: dict with db information: name, user, domains
+    :return list: tuples of (dimension, country, key, len_all, len_blocking),
+                  one per group (see `store.MeasurementStore.breakdown'), or
+                  None if we were unable to query the database
+    """
+    connection = connect(**query)
+    if connection is None:
+        return
+    conn, domains = connection
+
+    broken = True
+    try:
+        inputs = input_numbers(conn, domains, **query)
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        execute_prepared(conn, cur, "cescout_breakdown", DB_BREAKDOWN_QUERY,
+                         (bucket, inputs, countries, *date_range))
+        groups = cur.fetchall()
+        cur.close()
+        broken = False
+    except psycopg2.Error as e:
+        logging.error("Unable to query the database: {0}.".format(e))
+        return
+    finally:
+        release(conn, close=broken)
+
+    rows = []
+    metrics.DB_ROWS.inc(len(groups), query="cescout_breakdown")
+    for row in groups:
+        dimension, column = DB_GROUPINGS[row["grouping"]]
+        key = row[column]
+        if dimension == "time":
+            key = str(key)
+        rows.append((dimension, row["probe_cc"], key, row["len_all"],
+                     row["len_blocking"]))
+
+    return rows
+
+
+def input_domain(url, domains):
+    """Return the first of the domains that :param url: contains.
+
+    :param url: input (URL) of a measurement
+    :param domains: list of domains
+    :return domain: matching domain, or :param url: if none match
+    """
+    for domain in domains:
+        if domain in url:
+            return domain
+    return url
+
+
+def breakdowns(rows, countries, domains, bucket):
+    """Build the breakdowns of the measurements of each country.
+
+    The counts by input are added up by domain. Time buckets are sorted by
+    time and the other dimensions by the number of anomalous measurements.
+
+    :param rows: tuples of (dimension, country, key, len_all, len_blocking)
+                 (see `run_breakdown_query')
+    :param countries: list of two-letter country codes
+    :param domains: list of domains the measurements were fetched for
+    :param bucket: size of the time buckets (see BUCKETS)
+    :return all_breakdowns: dict of country mapped to a dict with the `bucket'
+                            size and a list of counts for each dimension
+                            (`time', `asn', `domain' and `blocking'), with the
+                            `key', `len_all' and `len_blocking' of each group
+    """
+    counts = {country: collections.defaultdict(dict) for country in countries}
+    for dimension, country, key, len_all, len_blocking in rows:
+        if country not in counts:
+            continue
+        if dimension == "input":
+            dimension, key = "domain", input_domain(key, domains)
+        elif dimension == "time":
+            key = key[:BUCKETS[bucket]]
+        group = counts[country][dimension].setdefault(
+            key, {"key": key, "len_all": 0, "len_blocking": 0})
+        group["len_all"] += len_all
+        group["len_blocking"] += len_blocking
+
+    all_breakdowns = {}
+    for country in countries:
+        breakdown = {"bucket": bucket}
+        for dimension in ("time", "asn", "domain", "blocking"):
+            groups = list(counts[country][dimension].values())
+            if dimension == "time":
+                groups.sort(key=lambda group: group["key"])
+            else:
+                groups.sort(key=lambda group: (-group["len_blocking"],
+                                               -group["len_all"]))
+            breakdown[dimension] = groups
+        all_breakdowns[country] = breakdown
+    return all_breakdowns
+
+
+def report_link(measurement, quoted):
+    """Return the OONI Explorer link to a measurement.
+
+    :param measurement: Measurement record
+    :param quoted: dict of input mapped to its encoded form, used as a cache
+                   since the same inputs are measured over and over
+    :return link: URL of the measurement on OONI Explorer
+    """
+    url = quoted.get(measurement.input)
+    if url is None:
+        url = quoted[measurement.input] = urllib.parse.quote(measurement.input)
+    return EXPLORER_LINK.format(measurement.report_id, url)
+
+
+def new_measurements(records=(), len_blocking=0, quoted=None):
+    """Return the measurements of a country from its records.
+
+    The links to the measurements are only encoded here, for the records that
+    end up in the measurements, and not as the rows are read.
+
+    :param records=(): list of Measurement records
+    :param len_blocking=0: number of anomalous measurements in :param records:
+    :param quoted=None: cache of encoded inputs (see `report_link')
+    :return all_measurements: defaultdict with the number of measurements
+                              (`len_all'), of anomalous measurements
+                              (`len_blocking') and the `measurements'
+                              themselves, with their link (`url') and
+                              `blocking' type
+    """
+    all_measurements = collections.defaultdict(list)
+    all_measurements["len_all"] = len(records)
+    all_measurements["len_blocking"] = len_blocking
+    if records:
+        quoted = {} if quoted is None else quoted
+        all_measurements["measurements"] = [
+            {"url": report_link(each, quoted), "blocking": each.blocking}
+            for each in records]
     return all_measurements
 
 
+@profiling.phase("ooni.process_results")
+def process_results(result):
+    """Process the results of a database query and return measurement data.
+
+    Measurements that are not useful for us are already filtered out by the
+    query (see DB_FILTER). The rows are processed one at a time, as they are
+    returned by the database, and only the fields needed for the report are
+    kept (see Measurement).
+
+    The report lists every measurement with its link, so memory use still
+    grows with the number of rows: one Measurement record, and then one link,
+    per row. Only the counts are kept, in constant memory, if the links are
+    not needed (`links: false', see `run_summary_query').
+
+    :param result: iterable of rows returned by `run_query'
+    :return all_measurements: measurements (see `new_measurements')
+    """
+    records = []
+    len_blocking = 0
+    for row in result:
+        record = Measurement._make(ROW_FIELDS(row))
+        records.append(record)
+        # We consider a measurement as anomalous when the blocking is *not*
+        # "false", indicated by a blocking type like "dns" or "tcp_ip".
+        if record.blocking != "false":
+            len_blocking += 1
+    metrics.PROCESSED_ROWS.inc(len(records), project="ooni")
+    return new_measurements(records, len_blocking)
+
+
+@profiling.phase("ooni.process_batch_results")
+def process_batch_results(result, countries):
+    """Process the results of a database query for a list of countries.
+
+    As in `process_results', the Measurement records and links of all the
+    rows of the countries are kept for the report.
+
+    :param result: iterable of rows returned by `run_query'
+    :param countries: list of two-letter country codes
+    :return dict: country mapped to its measurements (see `process_results')
+    """
+    records = {country: [] for country in countries}
+    len_blocking = dict.fromkeys(countries, 0)
+    for row in result:
+        country = row["probe_cc"]
+        kept = records.get(country)
+        if kept is None:
+            continue
+        record = Measurement._make(ROW_FIELDS(row))
+        kept.append(record)
+        if record.blocking != "false":
+            len_blocking[country] += 1
+    metrics.PROCESSED_ROWS.inc(sum(map(len, records.values())),
+                               project="ooni")
+
+    quoted = {}
+    return {country: new_measurements(records[country],
+                                      len_blocking[country], quoted)
+            for country in countries}
+
+
 def run(country, asns, *date_range, **config):
     """Entry point for the OONI module.
 
@@ -146,18 +905,147 @@ def run(country, asns, *date_range, **config):
     :param asns: list of ASNs to query for (checked against :param country:)
                  not used for OONI measurements
     :param date_range: tuple of date (since, until)
-    :param config: config settings: db information, domains to scan
+    :param config: config settings: db information, domains to scan, number
+                   of rows fetched at a time (`itersize'), whether the report
+                   needs the `links' to the measurements, the path to the
+                   local `store' (see `open_synced_store') and the size of the
+                   time buckets of the `breakdown' (see `fetch_breakdowns')
     :return measurements: defaultdict of measurements for :param country:
-                          and domains specified by :param config:
+                          and domains specified by :param config: (only the
+                          counts if `links' is false)
+    """
+    all_measurements = run_batch([country], asns, *date_range, **config)
+    if all_measurements is None:
+        return
+    return all_measurements[country]
+
+
+def run_batch(countries, asns, *date_range, **config):
+    """Entry point for the OONI module for a list of countries.
+
+    The measurements are fetched from `metadb' (see `run_metadb') or OONI's
+    API (see `run_api'), as set by the `backend' in the `ooni' section of
+    `cescout.cfg'; with `fallback', the API is used if `metadb' is unavailable.
+
+    :param countries: list of two-letter country codes to run query against
+    :param asns: not used for OONI measurements
+    :param date_range: tuple of date (since, until)
+    :param config: config settings (see `run')
+    :return all_measurements: dict of country mapped to its measurements (see
+                              `run')
     """
-    # Run the database query.
-    result = run_query(country, *date_range, **config)
-    # It's possible that no results were returned from the query in case there
-    # are no measurements from a country for the period specified.
-    if result is None:
+    ooni_config = config.get("ooni") or {}
+    backend = ooni_config.get("backend", "metadb")
+    if backend == "api":
+        all_measurements = run_api(countries, *date_range, **config)
+    elif backend == "metadb":
+        all_measurements = run_metadb(countries, *date_range, **config)
+        if all_measurements is None and ooni_config.get("fallback"):
+            logging.warning("Unable to query `metadb'; falling back to"
+                            " OONI's API")
+            backend = "api"
+            all_measurements = run_api(countries, *date_range, **config)
+    else:
+        logging.error("Invalid backend `{0}'; must be one of: metadb,"
+                      " api".format(backend))
+        return
+
+    # It's possible that no results were returned from the query in case
+    # there are no measurements for the period specified.
+    if all_measurements is None:
         logging.warning("No results from OONI's query")
         return
+    # The API only matches the configured domains exactly (see `ooni_api'),
+    # so the report shows which backend the measurements came from.
+    for measurements in all_measurements.values():
+        measurements["backend"] = backend
+    return all_measurements
+
+
+def run_metadb(countries, *date_range, **config):
+    """Fetch the measurements of countries from `metadb'.
+
+    A single query is run for all the countries and the results are then
+    grouped by country (`probe_cc') as they are processed. If the local store
+    could not be synced and `fallback' is set, nothing is returned so that
+    OONI's API is used instead of the incomplete store (see `run_batch').
+
+    :param countries: list of two-letter country codes to run query against
+    :param date_range: tuple of date (since, until)
+    :param config: config settings (see `run')
+    :return all_measurements: dict of country mapped to its measurements (see
+                              `run'), or None if there are no results
+    """
+    measurement_store, synced = open_synced_store(countries, *date_range,
+                                                  **config)
+    if not synced and (config.get("ooni") or {}).get("fallback"):
+        measurement_store.close()
+        return
+    try:
+        # If the report does not need the links to the measurements, only
+        # fetch the counts.
+        if not (config.get("ooni") or {}).get("links", True):
+            summary = fetch_summary(measurement_store, countries,
+                                    *date_range, **config)
+            if summary is None:
+                return
+            all_measurements = {
+                country: summary.get(country, {"len_all": 0,
+                                               "len_blocking": 0})
+                for country in countries}
+        else:
+            # Run the database query (or read the local store).
+            result = fetch_results(measurement_store, countries, *date_range,
+                                   **config)
+            if result is None:
+                return
+            # Process the results to get the measurement data we care about.
+            all_measurements = process_batch_results(result, countries)
+
+        all_breakdowns = fetch_breakdowns(measurement_store, countries,
+                                          *date_range, **config)
+        if all_breakdowns is not None:
+            for country in countries:
+                all_measurements[country]["breakdown"] = \
+                    all_breakdowns[country]
+    finally:
+        if measurement_store is not None:
+            measurement_store.close()
+
+    return all_measurements
+
+
+def run_api(countries, *date_range, **config):
+    """Fetch the measurements of countries from OONI's API.
+
+    :param countries: list of two-letter country codes to run query against
+    :param date_range: tuple of date (since, until)
+    :param config: config settings (see `run' and `ooni_api')
+    :return all_measurements: dict of country mapped to its measurements (see
+                              `run'), or None if there are no results
+    """
+    rows = ooni_api.fetch_measurements(countries, *date_range, **config)
+    if rows is None:
+        return
 
-    # Process the results to get the measurement data we care about.
-    measurements = process_results(result)
-    return measurements
+    if not config["ooni"].get("links", True):
+        all_measurements = {country: {"len_all": 0, "len_blocking": 0}
+                            for country in countries}
+        for row in rows:
+            counts = all_measurements.get(row["probe_cc"])
+            if counts is not None:
+                counts["len_all"] += 1
+                if row["blocking"] != "false":
+                    counts["len_blocking"] += 1
+    else:
+        all_measurements = process_batch_results(rows, countries)
+
+    bucket = breakdown_bucket(**config)
+    if bucket is not None:
+        all_breakdowns = breakdowns(
+            ooni_api.breakdown_rows(rows, BUCKETS[bucket]), countries,
+            config["ooni"]["domains"], bucket)
+        for country in countries:
+            all_measurements[country]["breakdown"] = all_breakdowns[country]
+
+    return all_measurements
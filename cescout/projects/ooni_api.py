@@ -0,0 +1,203 @@
+"""Fetch OONI measurements from OONI's measurements API.
+
+This is the alternative to querying (a local copy of) OONI's `metadb' (see
+`ooni'), used if the `backend' in the `ooni' section of `cescout.cfg' is `api'
+or, with `fallback', if `metadb' is unavailable.
+
+The API returns the measurements a page (`limit' measurements) at a time. The
+time period is split in slices and each country, domain and time slice is
+fetched by a worker of a bounded pool, which follows the pages in order. The
+measurements are then converted to the rows returned by the database query so
+that they are processed in the same way.
+
+Note that the API matches the domain of a measurement exactly: subdomains (such
+as `zh.wikipedia.org') are only fetched if they are listed in the `domains' of
+the `ooni' section of `cescout.cfg'.
+"""
+
+import collections
+import concurrent.futures
+import logging
+from datetime import datetime, timedelta
+
+import requests
+
+from .. import client
+from .. import profiling
+
+API_URL = "https://api.ooni.io/api/v1/measurements"
+# Maximum number of concurrent requests made to the API; can be set with
+# `workers' in the `api' subsection of the `ooni' section of `cescout.cfg'.
+MAX_WORKERS = 4
+# Number of measurements per page (`limit') and length of the time slices in
+# hours (`slice').
+PAGE_SIZE = 1000
+SLICE_HOURS = 24
+API_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# All requests to the API share this client so that connections are kept alive
+# and reused across requests (and threads).
+CLIENT = client.Client("ooni", pool_maxsize=MAX_WORKERS)
+
+
+def time_slices(since, until, hours=SLICE_HOURS):
+    """Split a time period in slices.
+
+    :param since: start of the time period
+    :param until: end of the time period
+    :param hours=SLICE_HOURS: length of the slices in hours
+    :return list: tuples of (start, end), the last one possibly shorter
+    """
+    length = timedelta(hours=hours)
+    slices = []
+    start = since
+    while start < until:
+        end = min(start + length, until)
+        slices.append((start, end))
+        start = end
+    return slices or [(since, until)]
+
+
+def normalize(result):
+    """Convert a measurement returned by the API to a database row.
+
+    The API does not return the blocking type of a measurement as such: it is
+    read from the analysis in its `scores' if the measurement is an anomaly.
+
+    :param result: measurement (dict) from the `results' of the API response
+    :return row: dict with the columns of the database query (see
+                 `ooni.DB_COLUMNS'), or None if the measurement has no ASN
+    """
+    asn = str(result.get("probe_asn") or "0")
+    asn = int(asn[2:] if asn.upper().startswith("AS") else asn)
+    if asn == 0:
+        return None
+
+    if result.get("anomaly") or result.get("confirmed"):
+        analysis = (result.get("scores") or {}).get("analysis") or {}
+        blocking = analysis.get("blocking_type") or "anomaly"
+    else:
+        blocking = "false"
+
+    start_time = result["measurement_start_time"].rstrip("Z")
+    return {"measurement_start_time": datetime.fromisoformat(start_time),
+            "report_id": result["report_id"],
+            "probe_asn": asn,
+            "probe_cc": result["probe_cc"],
+            "probe_ip": None,
+            "test_name": result.get("test_name", "web_connectivity"),
+            "input": result["input"],
+            "blocking": blocking,
+            "http_experiment_failure": None}
+
+
+@profiling.phase("ooni_api.fetch_slice")
+def fetch_slice(api_url, country, domain, since, until, limit=PAGE_SIZE):
+    """Fetch the measurements of a domain in a country for a time slice.
+
+    :param api_url: URL of the measurements API
+    :param country: two-letter country code
+    :param domain: domain of the measurements
+    :param since: start of the time slice
+    :param until: end of the time slice
+    :param limit=PAGE_SIZE: number of measurements per page
+    :return rows: list of rows (see `normalize')
+    """
+    params = {"probe_cc": country,
+              "domain": domain,
+              "test_name": "web_connectivity",
+              "since": since.strftime(API_TIME_FORMAT),
+              "until": until.strftime(API_TIME_FORMAT),
+              "limit": limit,
+              "order_by": "measurement_start_time",
+              "order": "asc"}
+    rows = []
+    url = api_url
+    while url:
+        logging.debug("Requested URL is {0} ({1})".format(url, params))
+        req = CLIENT.get(url, params=params)
+        req.raise_for_status()
+        response = req.json()
+        for result in response.get("results", []):
+            row = normalize(result)
+            if row is not None:
+                rows.append(row)
+        # The URL of the next page has all the parameters.
+        url = (response.get("metadata") or {}).get("next_url")
+        params = None
+    return rows
+
+
+def fetch_measurements(countries, since, until, **config):
+    """Fetch the measurements of countries from the API.
+
+    :param countries: list of two-letter country codes
+    :param since: start of the time period
+    :param until: end of the time period
+    :param config: config settings; the domains are read from the `ooni'
+                   section, the API settings (`url', `workers', `limit'
+                   and `slice') from its `api' subsection and the timeouts
+                   and retries of the requests from the `http' section
+    :return rows: list of rows in the same format as `ooni.run_query', or None
+                  if the config settings are missing or a request failed
+    """
+    try:
+        domains = config["ooni"]["domains"]
+    except KeyError:
+        logging.error("Unable to read config settings for OONI's test."
+                      " See `cescout.cfg` for an example.")
+        return
+    CLIENT.configure(**config)
+    api_config = config["ooni"].get("api") or {}
+    api_url = api_config.get("url", API_URL)
+    workers = min(api_config.get("workers", MAX_WORKERS), MAX_WORKERS)
+    limit = api_config.get("limit", PAGE_SIZE)
+    slices = time_slices(since, until, api_config.get("slice", SLICE_HOURS))
+
+    tasks = [(country, domain, start, end)
+             for country in countries
+             for domain in domains
+             for start, end in slices]
+    logging.debug("Fetching {0} slices from {1} with {2} workers".format(
+        len(tasks), api_url, workers))
+    rows = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch_slice, api_url, *task, limit)
+                   for task in tasks]
+        try:
+            for future in futures:
+                rows.extend(future.result())
+        except (requests.exceptions.RequestException, ValueError,
+                KeyError) as e:
+            logging.error("Unable to fetch measurements from OONI's API:"
+                          " {0}".format(e))
+            for future in futures:
+                future.cancel()
+            return
+    return rows
+
+
+def breakdown_rows(rows, bucket_length):
+    """Count rows by time bucket, ASN, input and blocking type.
+
+    This is the counterpart of `ooni.run_breakdown_query' for the rows fetched
+    from the API.
+
+    :param rows: list of rows (see `fetch_measurements')
+    :param bucket_length: length of the time bucket keys (see `ooni.BUCKETS')
+    :return list: tuples of (dimension, country, key, len_all, len_blocking)
+    """
+    counts = collections.Counter()
+    for row in rows:
+        blocking = row["blocking"] != "false"
+        country = row["probe_cc"]
+        time = str(row["measurement_start_time"])[:bucket_length]
+        for key in (("time", country, time),
+                    ("asn", country, row["probe_asn"]),
+                    ("input", country, row["input"]),
+                    ("blocking", country, row["blocking"])):
+            counts[key, False] += 1
+            if blocking:
+                counts[key, True] += 1
+    return [(*key, count, counts[key, True])
+            for (key, anomalous), count in counts.items() if not anomalous]
@@ -5,24 +5,74 @@ fetch BGP routing information for a given ASN, specifically the current and
 historic number of announced IPv4 prefixes. This information may be used to
 determine if there was an instance of internet shutdown or outage in the
 country, indicated by a significant change in the number of these prefixes.
+If no ASNs are given, all the ASNs in the country can be checked instead and
+the ones with the largest change are returned.
+
+Optionally, the announced IPv4 prefixes themselves are fetched at the start and
+end of the time period and compared, to tell which prefixes were withdrawn (or
+added) and how much address space they cover, and the number of visible
+prefixes is fetched over the whole time period, to find drops that start and
+end within it.
 
 Note that CAIDA's IODA project already takes into account BGP routing data for
 detecting internet outages (and their data is more exhaustive) but their API
 does not present this information.
 """
 
+import array
+import concurrent.futures
 import logging
+import socket
+from datetime import datetime, timedelta, timezone
 
 import requests
 
+from .. import cache
+from .. import client
+from .. import common
+from .. import profiling
+
 RIPE_COUNTRY_INFO = ("https://stat.ripe.net/data/"
                      "country-resource-list/data.json?resource={}")
 RIPE_ROUTING_CURRENT = ("https://stat.ripe.net/data/"
                         "routing-status/data.json?resource={}")
 RIPE_ROUTING_HIST = ("https://stat.ripe.net/data/"
                      "routing-status/data.json?resource={0}&timestamp={1}")
+RIPE_PREFIXES = ("https://stat.ripe.net/data/announced-prefixes/data.json?"
+                 "resource={0}&starttime={1}&endtime={1}")
+RIPE_PREFIXES_HIST = ("https://stat.ripe.net/data/announced-prefixes/"
+                      "data.json?resource={0}&starttime={1}&endtime={2}")
+# Maximum number of concurrent requests made to RIPEstat; this is also the size
+# of the connection pool. Can be lowered with `workers' in the `ripe' section
+# of `cescout.cfg'.
+MAX_WORKERS = 8
+
+# Maximum number of requests per second made to RIPEstat, shared by all the
+# requests made by the process. Can be set with `rate' in the `ripe' section of
+# `cescout.cfg'.
+RATE = 10
+RATE_LIMIT = common.TokenBucket(RATE)
+# Number of ASNs returned when sweeping all the ASNs in a country (the ones
+# with the largest change in the number of announced prefixes).
+TOP_MOVERS = 10
+
+# Routing snapshots older than this never change and are cached forever; more
+# recent ones (and the current routing state) are cached for CURRENT_TTL
+# seconds only.
+SNAPSHOT_SETTLED = timedelta(days=1)
+CURRENT_TTL = 300
+# A drop in the number of visible prefixes is reported when it falls below this
+# fraction of the highest number seen before in the time period.
+DROP_THRESHOLD = 0.9
 
+# All requests to RIPEstat share this client so that connections are kept
+# alive and reused across requests (and threads); every attempt takes a token
+# from RATE_LIMIT.
+CLIENT = client.Client("ripe", pool_maxsize=MAX_WORKERS,
+                       rate_limit=RATE_LIMIT)
 
+
+@profiling.phase("ripe.fetch_data")
 def fetch_data(request_url):
     """Query RIPEstat's API and return the JSON response.
 
@@ -31,9 +81,9 @@ def fetch_data(request_url):
     """
     logging.debug("Requested URL is {0}".format(request_url))
     try:
-        req = requests.get(request_url)
+        req = CLIENT.get(request_url)
         req.raise_for_status()
-    except requests.exceptions.HTTPError as e:
+    except requests.exceptions.RequestException as e:
         logging.error(e)
         return {}
     response = req.json()["data"]
@@ -44,47 +94,450 @@ def fetch_country_data(country):
     """Query RIPEstat's API and fetch a list of ASNs in a country.
 
     :param country: two-letter country code to query the API for
-    :return country_asns: list of ASNs in the country (int)
+    :return country_asns: list of ASNs in the country (int), or None if the
+                          request failed
     """
     url = RIPE_COUNTRY_INFO.format(country)
-    country_asns = [int(asn) for asn in fetch_data(url)["resources"]["asn"]]
+    data = fetch_data(url)
+    if not data:
+        return None
+    country_asns = [int(asn) for asn in data["resources"]["asn"]]
     return country_asns
 
 
-def fetch_asn_data(asn, time=None):
+def snapshot_ttl(time=None):
+    """Return how long the routing state of an ASN at :param time: is cached.
+
+    :param time=None: time of the routing state (current time if None)
+    :return ttl: time-to-live in seconds, or None if it never expires
+    """
+    if time is not None:
+        snapshot = datetime.fromisoformat(str(time))
+        if snapshot <= common.date_today() - SNAPSHOT_SETTLED:
+            return None
+    return CURRENT_TTL
+
+
+def fetch_asn_data(asn, time=None, routing_cache=None):
     """Query RIPEstat's API and fetch BGP routing state for a given ASN.
 
     :param asn: ASN to query the API for (current time)
     :param time=None: time in ISO format to run the query at (past time)
-    :return prefix: the number of IPv4 prefixes announced by the ASN
+    :param routing_cache=None: DiskCache to look up and store the result in
+    :return prefix: the number of IPv4 prefixes announced by the ASN, or
+                    None if the request failed
     """
+    key = "routing-status:{0}:{1}".format(asn, "current" if time is None
+                                          else time)
+    if routing_cache is not None:
+        prefix = routing_cache.get(key)
+        if prefix is not None:
+            return prefix
+
     if time is not None:
         url = RIPE_ROUTING_HIST.format(asn, time)
     else:
         url = RIPE_ROUTING_CURRENT.format(asn)
     routing_data = fetch_data(url)
+    if not routing_data:
+        return None
     query_time = routing_data["query_time"]
     logging.debug("Per RIPE, query was run for {0}".format(query_time))
     prefix = routing_data["announced_space"]["v4"]["prefixes"]
+
+    if routing_cache is not None:
+        routing_cache.set(key, prefix, ttl=snapshot_ttl(time))
     return prefix
 
 
-def fetch_routing_data(country, asns, since, until):
+def prefix_range(prefix):
+    """Convert an IPv4 prefix to the range of addresses it covers.
+
+    :param prefix: IPv4 prefix in CIDR notation (such as "192.0.2.0/24")
+    :return tuple: (first address, last address + 1) as integers
+    """
+    address, _, length = prefix.partition("/")
+    length = int(length) if length else 32
+    size = 1 << (32 - length)
+    start = int.from_bytes(socket.inet_aton(address), "big") & -size
+    return start, start + size
+
+
+def range_prefix(start, end):
+    """Convert a range of addresses (see `prefix_range') to an IPv4 prefix.
+
+    :param start: first address of the range (integer)
+    :param end: last address of the range + 1 (integer)
+    :return prefix: IPv4 prefix in CIDR notation
+    """
+    length = 32 - (end - start).bit_length() + 1
+    return "{0}/{1}".format(socket.inet_ntoa(start.to_bytes(4, "big")),
+                            length)
+
+
+def prefix_ranges(prefixes):
+    """Convert a list of IPv4 prefixes to sorted integer ranges.
+
+    The ranges are stored in a flat array of (start, end) pairs, sorted and
+    without duplicates, which is much smaller than a list of `ipaddress'
+    objects and can be compared in linear time (see `diff_ranges'). IPv6
+    prefixes are ignored.
+
+    :param prefixes: iterable of prefixes in CIDR notation
+    :return ranges: array of integers [start, end, start, end, ...]
+    """
+    pairs = sorted({prefix_range(each) for each in prefixes
+                    if ":" not in each})
+    ranges = array.array("Q")
+    for start, end in pairs:
+        ranges.append(start)
+        ranges.append(end)
+    return ranges
+
+
+def diff_ranges(old, new):
+    """Compare two sets of ranges (see `prefix_ranges') in a single pass.
+
+    :param old: ranges at the start of the time period
+    :param new: ranges at the end of the time period
+    :return tuple: (ranges only in :param old:, ranges only in :param new:)
+    """
+    removed, added = array.array("Q"), array.array("Q")
+    i = j = 0
+    while i < len(old) and j < len(new):
+        a, b = (old[i], old[i + 1]), (new[j], new[j + 1])
+        if a == b:
+            i += 2
+            j += 2
+        elif a < b:
+            removed.extend(a)
+            i += 2
+        else:
+            added.extend(b)
+            j += 2
+    removed.extend(old[i:])
+    added.extend(new[j:])
+    return removed, added
+
+
+def address_space(ranges):
+    """Return the number of addresses covered by the ranges.
+
+    Prefixes can overlap (a more-specific prefix is usually announced along
+    with its covering prefix), so addresses are only counted once.
+
+    :param ranges: ranges as returned by `prefix_ranges' (sorted)
+    :return total: number of addresses
+    """
+    total = 0
+    covered = 0
+    for i in range(0, len(ranges), 2):
+        start, end = max(ranges[i], covered), ranges[i + 1]
+        if end > start:
+            total += end - start
+            covered = end
+    return total
+
+
+def format_ranges(ranges):
+    """Convert ranges (see `prefix_ranges') back to a list of prefixes.
+
+    :param ranges: array of integers [start, end, start, end, ...]
+    :return list: list of prefixes in CIDR notation
+    """
+    return [range_prefix(ranges[i], ranges[i + 1])
+            for i in range(0, len(ranges), 2)]
+
+
+def fetch_prefixes(asn, time, routing_cache=None):
+    """Query RIPEstat's API and fetch the IPv4 prefixes announced by an ASN.
+
+    :param asn: ASN to query the API for
+    :param time: time in ISO format to run the query at
+    :param routing_cache=None: DiskCache to look up and store the result in
+    :return ranges: prefixes announced at :param time: (see `prefix_ranges'),
+                    or None if the request failed
+    """
+    key = "announced-prefixes:{0}:{1}".format(asn, time)
+    if routing_cache is not None:
+        ranges = routing_cache.get(key)
+        if ranges is not None:
+            return array.array("Q", ranges)
+
+    data = fetch_data(RIPE_PREFIXES.format(asn, time))
+    if not data:
+        return None
+    ranges = prefix_ranges(each["prefix"] for each in data["prefixes"])
+    logging.debug("ASN {0} announced {1} IPv4 prefixes at {2}".format(
+        asn, len(ranges) // 2, time))
+
+    if routing_cache is not None:
+        routing_cache.set(key, ranges.tolist(), ttl=snapshot_ttl(time))
+    return ranges
+
+
+def prefix_changes(since_ranges, until_ranges):
+    """Summarize the changes in the prefixes announced by an ASN.
+
+    :param since_ranges: prefixes announced at the start of the time period
+    :param until_ranges: prefixes announced at the end of the time period
+    :return dict: withdrawn and added prefixes, and the address space
+                  announced at the start (`since') and end (`until')
+    """
+    withdrawn, added = diff_ranges(since_ranges, until_ranges)
+    return {"withdrawn": format_ranges(withdrawn),
+            "added": format_ranges(added),
+            "space_since": address_space(since_ranges),
+            "space_until": address_space(until_ranges)}
+
+
+def epoch(time):
+    """Return the epoch in seconds for a time in ISO format (UTC).
+
+    :param time: time in ISO format (string or datetime object)
+    :return int: seconds since the epoch
+    """
+    date = datetime.fromisoformat(str(time)).replace(tzinfo=timezone.utc)
+    return int(date.timestamp())
+
+
+def visibility_series(prefixes, since, until):
+    """Build the number of visible prefixes over time from their timelines.
+
+    Each prefix returned by RIPEstat's announced-prefixes has the timelines
+    during which it was visible. Every start and end of a timeline is a step
+    in the number of visible prefixes: the starts and ends are sorted and
+    walked together once to build the series.
+
+    :param prefixes: list of prefixes (dicts with `prefix' and `timelines')
+    :param since: start of the time period (ISO format)
+    :param until: end of the time period (ISO format)
+    :return tuple: (times, counts): arrays with the time (epoch) of each step,
+                   starting at :param since:, and the number of prefixes
+                   visible from then on
+    """
+    start, end = epoch(since), epoch(until)
+    starts, ends = array.array("q"), array.array("q")
+    for each in prefixes:
+        if ":" in each["prefix"]:
+            continue
+        for timeline in each["timelines"]:
+            starts.append(max(epoch(timeline["starttime"]), start))
+            # Prefixes still visible at the end of the time period are not
+            # withdrawn, even if their timeline stops there.
+            stop = epoch(timeline["endtime"])
+            if stop < end:
+                ends.append(stop)
+    starts = array.array("q", sorted(starts))
+    ends = array.array("q", sorted(ends))
+
+    times, counts = array.array("q", [start]), array.array("l", [0])
+    count = i = j = 0
+    while i < len(starts) or j < len(ends):
+        if j == len(ends) or (i < len(starts) and starts[i] <= ends[j]):
+            time = starts[i]
+            count += 1
+            i += 1
+        else:
+            time = ends[j]
+            count -= 1
+            j += 1
+        if times[-1] == time:
+            counts[-1] = count
+        else:
+            times.append(time)
+            counts.append(count)
+    return times, counts
+
+
+def detect_drops(times, counts, threshold=DROP_THRESHOLD):
+    """Find the drops in the number of visible prefixes.
+
+    A drop starts when the number of visible prefixes falls below
+    :param threshold: times the highest number seen before and ends when it
+    goes back above it.
+
+    :param times: array with the time (epoch) of each step (see
+                  `visibility_series')
+    :param counts: array with the number of prefixes visible at each step
+    :param threshold=DROP_THRESHOLD: fraction of the highest number of prefixes
+                                     under which there is a drop
+    :return drops: list of dicts with the `start' and `end' of the drop (`end'
+                   is None if it did not end in the time period), the number
+                   of prefixes before the drop (`from') and the lowest number
+                   during the drop (`to')
+    """
+    drops = []
+    current = None
+    peak = 0
+    for time, count in zip(times, counts):
+        if current is None:
+            if count < peak * threshold:
+                current = {"start": time, "end": None,
+                           "from": peak, "to": count}
+            else:
+                peak = max(peak, count)
+        elif count >= current["from"] * threshold:
+            current["end"] = time
+            drops.append(current)
+            current = None
+            peak = max(peak, count)
+        else:
+            current["to"] = min(current["to"], count)
+    if current is not None:
+        drops.append(current)
+    return drops
+
+
+def fetch_prefix_history(asn, since, until, routing_cache=None):
+    """Fetch the number of prefixes visible for an ASN over a time period.
+
+    This is a single request per ASN, independent of the length of the time
+    period.
+
+    :param asn: ASN to query the API for
+    :param since: start of the time period (ISO format)
+    :param until: end of the time period (ISO format)
+    :param routing_cache=None: DiskCache to look up and store the result in
+    :return tuple: (times, counts) arrays (see `visibility_series'), or None
+                   if the request failed
+    """
+    key = "prefix-history:{0}:{1}:{2}".format(asn, since, until)
+    if routing_cache is not None:
+        series = routing_cache.get(key)
+        if series is not None:
+            return array.array("q", series[0]), array.array("l", series[1])
+
+    data = fetch_data(RIPE_PREFIXES_HIST.format(asn, since, until))
+    if not data:
+        return None
+    times, counts = visibility_series(data["prefixes"], since, until)
+    logging.debug("ASN {0} prefix history has {1} steps".format(
+        asn, len(times)))
+
+    if routing_cache is not None:
+        routing_cache.set(key, [times.tolist(), counts.tolist()],
+                          ttl=snapshot_ttl(until))
+    return times, counts
+
+
+def prefix_history(times, counts):
+    """Summarize the number of visible prefixes over time.
+
+    :param times: array with the time (epoch) of each step
+    :param counts: array with the number of prefixes visible at each step
+    :return dict: the series (`times' and `prefixes') and the `drops' in it
+                  (see `detect_drops')
+    """
+    return {"times": times.tolist(),
+            "prefixes": counts.tolist(),
+            "drops": detect_drops(times, counts)}
+
+
+def fetch_prefix_changes(asn, since, until, routing_cache=None):
+    """Fetch and compare the prefixes announced by an ASN at two times.
+
+    :param asn: ASN to query the API for
+    :param since: start of the time period (ISO format)
+    :param until: end of the time period (ISO format)
+    :param routing_cache=None: DiskCache to look up and store the result in
+    :return dict: see `prefix_changes', or None if a request failed
+    """
+    since_ranges = fetch_prefixes(asn, since, routing_cache)
+    until_ranges = fetch_prefixes(asn, until, routing_cache)
+    if since_ranges is None or until_ranges is None:
+        return None
+    return prefix_changes(since_ranges, until_ranges)
+
+
+def fetch_history_summary(asn, since, until, routing_cache=None):
+    """Fetch and summarize the prefix history of an ASN.
+
+    :param asn: ASN to query the API for
+    :param since: start of the time period (ISO format)
+    :param until: end of the time period (ISO format)
+    :param routing_cache=None: DiskCache to look up and store the result in
+    :return dict: see `prefix_history', or None if the request failed
+    """
+    series = fetch_prefix_history(asn, since, until, routing_cache)
+    if series is None:
+        return None
+    return prefix_history(*series)
+
+
+def submit_details(executor, asns, since, until, routing_cache=None,
+                   prefixes=False, history=False):
+    """Submit the requests for the prefixes and prefix history of ASNs.
+
+    :param executor: concurrent.futures.Executor to submit the requests to
+    :param asns: list of ASNs to query for
+    :param since: start of the time period (ISO format)
+    :param until: end of the time period (ISO format)
+    :param routing_cache=None: DiskCache for the routing state of the ASNs
+    :param prefixes=False: compare the prefixes announced at :param since:
+                           and :param until: (see `prefix_changes')
+    :param history=False: fetch the number of visible prefixes over the time
+                          period (see `prefix_history')
+    :return details: dict of ASN mapped to a dict of `prefixes' and `history'
+                     (if enabled) mapped to a future with the data
+    """
+    details = {}
+    for asn in asns:
+        details[asn] = {}
+        if prefixes:
+            details[asn]["prefixes"] = executor.submit(
+                fetch_prefix_changes, asn, since, until, routing_cache)
+        if history:
+            details[asn]["history"] = executor.submit(
+                fetch_history_summary, asn, since, until, routing_cache)
+    return details
+
+
+def fetch_routing_data(country, asns, since, until, workers=MAX_WORKERS,
+                       routing_cache=None, prefixes=False, history=False):
     """Fetch current and historic BGP routing data for ASNs in a country.
 
+    The requests for all the ASNs and times are made concurrently, with at
+    most :param workers: requests at a time.
+
     :param country: two-letter country code
     :param asns: list of ASNs to query for (checked against :param country:)
     :param since: time in ISO format to run the query at (from)
     :param until: time in ISO format to run the query at (to)
-    :return asn_data: mapping of ASNs to their routing history
+    :param workers=MAX_WORKERS: maximum number of concurrent requests
+    :param routing_cache=None: DiskCache for the routing state of the ASNs
+    :param prefixes=False: also compare the prefixes announced at :param
+                           since: and :param until: (see `prefix_changes')
+    :param history=False: also fetch the number of visible prefixes over the
+                          time period (see `prefix_history')
+    :return asn_data: mapping of ASNs to their routing history (None where a
+                      request failed), or None if the ASNs of the country
+                      could not be fetched
     """
     country_asns = fetch_country_data(country)
-    asn_data = {}
+    if country_asns is None:
+        return None
+    valid_asns = []
     for asn in asns:
         if asn in country_asns:
-            current_routing = fetch_asn_data(asn)
-            past_routing_since = fetch_asn_data(asn, since)
-            past_routing_until = fetch_asn_data(asn, until)
+            valid_asns.append(asn)
+        else:
+            logging.warning("ASN {0} not in {1}".format(asn, country))
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(workers, MAX_WORKERS))) as executor:
+        # Three requests per ASN: current, since and until (in this order).
+        routing = {asn: [executor.submit(fetch_asn_data, asn, time,
+                                         routing_cache)
+                         for time in (None, since, until)]
+                   for asn in valid_asns}
+        details = submit_details(executor, valid_asns, since, until,
+                                 routing_cache, prefixes, history)
+
+        asn_data = {}
+        for asn in valid_asns:
+            current_routing, past_routing_since, past_routing_until = \
+                [future.result() for future in routing[asn]]
             asn_data[asn] = {"current": current_routing,
                              "since": past_routing_since,
                              "until": past_routing_until}
@@ -93,8 +546,88 @@ def fetch_routing_data(country, asns, since, until):
                           " {3} until".format(asn, current_routing,
                                               past_routing_since,
                                               past_routing_until))
-        else:
-            logging.warning("ASN {0} not in {1}".format(asn, country))
+            for key, future in details[asn].items():
+                asn_data[asn][key] = future.result()
+    return asn_data
+
+
+def sweep_routing_data(country, since, until, workers=MAX_WORKERS,
+                       routing_cache=None, prefixes=False, history=False,
+                       top=TOP_MOVERS):
+    """Fetch BGP routing data for all the ASNs in a country.
+
+    The routing state of every ASN in the country is fetched (currently, at
+    :param since: and at :param until:) and ASNs that announce no prefixes at
+    any of these times are skipped; an ASN that went dark during the time
+    period is kept. The remaining ASNs are ranked by the change in the number
+    of prefixes they announced between :param since: and :param until:, and
+    only the top :param top: ASNs (with a change) are returned. The prefixes
+    and prefix history, if enabled, are only fetched for these ASNs. ASNs
+    whose routing state could not be fetched are skipped (and logged), so
+    that a failed request does not end the sweep.
+
+    All requests are subject to the rate limit (RATE_LIMIT) and are made
+    concurrently, with at most :param workers: requests at a time.
+
+    :param country: two-letter country code
+    :param since: time in ISO format to run the query at (from)
+    :param until: time in ISO format to run the query at (to)
+    :param workers=MAX_WORKERS: maximum number of concurrent requests
+    :param routing_cache=None: DiskCache for the routing state of the ASNs
+    :param prefixes=False: see `fetch_routing_data'
+    :param history=False: see `fetch_routing_data'
+    :param top=TOP_MOVERS: maximum number of ASNs to return
+    :return asn_data: mapping of ASNs to their routing history, ordered by
+                      the change in the number of prefixes (largest first),
+                      or None if the ASNs of the country could not be fetched
+    """
+    country_asns = fetch_country_data(country)
+    if country_asns is None:
+        return None
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(workers, MAX_WORKERS))) as executor:
+        routing = {asn: [executor.submit(fetch_asn_data, asn, time,
+                                         routing_cache)
+                         for time in (None, since, until)]
+                   for asn in country_asns}
+
+        all_asn_data = {}
+        failed = []
+        for asn in country_asns:
+            current_routing, past_routing_since, past_routing_until = \
+                [future.result() for future in routing[asn]]
+            if None in (current_routing, past_routing_since,
+                        past_routing_until):
+                failed.append(asn)
+            elif current_routing or past_routing_since or past_routing_until:
+                all_asn_data[asn] = {"current": current_routing,
+                                     "since": past_routing_since,
+                                     "until": past_routing_until}
+        if failed:
+            logging.warning("Unable to fetch the routing state of {0} ASNs"
+                            " in {1}; skipping: {2}".format(
+                                len(failed), country,
+                                ", ".join(map(str, failed))))
+        logging.info("Sweeping {0} of {1} ASNs in {2} (with announced"
+                     " prefixes)".format(len(all_asn_data), len(country_asns),
+                                         country))
+
+        def change(asn):
+            return abs(all_asn_data[asn]["until"]
+                       - all_asn_data[asn]["since"])
+
+        movers = [asn for asn in sorted(all_asn_data, key=change,
+                                        reverse=True)
+                  if change(asn)][:top]
+        details = submit_details(executor, movers, since, until,
+                                 routing_cache, prefixes, history)
+
+        asn_data = {}
+        for asn in movers:
+            asn_data[asn] = all_asn_data[asn]
+            for key, future in details[asn].items():
+                asn_data[asn][key] = future.result()
     return asn_data
 
 
@@ -102,16 +635,49 @@ def run(country, asns, *date_range, **config):
     """Entry point for the RIPE module.
 
     :param country: two-letter country code to run query against
-    :param asns: list of ASNs to query for (checked against :param country:)
+    :param asns: list of ASNs to query for (checked against :param country:);
+                 if None, all the ASNs in the country are checked if `sweep'
+                 is set in the `ripe' section of :param config:
     :param date_range: tuple of date (since, until)
-    :param config: (optional) other configuration parameters
-                   not used for RIPE measurements
+    :param config: (optional) other configuration parameters: in the `ripe'
+                   section, `workers' and `rate' set the number of concurrent
+                   requests and requests per second, `prefixes' and `history'
+                   enable the comparison of the announced prefixes and the
+                   prefix history, and `sweep' and `top' the sweep of all the
+                   ASNs in the country; the `cache' section enables the
+                   routing cache and the `http' section sets the timeouts and
+                   retries of the requests (see `client')
     :return asn_data: dict of ASNs mapped to their routing history
     """
-    # If the ASNs were not specified, return early.
-    if asns is None:
+    ripe_config = config.get("ripe") or {}
+    # If the ASNs were not specified, return early unless we were asked to
+    # sweep all the ASNs in the country.
+    if asns is None and not ripe_config.get("sweep", False):
         logging.warning("No ASNs specified; skipping RIPE")
         return
 
-    asn_data = fetch_routing_data(country, asns, *date_range)
+    rate = ripe_config.get("rate", RATE)
+    if rate != RATE_LIMIT.rate:
+        RATE_LIMIT.set_rate(rate)
+    CLIENT.configure(**config)
+    options = {"workers": ripe_config.get("workers", MAX_WORKERS),
+               "prefixes": ripe_config.get("prefixes", False),
+               "history": ripe_config.get("history", False)}
+    routing_cache = cache.open_cache("ripe", **config)
+    try:
+        if asns is None:
+            asn_data = sweep_routing_data(country, *date_range,
+                                          routing_cache=routing_cache,
+                                          top=ripe_config.get("top",
+                                                              TOP_MOVERS),
+                                          **options)
+        else:
+            asn_data = fetch_routing_data(country, asns, *date_range,
+                                          routing_cache=routing_cache,
+                                          **options)
+    finally:
+        if routing_cache is not None:
+            logging.debug("RIPE cache: {0} hits, {1} misses".format(
+                routing_cache.hits, routing_cache.misses))
+            cache.close_cache(routing_cache)
     return asn_data
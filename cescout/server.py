@@ -0,0 +1,309 @@
+"""Serve reports over HTTP.
+
+`cescout serve' runs a small HTTP server so that dashboards and bots can
+request the report of a country for a time period without running `cescout'
+for every request. The endpoints take the same parameters as the command line:
+
+    GET /report?country=CN&since=2020-02-01T00:00:00&until=...&asns=4134,4837
+
+returns the report as text, and `/measurements' returns the measurements as
+JSON (without the configuration data). `/metrics' returns the metrics (see
+`metrics') in Prometheus' text format. `until' and `asns' are optional, and
+`skip' takes a comma-separated list of projects to skip.
+
+The measurements are kept in an in-process cache (up to `max_entries', for
+`ttl' seconds), keyed on the normalized parameters, and identical requests that
+arrive while the measurements are being fetched wait for that fetch instead of
+starting their own.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import functools
+import http.server
+import json
+import logging
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+
+from . import cache
+from . import common
+from . import main
+from . import metrics
+from . import projects
+
+# Default settings, if not set in the `server' section of `cescout.cfg'.
+HOST = "127.0.0.1"
+PORT = 8080
+TTL = 300
+MAX_ENTRIES = 128
+
+Query = collections.namedtuple("Query", ["country", "since", "until", "asns",
+                                         "skip"])
+
+
+class ResultCache:
+    """In-process cache of results with a time-to-live and LRU eviction.
+
+    Results are cached for :param ttl: seconds and, when there are more than
+    :param max_entries: results, the least recently used are evicted. Requests
+    for a key that is being fetched wait for that fetch (single-flight); if it
+    fails, they all get its exception and nothing is cached.
+
+    :param max_entries=MAX_ENTRIES: maximum number of results to keep
+    :param ttl=TTL: time (in seconds) a result is kept for
+    :param clock=time.monotonic: function that returns the current time
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = collections.OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """Return the result for a key, calling :param fetch: if needed.
+
+        :param key: hashable key of the result
+        :param fetch: function called without arguments to fetch the result
+        :return value: cached or fetched result
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                owner = False
+            else:
+                future = self._in_flight[key] = concurrent.futures.Future()
+                self.misses += 1
+                owner = True
+        if not owner:
+            return future.result()
+
+        try:
+            value = fetch()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            self._entries[key] = (self.clock() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+
+def parse_query(query):
+    """Parse and normalize the query string of a request.
+
+    Equivalent queries (such as dates with and without a time, or the same ASNs
+    in a different order) are normalized to the same Query, which is used as
+    the key of the cache.
+
+    :param query: query string of the request
+    :return Query: normalized parameters
+    :raises ValueError: if a parameter is missing or invalid
+    """
+    params = urllib.parse.parse_qs(query)
+
+    def values(name):
+        return [value.strip() for each in params.get(name, [])
+                for value in each.split(",") if value.strip()]
+
+    country = (values("country") or [""])[-1].upper()
+    if len(country) != 2 or not country.isalpha():
+        raise ValueError("`country' must be a two-letter country code")
+    if not values("since"):
+        raise ValueError("`since' is required")
+    try:
+        since = common.validate_date(values("since")[-1])
+        until = (common.validate_date(values("until")[-1])
+                 if values("until") else None)
+    except ValueError:
+        raise ValueError("`since' and `until' must be in the format {0}"
+                         " (in UTC, without a time zone)"
+                         .format(common.TIME_FORMAT))
+    if since > (until or common.date_today()):
+        raise ValueError("`since' must not be after `until'")
+    try:
+        asns = tuple(sorted(set(int(asn) for asn in values("asns")))) or None
+    except ValueError:
+        raise ValueError("`asns' must be a list of numbers")
+    skip = frozenset(values("skip"))
+    unknown = skip.difference(projects.__all__)
+    if unknown:
+        raise ValueError("Unknown projects in `skip': {0}".format(
+            ", ".join(sorted(unknown))))
+    return Query(country, since, until, asns, skip)
+
+
+def fetch_measurements(query, config):
+    """Fetch the measurements for a query (see `main.get_measurements').
+
+    :param query: Query
+    :param config: dict with configuration data from `cescout.cfg'
+    :return dict: measurement results
+    """
+    args = {"country": query.country,
+            "asns": list(query.asns) if query.asns else None,
+            "since": query.since,
+            "until": query.until or common.date_today()}
+    for project in projects.__all__:
+        args["skip_{0}".format(project)] = project in query.skip
+    return main.get_measurements(projects.__all__, args, config)
+
+
+class ReportHandler(http.server.BaseHTTPRequestHandler):
+    """Handle the requests for reports (see the module's documentation)."""
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/health":
+            self.respond("ok\n", "text/plain")
+            return
+        if url.path == "/metrics":
+            self.respond(metrics.REGISTRY.expose(), metrics.CONTENT_TYPE)
+            return
+        if url.path not in ("/report", "/measurements"):
+            self.send_error(404)
+            return
+
+        try:
+            query = parse_query(url.query)
+        except ValueError as e:
+            self.send_error(400, explain=str(e))
+            return
+        try:
+            measurements = self.server.results.get(query, functools.partial(
+                fetch_measurements, query, self.server.config))
+        except Exception:
+            logging.exception("Unable to fetch measurements for {0}".format(
+                self.path))
+            self.send_error(500)
+            return
+
+        if url.path == "/report":
+            self.respond(main.generate_report(measurements), "text/plain")
+        else:
+            # The configuration data has the credentials of the database.
+            self.respond(json.dumps({key: value
+                                     for key, value in measurements.items()
+                                     if key != "config"}),
+                         "application/json")
+
+    def respond(self, body, content_type):
+        """Send a response with :param body: (string)."""
+        body = body.encode("utf-8")
+        if "charset" not in content_type:
+            content_type = "{0}; charset=utf-8".format(content_type)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("{0} {1}".format(self.address_string(), format % args))
+
+
+class ReportServer(http.server.ThreadingHTTPServer):
+    """HTTP server for reports, with the configuration and the cache.
+
+    :param address: tuple of (host, port) to listen on
+    :param config: dict with configuration data from `cescout.cfg'
+    :param results: ResultCache of the measurements
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, config, results):
+        self.config = config
+        self.results = results
+        super().__init__(address, ReportHandler)
+
+
+def arg_parser(args):
+    """Initialize argument parser to process the server's arguments.
+
+    :param args: list of arguments to parse
+    :return parser: populated namespace of arguments
+    """
+    descr = ("cescout serve runs an HTTP server that returns the report (or"
+             " measurements) of a country for a time period.")
+    parser = argparse.ArgumentParser(prog="cescout serve", description=descr)
+    parser.add_argument("--host",
+                        help="address to listen on (default: `host' in the"
+                             " `server' section of `cescout.cfg', or"
+                             " {0})".format(HOST))
+    parser.add_argument("--port",
+                        type=int,
+                        help="port to listen on (default: `port' in the"
+                             " `server' section of `cescout.cfg', or"
+                             " {0})".format(PORT))
+    parser.add_argument("-v", "--verbose",
+                        action="store_true",
+                        help="enable verbose output (logging.DEBUG)")
+    return parser.parse_args(args)
+
+
+def run(argv=None):
+    """Entry point for `cescout serve'.
+
+    :param argv: optional list of command-line arguments (after `serve')
+    """
+    main.enable_logging()
+
+    args = arg_parser(argv)
+    if args.verbose:
+        logging.getLogger().setLevel("DEBUG")
+
+    config = main.load_config() or {}
+    server_config = config.get("server") or {}
+    address = (args.host or server_config.get("host", HOST),
+               args.port or server_config.get("port", PORT))
+    results = ResultCache(server_config.get("max_entries", MAX_ENTRIES),
+                          server_config.get("ttl", TTL))
+    try:
+        server = ReportServer(address, config, results)
+    except OSError as e:
+        logging.error("Unable to listen on {0}:{1}: {2}".format(*address, e))
+        return
+
+    # Stop on SIGTERM as on Ctrl-C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    cache.keep_open()
+    logging.info("Serving reports on http://{0}:{1}/".format(*address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info("Served {0} requests from the cache, {1} coalesced,"
+                     " {2} fetched".format(results.hits, results.coalesced,
+                                           results.misses))
+        cache.close_shared()
+        for project in projects.__all__:
+            m = sys.modules.get("cescout.projects.{0}".format(project))
+            if hasattr(m, "close_pool"):
+                m.close_pool()
@@ -0,0 +1,283 @@
+"""Local store of the OONI measurements fetched from `metadb'.
+
+The measurements that match the configured domains are kept in an SQLite
+database, along with the time periods covered for each country and, for each
+period, the highest measurement number (`msm_no') fetched, the watermark.
+Each run only fetches the measurements that were added to `metadb' since the
+previous one and reports are answered from the store, so that repeated and
+overlapping time periods do not scan `metadb' again. Measurements older than
+the retention period are pruned (see `prune').
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+# Columns of a measurement, as returned by the query (see `ooni.DB_QUERY').
+COLUMNS = ("measurement_start_time", "report_id", "probe_asn", "probe_cc",
+           "probe_ip", "test_name", "input", "blocking",
+           "http_experiment_failure")
+# Number of measurements read from the store at a time.
+BATCH_SIZE = 2000
+# Length of the prefix of a time (as text) that identifies its bucket, and the
+# suffix that completes it, for each bucket size (see `breakdown').
+BUCKETS = {"hour": (13, ":00:00"), "day": (10, " 00:00:00")}
+# Number of days the measurements are kept for; can be set with `retention' in
+# the `ooni' section of `cescout.cfg'.
+RETENTION_DAYS = 30
+
+
+class MeasurementStore:
+    """OONI measurements stored in an SQLite database.
+
+    Times are stored as text (`str' of the datetime) so that they compare in
+    chronological order. The store can be shared between threads.
+
+    :param path: path to the SQLite database (created if it does not exist)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS measurement ("
+                               " msm_no INTEGER PRIMARY KEY,"
+                               " test_start_time TEXT NOT NULL, " +
+                               ", ".join(COLUMNS) + ")")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS measurement_cc"
+                               " ON measurement (probe_cc, test_start_time)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS coverage ("
+                               " probe_cc TEXT NOT NULL,"
+                               " since TEXT NOT NULL,"
+                               " until TEXT NOT NULL,"
+                               " watermark INTEGER NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS coverage_cc"
+                               " ON coverage (probe_cc, since)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta ("
+                               " key TEXT PRIMARY KEY,"
+                               " value TEXT NOT NULL)")
+
+    def check_domains(self, domains):
+        """Empty the store if it was synced for other domains.
+
+        :param domains: list of domains the measurements are fetched for
+        :return bool: True if the store was emptied
+        """
+        value = "\n".join(sorted(domains))
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value FROM meta"
+                                     " WHERE key = 'domains'").fetchone()
+            if row is not None and row[0] == value:
+                return False
+            self._conn.execute("DELETE FROM measurement")
+            self._conn.execute("DELETE FROM coverage")
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value)"
+                               " VALUES ('domains', ?)", (value, ))
+        if row is not None:
+            logging.info("Domains changed; emptied {0}".format(self.path))
+        return row is not None
+
+    def coverage(self, country):
+        """Return the time periods covered for a country.
+
+        The periods do not overlap, apart from their bounds.
+
+        :param country: two-letter country code
+        :return list: tuples of (since, until, watermark), ordered by time;
+                      empty if the country was never synced
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT since, until, watermark"
+                                      " FROM coverage WHERE probe_cc = ?"
+                                      " ORDER BY since",
+                                      (country, )).fetchall()
+        return [(datetime.fromisoformat(row[0]),
+                 datetime.fromisoformat(row[1]), row[2]) for row in rows]
+
+    def set_coverage(self, countries, since, until, watermark):
+        """Record that the measurements of countries were synced.
+
+        The time periods already covered are cut where they overlap with the
+        new one; the parts outside of it keep their watermark.
+
+        :param countries: list of two-letter country codes
+        :param since: start of the time period covered
+        :param until: end of the time period covered
+        :param watermark: highest `msm_no' fetched
+        """
+        since, until = str(since), str(until)
+        with self._lock, self._conn:
+            for country in countries:
+                overlap = (" FROM coverage WHERE probe_cc = ?"
+                           " AND since <= ? AND until >= ?")
+                params = (country, until, since)
+                rows = self._conn.execute("SELECT since, until, watermark" +
+                                          overlap, params).fetchall()
+                self._conn.execute("DELETE" + overlap, params)
+                periods = [(since, until, watermark)]
+                for first, last, covered in rows:
+                    if first < since:
+                        periods.append((first, since, covered))
+                    if last > until:
+                        periods.append((until, last, covered))
+                self._conn.executemany("INSERT INTO coverage"
+                                       " (probe_cc, since, until, watermark)"
+                                       " VALUES (?, ?, ?, ?)",
+                                       [(country, *period)
+                                        for period in periods])
+
+    def prune(self, before):
+        """Remove the measurements older than a time.
+
+        The time periods covered are cut accordingly.
+
+        :param before: measurements that started before this time are removed
+        :return count: number of measurements removed
+        """
+        before = str(before)
+        with self._lock, self._conn:
+            cur = self._conn.execute("DELETE FROM measurement"
+                                     " WHERE test_start_time < ?", (before, ))
+            self._conn.execute("DELETE FROM coverage WHERE until < ?",
+                               (before, ))
+            self._conn.execute("UPDATE coverage SET since = ?"
+                               " WHERE since < ?", (before, before))
+            count = cur.rowcount
+        if count:
+            logging.debug("Pruned {0} measurements older than {1} from"
+                          " {2}".format(count, before, self.path))
+        return count
+
+    def add(self, rows):
+        """Add (or replace) measurements.
+
+        :param rows: iterable of dicts with `msm_no', `test_start_time' and
+                     COLUMNS
+        :return count: number of measurements added
+        """
+        values = ((row["msm_no"], str(row["test_start_time"]),
+                   str(row["measurement_start_time"]),
+                   *(row[column] for column in COLUMNS[1:]))
+                  for row in rows)
+        with self._lock, self._conn:
+            cur = self._conn.executemany(
+                "INSERT OR REPLACE INTO measurement"
+                " (msm_no, test_start_time, " + ", ".join(COLUMNS) + ")"
+                " VALUES (" + ", ".join(["?"] * (len(COLUMNS) + 2)) + ")",
+                values)
+            return cur.rowcount
+
+    def rows(self, countries, since, until):
+        """Return the measurements of countries in a time period.
+
+        :param countries: list of two-letter country codes
+        :param since: start of the time period
+        :param until: end of the time period
+        :return generator: dicts with COLUMNS, in the order they were fetched
+        """
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT " + ", ".join(COLUMNS) + " FROM measurement"
+                " WHERE probe_cc IN (" + ", ".join(["?"] * len(countries)) +
+                ") AND test_start_time >= ? AND test_start_time <= ?"
+                " ORDER BY msm_no",
+                (*countries, str(since), str(until)))
+        try:
+            while True:
+                with self._lock:
+                    rows = cur.fetchmany(BATCH_SIZE)
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(row)
+        finally:
+            cur.close()
+
+    def summary(self, countries, since, until):
+        """Count the measurements of countries in a time period.
+
+        :param countries: list of two-letter country codes
+        :param since: start of the time period
+        :param until: end of the time period
+        :return summary: dict of country mapped to a dict with `len_all' and
+                         `len_blocking' (countries without measurements are
+                         left out)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT probe_cc, count(*),"
+                " sum(blocking IS NOT 'false')"
+                " FROM measurement"
+                " WHERE probe_cc IN (" + ", ".join(["?"] * len(countries)) +
+                ") AND test_start_time >= ? AND test_start_time <= ?"
+                " GROUP BY probe_cc",
+                (*countries, str(since), str(until))).fetchall()
+        return {row[0]: {"len_all": row[1], "len_blocking": row[2]}
+                for row in rows}
+
+    def breakdown(self, countries, since, until, bucket="day"):
+        """Count the measurements of countries in a time period by dimension.
+
+        The measurements are counted by time bucket (`time'), ASN (`asn'),
+        input (`input') and blocking type (`blocking').
+
+        :param countries: list of two-letter country codes
+        :param since: start of the time period
+        :param until: end of the time period
+        :param bucket="day": size of the time buckets (see BUCKETS)
+        :return list: tuples of (dimension, country, key, len_all,
+                      len_blocking), one per group
+        """
+        length, suffix = BUCKETS[bucket]
+        where = (" FROM measurement WHERE probe_cc IN (" +
+                 ", ".join(["?"] * len(countries)) +
+                 ") AND test_start_time >= ? AND test_start_time <= ?")
+        params = (*countries, str(since), str(until))
+        dimensions = (("time", "substr(test_start_time, 1, {0}) || '{1}'"
+                       .format(length, suffix)),
+                      ("asn", "probe_asn"),
+                      ("input", "input"),
+                      ("blocking", "blocking"))
+        query = " UNION ALL ".join(
+            "SELECT '{0}', probe_cc, {1}, count(*),"
+            " sum(blocking IS NOT 'false')".format(dimension, column) +
+            where + " GROUP BY probe_cc, {0}".format(column)
+            for dimension, column in dimensions)
+        with self._lock:
+            rows = self._conn.execute(query,
+                                      params * len(dimensions)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
+
+
+def open_store(**config):
+    """Open the measurement store configured in `cescout.cfg'.
+
+    :param config: configuration parameters; `store' in the `ooni' section is
+                   the path to the SQLite database
+    :return store: MeasurementStore object, or None if the store is not
+                   configured or could not be opened
+    """
+    path = (config.get("ooni") or {}).get("store")
+    if not path:
+        return None
+
+    path = os.path.expanduser(path)
+    try:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        store = MeasurementStore(path)
+    except (OSError, sqlite3.Error) as e:
+        logging.warning("Unable to open store {0}: {1}".format(path, e))
+        return None
+    logging.debug("Using store {0}".format(path))
+    return store
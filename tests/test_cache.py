@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cescout import cache
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "test.sqlite")
+        self.cache = cache.DiskCache(self.path, max_entries=3)
+        self.addCleanup(self.cache.close)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", {"prefixes": 30})
+        self.cache.set("b", [1, 2])
+        self.assertEqual(self.cache.get("a"), {"prefixes": 30})
+        self.assertEqual(self.cache.get("b"), [1, 2])
+        self.cache.set("a", 0)
+        self.assertEqual(self.cache.get("a"), 0)
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 1))
+
+    def test_persistent(self):
+        self.cache.set("a", 1)
+        other = cache.DiskCache(self.path)
+        self.addCleanup(other.close)
+        self.assertEqual(other.get("a"), 1)
+
+    @patch("time.time")
+    def test_ttl(self, mock):
+        mock.return_value = 1000
+        self.cache.set("current", 1, ttl=300)
+        self.cache.set("past", 2)
+        mock.return_value = 1299
+        self.assertEqual(self.cache.get("current"), 1)
+        mock.return_value = 1300
+        self.assertIsNone(self.cache.get("current"))
+        mock.return_value = 10 ** 9
+        self.assertEqual(self.cache.get("past"), 2)
+
+    @patch("time.time")
+    def test_lru_eviction(self, mock):
+        for now, key in enumerate(["a", "b", "c"]):
+            mock.return_value = now
+            self.cache.set(key, now)
+        # `a' is used again, so `b' is now the least recently used entry.
+        mock.return_value = 10
+        self.assertEqual(self.cache.get("a"), 0)
+        mock.return_value = 11
+        self.cache.set("d", 3)
+        self.assertIsNone(self.cache.get("b"))
+        for key in ("a", "c", "d"):
+            self.assertIsNotNone(self.cache.get(key))
+
+    def test_count(self):
+        statements = []
+        self.cache._conn.set_trace_callback(statements.append)
+        # The entries are only counted when there are more than the maximum.
+        for key in ("a", "b", "a", "c"):
+            self.cache.set(key, 1)
+        self.assertFalse([each for each in statements if "count(*)" in each])
+        self.cache.set("d", 1)
+        self.assertEqual(len([each for each in statements if "count(*)" in each]), 1)
+        # Entries added by another process are counted (and evicted) then.
+        other = cache.DiskCache(self.path, max_entries=10)
+        self.addCleanup(other.close)
+        other.set("e", 1)
+        other.set("f", 1)
+        self.cache.set("g", 1)
+        reopened = cache.DiskCache(self.path)
+        self.addCleanup(reopened.close)
+        self.assertEqual(reopened._count, 3)
+
+
+class TestOpenCache(unittest.TestCase):
+    def test_open_cache(self):
+        self.assertIsNone(cache.open_cache("ripe"))
+        self.assertIsNone(cache.open_cache("ripe", cache={}))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "caches")
+            ripe_cache = cache.open_cache("ripe", cache={"directory": path, "max_entries": 10})
+            self.assertEqual(ripe_cache.path, os.path.join(path, "ripe.sqlite"))
+            self.assertEqual(ripe_cache.max_entries, 10)
+            ripe_cache.close()
+            with patch("os.makedirs", side_effect=OSError()):
+                self.assertIsNone(cache.open_cache("ripe", cache={"directory": path}))
+
+    def test_keep_open(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config = {"cache": {"directory": directory}}
+            cache.keep_open()
+            self.addCleanup(cache.close_shared)
+            ripe_cache = cache.open_cache("ripe", **config)
+            ripe_cache.set("a", 1)
+            cache.close_cache(ripe_cache)
+            # The same cache is returned, still open.
+            self.assertIs(cache.open_cache("ripe", **config), ripe_cache)
+            self.assertEqual(ripe_cache.get("a"), 1)
+            self.assertIsNot(cache.open_cache("ooni", **config), ripe_cache)
+            with patch.object(ripe_cache, "close", wraps=ripe_cache.close) as mock:
+                cache.close_shared()
+                mock.assert_called_once_with()
+            # Once no longer shared, caches are opened and closed every time.
+            ripe_cache = cache.open_cache("ripe", **config)
+            other = cache.open_cache("ripe", **config)
+            self.assertIsNot(other, ripe_cache)
+            other.close()
+            with patch.object(ripe_cache, "close", wraps=ripe_cache.close) as mock:
+                cache.close_cache(ripe_cache)
+                mock.assert_called_once_with()
@@ -0,0 +1,169 @@
+import gzip
+import http.server
+import socket
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+import requests
+
+from cescout import client
+from cescout import metrics
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path == "/flaky":
+            self.server.failures += 1
+            if self.server.failures <= 2:
+                self.reply(503, b"", {"Retry-After": "0.5"})
+                return
+        elif self.path == "/throttled":
+            self.reply(429, b"")
+            return
+        elif self.path == "/slow":
+            time.sleep(0.5)
+        elif self.path == "/etag":
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.reply(304, None, {"ETag": '"v1"'})
+                return
+            self.reply(200, b'{"data": 1}', {"ETag": '"v1"'})
+            return
+        elif self.path == "/gzip":
+            self.reply(200, gzip.compress(b'{"data": "compressed"}'), {"Content-Encoding": "gzip"})
+            return
+        self.reply(200, b'{"data": 0}')
+
+    def reply(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(int(self.path.strip("/")))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The client gives up on `/slow' before the response is sent.
+        pass
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.requests = []
+        self.server.failures = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+        self.delays = []
+        self.client = client.Client("test", sleep=self.delays.append)
+        self.addCleanup(self.client.close)
+
+    def test_retry_delay(self):
+        response = MagicMock(headers={"Retry-After": "5"})
+        self.assertEqual(client.retry_delay(response, 1), 5)
+        response.headers = {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}
+        self.assertEqual(client.retry_delay(response, 3, backoff=0.5), 2)
+        self.assertEqual(client.retry_delay(None, 10), client.MAX_DELAY)
+
+    def test_retries(self):
+        before = metrics.HTTP_REQUESTS.value(project="test", status="5xx")
+        response = self.client.get(self.url + "/flaky")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.timing.attempts, 3)
+        self.assertFalse(response.timing.not_modified)
+        self.assertEqual(self.delays, [0.5, 0.5])
+        # Every attempt is recorded.
+        self.assertEqual(metrics.HTTP_REQUESTS.value(project="test", status="5xx"), before + 2)
+
+        # The last response is returned once there are no retries left.
+        self.delays.clear()
+        response = self.client.get(self.url + "/throttled")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.timing.attempts, client.RETRIES + 1)
+        self.assertEqual(self.delays, [1, 2, 4])
+
+    def test_timeout(self):
+        self.client.configure(http={"read_timeout": 0.1, "retries": 1, "backoff": 0.25})
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.client.get(self.url + "/slow")
+        self.assertEqual(self.delays, [0.25])
+        self.assertEqual([path for path, _ in self.server.requests], ["/slow", "/slow"])
+        self.client.configure()
+        self.assertEqual(self.client.timeout, (client.CONNECT_TIMEOUT, client.READ_TIMEOUT))
+
+    def test_rate_limit(self):
+        rate_limit = MagicMock()
+        self.client.rate_limit = rate_limit
+        self.client.get(self.url + "/flaky")
+        self.assertEqual(rate_limit.acquire.call_count, 3)
+
+    def test_conditional(self):
+        first = self.client.get(self.url + "/etag")
+        second = self.client.get(self.url + "/etag")
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json(), {"data": 1})
+        self.assertTrue(second.timing.not_modified)
+        self.assertIsNot(first, second)
+        self.assertNotIn("If-None-Match", self.server.requests[0][1])
+        self.assertEqual(self.server.requests[1][1]["If-None-Match"], '"v1"')
+        # Streamed responses are not kept.
+        self.client.get(self.url + "/etag?page=2", stream=True).close()
+        self.client.get(self.url + "/etag?page=2", stream=True).close()
+        self.assertNotIn("If-None-Match", self.server.requests[3][1])
+
+    def test_gzip(self):
+        response = self.client.get(self.url + "/gzip")
+        self.assertIn("gzip", self.server.requests[0][1]["Accept-Encoding"])
+        self.assertEqual(response.json(), {"data": "compressed"})
+
+
+class TestHTTPAdapter(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(("127.0.0.1", 0), StatusHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+        self.session = requests.Session()
+        self.session.mount("http://", client.HTTPAdapter("test"))
+        self.addCleanup(self.session.close)
+
+    def test_requests(self):
+        requests_total = metrics.HTTP_REQUESTS
+        before = {status: requests_total.value(project="test", status=status)
+                  for status in ("2xx", "5xx", "error")}
+        count = metrics.HTTP_DURATION.count(project="test")
+        self.session.get(self.url + "/200")
+        self.session.get(self.url + "/503")
+        # Nothing listens on this port.
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.session.get("http://127.0.0.1:{0}/".format(port))
+        for status in ("2xx", "5xx", "error"):
+            self.assertEqual(requests_total.value(project="test", status=status), before[status] + 1)
+        self.assertEqual(metrics.HTTP_DURATION.count(project="test"), count + 3)
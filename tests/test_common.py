@@ -1,4 +1,7 @@
+import os
+import tempfile
 import unittest
+from unittest.mock import patch
 
 from cescout import common
 
@@ -13,3 +16,83 @@ class TestCountryCodes(unittest.TestCase):
         for each in self.cc:
             self.assertEqual(common.country_name(each),
                              self.codes[each])
+
+
+class TestCountryFile(unittest.TestCase):
+    def test_read_country_file(self):
+        with tempfile.NamedTemporaryFile("w", delete=False) as f:
+            f.write("# monitored countries\nCN\n\nIR \n  # not monitored\ntr\n")
+        self.addCleanup(os.remove, f.name)
+        self.assertEqual(common.read_country_file(f.name), ["CN", "IR", "TR"])
+        with self.assertRaises(ValueError):
+            common.read_country_file(f.name + ".missing")
+        with open(f.name, "a") as f:
+            f.write("XX\n")
+        with self.assertRaises(ValueError):
+            common.read_country_file(f.name)
+
+    def test_validate_country(self):
+        self.assertEqual(common.validate_country(" cn"), "CN")
+        for each in ("XX", "CHN", "China", ""):
+            with self.assertRaises(ValueError):
+                common.validate_country(each)
+
+
+class TestTime(unittest.TestCase):
+    def test_validate_date(self):
+        self.assertEqual(common.validate_date("2020-02-01T10:00:00"),
+                         common.datetime(2020, 2, 1, 10))
+        for each in ("2020-13-01", "2020-02-01T10:00:00+08:00", "2020-02-01T10:00:00Z"):
+            with self.assertRaises(ValueError), self.assertLogs(level="ERROR"):
+                common.validate_date(each)
+
+    def test_time_utc(self):
+        self.assertEqual(common.time_utc(1580551200), "2020-02-01 10:00:00")
+        self.assertEqual(common.time_utc(None), "-")
+
+
+class TestTokenBucket(unittest.TestCase):
+    @patch("time.sleep")
+    @patch("time.monotonic")
+    def test_acquire(self, mock_time, mock_sleep):
+        mock_time.return_value = 100
+        bucket = common.TokenBucket(2)
+        # The bucket starts full, so the first two tokens are free.
+        bucket.acquire()
+        bucket.acquire()
+        mock_sleep.assert_not_called()
+
+        def sleep(seconds):
+            mock_time.return_value += seconds
+
+        mock_sleep.side_effect = sleep
+        bucket.acquire()
+        mock_sleep.assert_called_once_with(0.5)
+        mock_time.return_value += 10
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    @patch("time.sleep")
+    @patch("time.monotonic", return_value=100)
+    def test_set_rate(self, mock_time, mock_sleep):
+        bucket = common.TokenBucket(2)
+        bucket.acquire()
+        bucket.set_rate(5, 10)
+        self.assertEqual((bucket.rate, bucket.capacity), (5, 10))
+        # The bucket is not refilled: only the token left is free.
+        bucket.acquire()
+        mock_sleep.assert_not_called()
+
+        def sleep(seconds):
+            mock_time.return_value += seconds
+
+        mock_sleep.side_effect = sleep
+        bucket.acquire()
+        mock_sleep.assert_called_once_with(0.2)
+        # The tokens are capped by the new capacity.
+        mock_time.return_value += 10
+        bucket.set_rate(1)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual(mock_sleep.call_count, 2)
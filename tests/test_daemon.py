@@ -0,0 +1,194 @@
+import datetime
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from cescout import daemon
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.output = directory.name
+        self.entry = daemon.Entry(countries=["CN", "IR"], asns=None, interval=60,
+                                  window=6, skip=frozenset(["ripe"]))
+
+    def test_load_watchlist(self):
+        config = {"watchlist": [{"countries": ["cn", "IR"], "interval": 1800, "window": 6, "skip": ["ripe"]},
+                                {"countries": "TR", "asns": [9121]},
+                                {"interval": 60},
+                                {"countries": ["CA"], "interval": "often"},
+                                {"countries": ["CA"], "window": 0},
+                                {"countries": []},
+                                "CA"]}
+        self.assertEqual(daemon.load_watchlist(config),
+                         [daemon.Entry(["CN", "IR"], None, 1800.0, 6.0, frozenset(["ripe"])),
+                          daemon.Entry(["TR"], [9121], daemon.INTERVAL, daemon.WINDOW, frozenset())])
+        self.assertEqual(daemon.load_watchlist({}), [])
+
+    def test_project_limits(self):
+        limits = daemon.project_limits({"concurrency": {"ooni": 1, "ripe": 0}})
+        self.assertEqual(list(limits), ["ooni"])
+        self.assertEqual(daemon.project_limits({}), {})
+
+    def test_limited(self):
+        limits = daemon.project_limits({"concurrency": {"ooni": 1}})
+        running = {"ooni": 0, "ioda": 0}
+        peak = {"ooni": 0, "ioda": 0}
+        lock = threading.Lock()
+        barrier = threading.Barrier(2, timeout=5)
+
+        def runner(module, project, args, config):
+            with lock:
+                running[project] += 1
+                peak[project] = max(peak[project], running[project])
+            # Unlimited projects run at the same time, or this times out.
+            if project == "ioda":
+                barrier.wait()
+            with lock:
+                running[project] -= 1
+            return project
+
+        run = daemon.limited(runner, limits)
+        threads = [threading.Thread(target=run, args=(None, project, {}, {}))
+                   for project in ("ooni", "ooni", "ooni", "ioda", "ioda")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(peak, {"ooni": 1, "ioda": 2})
+
+    def test_write_report(self):
+        until = datetime.datetime(2020, 2, 1, 10)
+        path = daemon.write_report(self.output, "CN", until, {"country": "China"}, raw=True)
+        self.assertEqual(path, os.path.join(self.output, "CN-20200201T100000.json"))
+        with open(path) as f:
+            self.assertEqual(json.load(f), {"country": "China"})
+        with patch("cescout.main.render_report", side_effect=lambda data, f: f.write("report")):
+            path = daemon.write_report(self.output, "CN", until, {"country": "China"})
+        with open(path) as f:
+            self.assertEqual(f.read(), "report")
+        # No temporary files are left behind.
+        self.assertEqual(sorted(os.listdir(self.output)),
+                         ["CN-20200201T100000.json", "CN-20200201T100000.txt"])
+
+    def test_run_entry(self):
+        until = datetime.datetime(2020, 2, 1, 10)
+        with patch("cescout.common.date_today", return_value=until), \
+                patch("cescout.projects.ooni.run_batch") as mock_ooni, \
+                patch("cescout.projects.ioda.run_batch") as mock_ioda, \
+                patch("cescout.projects.ripe.run") as mock_ripe:
+            from cescout.projects import ioda, ooni, ripe
+            modules = {"ooni": ooni, "ioda": ioda, "ripe": ripe}
+            mock_ooni.return_value = {"CN": {"len_all": 1, "len_blocking": 1}}
+            mock_ioda.return_value = {"CN": {"is_outage": False}, "IR": {"is_outage": True}}
+            paths = daemon.run_entry(self.entry, modules, {}, {}, self.output, raw=True)
+            since = datetime.datetime(2020, 2, 1, 4)
+            mock_ooni.assert_called_once_with(["CN", "IR"], None, since, until)
+            mock_ioda.assert_called_once_with(["CN", "IR"], None, since, until)
+            mock_ripe.assert_not_called()
+
+        self.assertEqual(paths, [os.path.join(self.output, "CN-20200201T100000.json"),
+                                 os.path.join(self.output, "IR-20200201T100000.json")])
+        with open(paths[1]) as f:
+            measurements = json.load(f)
+        self.assertEqual(measurements["country"], "Iran, Islamic Republic of")
+        self.assertEqual((measurements["since"], measurements["until"]),
+                         ("2020-02-01 04:00:00", "2020-02-01 10:00:00"))
+        self.assertEqual(measurements["projects"]["ooni"], {"ran_test": True, "data": None,
+                                                            "elapsed": measurements["projects"]["ooni"]["elapsed"]})
+        self.assertEqual(measurements["projects"]["ioda"]["data"], {"is_outage": True})
+        self.assertEqual(measurements["projects"]["ripe"], {"ran_test": False})
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.entries = [daemon.Entry(["CN"], None, 0.01, 24, frozenset()),
+                        daemon.Entry(["IR"], None, 0.01, 24, frozenset())]
+
+    def test_run_once(self):
+        ran = []
+        scheduler = daemon.Scheduler(ran.append, workers=2, jitter=3600)
+        scheduler.run(self.entries, once=True)
+        # Jitter only delays the runs that are scheduled again.
+        self.assertEqual(sorted(entry.countries for entry in ran), [["CN"], ["IR"]])
+
+    def test_run_failure(self):
+        def fail(entry):
+            raise RuntimeError(entry.countries)
+
+        scheduler = daemon.Scheduler(fail, jitter=0)
+        with self.assertLogs(level="ERROR") as logs:
+            scheduler.run(self.entries, once=True)
+        self.assertEqual(len(logs.records), 2)
+
+    def test_run_interval(self):
+        runs = {"CN": 0, "IR": 0}
+        running = set()
+        overlaps = []
+        lock = threading.Lock()
+
+        def run_entry(entry):
+            country = entry.countries[0]
+            with lock:
+                if country in running:
+                    overlaps.append(country)
+                running.add(country)
+                runs[country] += 1
+                done = min(runs.values()) >= 3
+            if done:
+                scheduler.stop()
+            with lock:
+                running.discard(country)
+
+        scheduler = daemon.Scheduler(run_entry, workers=4, jitter=0)
+        thread = threading.Thread(target=scheduler.run, args=(self.entries, ))
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertGreaterEqual(min(runs.values()), 3)
+        self.assertEqual(overlaps, [])
+
+    def test_schedule(self):
+        now = [100.0]
+        scheduler = daemon.Scheduler(lambda entry: None, jitter=0, clock=lambda: now[0])
+        self.addCleanup(scheduler.executor.shutdown)
+        scheduler.schedule(self.entries[0], 105)
+        scheduler.schedule(self.entries[1], 101)
+        self.assertEqual(scheduler.run_pending(), 0)
+        now[0] = 102
+        self.assertEqual(scheduler.run_pending(), 1)
+        scheduler.executor.shutdown(wait=True)
+        # `IR' was due at 101: its next run, at 101.01, is already past.
+        self.assertEqual([(due, entry) for due, _, entry in sorted(scheduler.queue)],
+                         [(102, self.entries[1]), (105, self.entries[0])])
+
+
+class TestRun(unittest.TestCase):
+    def test_run_no_watchlist(self):
+        with patch("cescout.main.load_config", return_value={}), \
+                patch("cescout.daemon.Scheduler") as mock:
+            with self.assertLogs(level="ERROR"):
+                daemon.run([])
+            mock.assert_not_called()
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "reports")
+            config = {"daemon": {"output": output, "jitter": 0, "workers": 2,
+                                 "watchlist": [{"countries": ["CN"], "skip": ["ripe"]}]}}
+            with patch("cescout.main.load_config", return_value=config), \
+                    patch("cescout.daemon.run_entry") as mock, \
+                    patch("cescout.cache.close_shared") as mock_close, \
+                    patch("cescout.projects.ooni.close_pool") as mock_pool:
+                daemon.run(["--once"])
+                self.assertTrue(os.path.isdir(output))
+                entry, = mock.call_args[0]
+                self.assertEqual(entry.countries, ["CN"])
+                self.assertEqual(mock.call_args[1]["output"], output)
+                mock_close.assert_called_once_with()
+                mock_pool.assert_called_once_with()
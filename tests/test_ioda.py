@@ -1,7 +1,8 @@
+import json
 import unittest
 from unittest.mock import patch
 
-from requests.exceptions import HTTPError
+from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError
 
 from cescout import common
 from cescout.projects import ioda
@@ -94,6 +95,22 @@ SAMPLE_REQUEST = {
 }
 
 
+def chunks(document, size=16):
+    """Split a JSON document into chunks of bytes, as read from the API."""
+    data = json.dumps(document).encode()
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+SAMPLE_INDEX = {
+    "IQ": {"region": [(1570070400, "normal", "geo.netacuity.AS.IQ.1870"),
+                      (1570070400, "critical", "geo.netacuity.AS.IQ.1859")]},
+    "LV": {"region": [(1570070400, "critical", "geo.netacuity.EU.LV.2389"),
+                      (1570070400, "normal", "geo.netacuity.EU.LV.2389")]},
+}
+
+IQ_OUTAGE = {"is_outage": True, "intervals": [{"start": 1570070400, "end": None, "level": "critical", "fqids": ["geo.netacuity.AS.IQ.1859"]}]}
+
+
 class TestIODA(unittest.TestCase):
     def setUp(self):
         self.since = common.validate_date("2020-02-01T10:00:00")
@@ -101,42 +118,111 @@ class TestIODA(unittest.TestCase):
         self.start_time = 1580551200
         self.end_time = 1580637600
 
-    def test_pair(self):
-        self.assertEqual(ioda.pair(('level', 'warning', 'critical')),
-                         [('level', 'warning'), ('warning', 'critical')])
-        self.assertEqual(ioda.pair(('level', 'critical')),
-                         [('level', 'critical')])
-        self.assertEqual(ioda.pair(('warning', )),
-                         None)
+    def test_iter_alerts(self):
+        alerts = SAMPLE_REQUEST["data"]["alerts"]
+        for size in (1, 7, 16, 4096):
+            self.assertEqual(list(ioda.iter_alerts(chunks(SAMPLE_REQUEST, size))),
+                             alerts)
+        # Keys other than `data.alerts' are skipped, wherever they are.
+        document = {"data": {"extra": [{"alerts": []}], "alerts": alerts, "n": 1.5},
+                    "error": None}
+        self.assertEqual(list(ioda.iter_alerts(chunks(document, 3))),
+                         alerts)
+        self.assertEqual(list(ioda.iter_alerts(chunks({"data": {"alerts": []}}))),
+                         [])
+        self.assertEqual(list(ioda.iter_alerts(chunks({"error": "some error"}))),
+                         [])
+        with self.assertRaises(ValueError):
+            list(ioda.iter_alerts([b'{"data": {"alerts": [{"time": 1}']))
+
+    def test_index_alerts(self):
+        alerts = SAMPLE_REQUEST["data"]["alerts"]
+        self.assertEqual(ioda.index_alerts(alerts),
+                         SAMPLE_INDEX)
+        self.assertEqual(ioda.index_alerts(alerts, ["LV", "US"]),
+                         {"LV": SAMPLE_INDEX["LV"]})
+        self.assertEqual(ioda.index_alerts(alerts, meta_types=("asn", )),
+                         {})
+
+    def test_outage_intervals(self):
+        events = [(50, "normal", "a"), (10, "normal", "a"), (20, "warning", "b"),
+                  (30, "critical", "c"), (35, "warning", "b"), (40, "normal", "b"),
+                  (60, "critical", "a"), (70, "critical", "a")]
+        self.assertEqual(ioda.outage_intervals(events),
+                         [{"start": 20, "end": 40, "level": "critical", "fqids": ["b", "c"]},
+                          {"start": 60, "end": None, "level": "critical", "fqids": ["a"]}])
+        # A country that starts in a warning or critical level is not in an
+        # outage until there is a transition from normal.
+        self.assertEqual(ioda.outage_intervals([(10, "critical", "a"), (20, "warning", "a"),
+                                                (30, "normal", "a")]),
+                         [])
+        self.assertEqual(ioda.outage_intervals([]),
+                         [])
+
+    def test_detect_outage(self):
+        self.assertEqual(ioda.detect_outage([(10, "normal", "a"), (20, "warning", "a")]),
+                         {"is_outage": True,
+                          "intervals": [{"start": 20, "end": None, "level": "warning", "fqids": ["a"]}]})
+        self.assertEqual(ioda.detect_outage([(10, "normal", "a"), (20, "normal", "a")]),
+                         {"is_outage": False, "intervals": []})
+        self.assertEqual(ioda.detect_outage([(10, "critical", "a")]),
+                         {})
 
     def test_parse_response(self):
-        self.assertEqual(ioda.parse_response(SAMPLE_REQUEST, "IQ"),
-                         {"is_outage": True})
-        self.assertEqual(ioda.parse_response(SAMPLE_REQUEST, "LV"),
-                         {"is_outage": False})
-        self.assertEqual(ioda.parse_response(SAMPLE_REQUEST, "US"),
+        self.assertEqual(ioda.parse_response(SAMPLE_INDEX, "IQ"),
+                         IQ_OUTAGE)
+        self.assertEqual(ioda.parse_response(SAMPLE_INDEX, "LV"),
+                         {"is_outage": False, "intervals": []})
+        self.assertEqual(ioda.parse_response(SAMPLE_INDEX, "US"),
                          {})
 
     def test_fetch_data(self):
-        with patch("requests.get") as mock:
-            mock.return_value.json.return_value = SAMPLE_REQUEST
+        with patch("cescout.projects.ioda.CLIENT.get") as mock:
+            mock.return_value.iter_content.return_value = chunks(SAMPLE_REQUEST)
             response = ioda.fetch_data("https://some.url")
-            self.assertEqual(response, SAMPLE_REQUEST)
-        with patch("requests.get") as mock:
+            self.assertEqual(response, SAMPLE_INDEX)
+            mock.assert_called_with("https://some.url", stream=True)
+            mock.return_value.close.assert_called_once()
+        with patch("cescout.projects.ioda.CLIENT.get") as mock:
+            mock.return_value.iter_content.return_value = chunks(SAMPLE_REQUEST)
+            self.assertEqual(ioda.fetch_data("https://some.url", ["IQ"]),
+                             {"IQ": SAMPLE_INDEX["IQ"]})
+        with patch("cescout.projects.ioda.CLIENT.get") as mock:
+            mock.return_value.iter_content.return_value = [b'{"data": ']
+            self.assertEqual(ioda.fetch_data("https://some.url"),
+                             {})
+        with patch("cescout.projects.ioda.CLIENT.get") as mock:
             mock.return_value.raise_for_status.side_effect = HTTPError()
             self.assertEqual(ioda.fetch_data("https://some.url"),
                              {})
+        for error in (ChunkedEncodingError(), ConnectionError()):
+            with patch("cescout.projects.ioda.CLIENT.get") as mock:
+                mock.return_value.iter_content.side_effect = error
+                self.assertEqual(ioda.fetch_data("https://some.url"),
+                                 {})
+                mock.return_value.close.assert_called_once()
 
     def test_time_epoch(self):
         self.assertEqual(ioda.time_epoch(self.since, self.until),
                          (self.start_time, self.end_time))
 
-    @patch("requests.get")
+    @patch("cescout.projects.ioda.CLIENT.get")
     def test_run(self, mock):
-        mock.return_value.json.return_value = SAMPLE_REQUEST
+        mock.return_value.iter_content.return_value = chunks(SAMPLE_REQUEST)
         url = ioda.IODA_VIEW_URL.format("IQ", *ioda.time_epoch(self.since,
                                                                self.until))
-        return_obj = {"is_outage": True, "url": url}
+        return_obj = {**IQ_OUTAGE, "url": url}
         self.assertEqual(ioda.run("IQ", None, self.since, self.until),
                          return_obj)
-        mock.assert_called_with(ioda.IODA_API_URL.format(self.start_time, self.end_time))
+        mock.assert_called_with(ioda.IODA_API_URL.format(self.start_time, self.end_time), stream=True)
+
+    @patch("cescout.projects.ioda.CLIENT.get")
+    def test_run_batch(self, mock):
+        mock.return_value.iter_content.return_value = chunks(SAMPLE_REQUEST)
+        since, until = ioda.time_epoch(self.since, self.until)
+        output = ioda.run_batch(["IQ", "LV", "US"], None, self.since, self.until)
+        self.assertEqual(output,
+                         {"IQ": {**IQ_OUTAGE, "url": ioda.IODA_VIEW_URL.format("IQ", since, until)},
+                          "LV": {"is_outage": False, "intervals": [], "url": ioda.IODA_VIEW_URL.format("LV", since, until)},
+                          "US": {"url": ioda.IODA_VIEW_URL.format("US", since, until)}})
+        self.assertEqual(mock.call_count, 1)
@@ -1,11 +1,17 @@
+import io
 import json
 import logging
+import os
+import sys
+import tempfile
+import threading
 import unittest
 from unittest.mock import patch
 
 from yaml import YAMLError
 
 from cescout import main
+from cescout import metrics
 
 
 class TestMain(unittest.TestCase):
@@ -32,7 +38,16 @@ class TestMain(unittest.TestCase):
         for arg in correct_args:
             main.arg_parser(arg.split(), ["ooni", ])
 
+        batch_args = main.arg_parser("--countries CN ir --since 2020-02-01T10:00:00".split(), ["ooni", ])
+        self.assertEqual(batch_args.countries, ["CN", "IR"])
+        self.assertIsNone(batch_args.country)
+        self.assertEqual(main.arg_parser("-c ca --since 2020-02-01T10:00:00".split(), ["ooni", ]).country, "CA")
+
         incorrect_args = ["--since 2020-02-01T10:00:00",
+                          "-c XX --since 2020-02-01T10:00:00",
+                          "--countries CN XX --since 2020-02-01T10:00:00",
+                          "--countries CN IR --since 2020-02-01T10:00:00 --asns 4134",
+                          "-c CA --countries CN IR --since 2020-02-01T10:00:00",
                           "-c CA 2020-02-01T10:00:00",
                           "-c CA --since 2020-02-01T10:10:10 --asns one"]
         for arg in incorrect_args:
@@ -61,11 +76,28 @@ class TestMain(unittest.TestCase):
 
         project_data = [
             {"projects": {"ooni": {"ran_test": True, "data": None}}},
-            {"projects": {"ooni": {"ran_test": True, "data": {"len_all": 2, "len_blocking": 1,
+            {"projects": {"ooni": {"ran_test": True, "data": {"len_all": 2, "len_blocking": 1, "backend": "api",
                           "measurements": [{"url": "https://explorer.ooni.io/measurement/", "blocking": "tcp_ip"}]}}}},
             {"projects": {"ioda": {"ran_test": True, "data": {"is_outage": False}}}},
+            {"projects": {"ioda": {"ran_test": True, "data": {"is_outage": True, "url": "https://ioda.caida.org/",
+                          "intervals": [{"start": 1580551200, "end": 1580554800, "level": "critical", "fqids": ["a", "b"]},
+                                        {"start": 1580558400, "end": None, "level": "warning", "fqids": ["a"]}]}}}},
             {"projects": {"ripe": {"ran_test": True, "data": {1: {"current": 10, "since": 10, "until": 10}}}}},
+            {"projects": {"ripe": {"ran_test": True, "data": {1: {"current": 9, "since": 10, "until": 9,
+                          "prefixes": {"withdrawn": ["192.0.2.0/24"], "added": [], "space_since": 512, "space_until": 256}}}}}},
+            {"projects": {"ripe": {"ran_test": True, "data": {1: {"current": 10, "since": 10, "until": 10,
+                          "history": {"times": [1580551200, 1580554800, 1580558400], "prefixes": [10, 2, 10],
+                                      "drops": [{"start": 1580554800, "end": 1580558400, "from": 10, "to": 2}]}}}}}},
             {"projects": {"ooni": {"ran_test": False}, "ioda": {"ran_test": False}}},
+            {"projects": {"ooni": {"ran_test": True, "data": {"len_all": 3, "len_blocking": 2,
+                          "breakdown": {"bucket": "hour",
+                                        "time": [{"key": "2020-02-02 10:00", "len_all": 3, "len_blocking": 2}],
+                                        "asn": [{"key": 4134, "len_all": 2, "len_blocking": 2},
+                                                {"key": 45102, "len_all": 1, "len_blocking": 0}],
+                                        "domain": [{"key": "wikipedia.org", "len_all": 3, "len_blocking": 2}],
+                                        "blocking": [{"key": "dns", "len_all": 1, "len_blocking": 1},
+                                                     {"key": None, "len_all": 1, "len_blocking": 1},
+                                                     {"key": "false", "len_all": 1, "len_blocking": 0}]}}}}},
                        ]
 
         header = "Censorship Report for 'Canada' [2020-02-02 to 2020-02-03]\n\n"
@@ -73,15 +105,40 @@ class TestMain(unittest.TestCase):
             """[ooni] no data
 """,
             """[ooni] domains: wikipedia.org, wikidata.org
-[ooni] (1 / 2) anomalous measurements
+[ooni] (1 / 2) anomalous measurements (from api)
 [ooni] https://explorer.ooni.io/measurement/ [!]
 """,
             """[ioda] no internet outage observed
+""",
+            """[ioda] internet outage observed. more information at https://ioda.caida.org/
+[ioda] 2020-02-01 10:00:00 to 2020-02-01 11:00:00: critical (a, b)
+[ioda] 2020-02-01 12:00:00 to -: warning (a)
 """,
             """[ripe] ASN 1: 2020-02-01: 10 (current), 2020-02-02: 10 (since), 2020-02-03: 10 (until)
+""",
+            """[ripe] ASN 1: 2020-02-01: 9 (current), 2020-02-02: 10 (since), 2020-02-03: 9 (until)
+[ripe] ASN 1: 1 prefixes withdrawn, 0 added; 512 (since) to 256 (until) addresses
+[ripe] ASN 1 withdrawn: 192.0.2.0/24
+""",
+            """[ripe] ASN 1: 2020-02-01: 10 (current), 2020-02-02: 10 (since), 2020-02-03: 10 (until)
+[ripe] ASN 1: visible prefixes dropped from 10 to 2, 2020-02-01 11:00:00 to 2020-02-01 12:00:00
 """,
             """[ooni] skipped test
 [ioda] skipped test
+""",
+            """[ooni] domains: wikipedia.org, wikidata.org
+[ooni] (2 / 3) anomalous measurements
+[ooni] hour                     anomalous       all
+[ooni] 2020-02-02 10:00                 2         3
+[ooni] asn                      anomalous       all
+[ooni] 4134                             2         2
+[ooni] 45102                            0         1
+[ooni] domain                   anomalous       all
+[ooni] wikipedia.org                    2         3
+[ooni] blocking                 anomalous       all
+[ooni] dns                              1         1
+[ooni] -                                1         1
+[ooni] false                            0         1
 """
                                ]
         incorrect_output_data = [
@@ -92,8 +149,14 @@ class TestMain(unittest.TestCase):
 [ooni] https://explorer.ooni.io/measurement/ [!]
 """,
             """[ioda] internet outage observed
+""",
+            """[ioda] internet outage observed. more information at https://ioda.caida.org/
 """,
             """[ripe] ASN 1: 2020-02-02: 10 (current), 2020-02-02: 10 (since), 2020-02-03: 10 (until)""",
+            """[ripe] ASN 1: 2020-02-01: 9 (current), 2020-02-02: 10 (since), 2020-02-03: 9 (until)
+""",
+            """[ripe] ASN 1: 2020-02-01: 10 (current), 2020-02-02: 10 (since), 2020-02-03: 10 (until)
+""",
             """[ooni] skipped test [ioda] skipped test
 """
                                 ]
@@ -105,6 +168,23 @@ class TestMain(unittest.TestCase):
             self.assertNotEqual(main.generate_report({**report_data, **config}),
                                 header+output)
 
+    def test_report_template(self):
+        with tempfile.TemporaryDirectory() as directory:
+            bytecode_dir = os.path.join(directory, "templates")
+            self.addCleanup(main._ENVIRONMENTS.pop, (main.config_dir(), bytecode_dir), None)
+            data = {"country": "Canada", "since": "2020-02-02", "until": "2020-02-03",
+                    "config": {"cache": {"directory": directory}},
+                    "projects": {"ooni": {"ran_test": False}}}
+            template = main.report_template(data)
+            # The environment and the compiled template are kept for the process.
+            self.assertIs(main.report_template(data), template)
+            self.assertIs(main.template_environment(main.config_dir(), bytecode_dir), template.environment)
+            self.assertEqual(len(os.listdir(bytecode_dir)), 1)
+            f = io.StringIO()
+            main.render_report(data, f)
+            self.assertEqual(f.getvalue(), main.generate_report(data))
+            self.assertTrue(f.getvalue().startswith("Censorship Report for 'Canada'"))
+
     def test_get_measurements(self):
         args = {"country": "CA", "asns": 1,
                 "current": "2020-01-01", "since": "2020-01-02", "until": "2020-01-03", "config": {}}
@@ -116,22 +196,155 @@ class TestMain(unittest.TestCase):
             mock_ooni.return_value = None
             mock_country.return_value = "CA"
             mock_date.return_value = "2020-01-01"
-            self.assertEqual(main.get_measurements(["ooni", ], {**args, "skip_ooni": False}),
+            measurements = main.get_measurements(["ooni", ], {**args, "skip_ooni": False})
+            self.assertIsInstance(measurements["projects"]["ooni"].pop("elapsed"), float)
+            self.assertEqual(measurements,
                              {**args, "projects": {"ooni": {"data": None, "ran_test": True}}})
             self.assertEqual(main.get_measurements(["ooni", ], {**args, "skip_ooni": True}),
                              {**args, "projects": {"ooni": {"ran_test": False}}})
 
+    def test_get_measurements_concurrent(self):
+        args = {"country": "CA", "asns": None, "since": "2020-01-02", "until": "2020-01-03",
+                "skip_ooni": False, "skip_ioda": False, "skip_ripe": True}
+        # Both projects wait on each other: this only completes if they run
+        # at the same time.
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wait(*args, **kwargs):
+            barrier.wait()
+            return {"is_outage": False}
+
+        with patch("cescout.main.load_config", return_value={}), \
+                patch("cescout.projects.ooni.run", side_effect=wait), \
+                patch("cescout.projects.ioda.run", side_effect=wait):
+            measurements = main.get_measurements(["ooni", "ioda", "ripe"], args)
+        self.assertEqual(list(measurements["projects"]), ["ooni", "ioda", "ripe"])
+        for project in ("ooni", "ioda"):
+            self.assertTrue(measurements["projects"][project]["ran_test"])
+            self.assertEqual(measurements["projects"][project]["data"], {"is_outage": False})
+            self.assertIn("elapsed", measurements["projects"][project])
+        self.assertEqual(measurements["projects"]["ripe"], {"ran_test": False})
+
+    def test_get_measurements_failure(self):
+        args = {"country": "CA", "asns": None, "since": "2020-01-02", "until": "2020-01-03",
+                "skip_ooni": False, "skip_ioda": False, "skip_ripe": True}
+        # A project that fails is reported without data; the results of the
+        # other projects are kept.
+        with patch("cescout.main.load_config", return_value={}), \
+                patch("cescout.projects.ooni.run", side_effect=KeyError("query_time")), \
+                patch("cescout.projects.ioda.run", return_value={"is_outage": False}), \
+                self.assertLogs(level="ERROR") as logs:
+            measurements = main.get_measurements(["ooni", "ioda", "ripe"], args)
+        self.assertIn("Unable to fetch data from `ooni'", logs.output[0])
+        self.assertEqual(measurements["projects"]["ooni"]["data"], None)
+        self.assertTrue(measurements["projects"]["ooni"]["ran_test"])
+        self.assertEqual(measurements["projects"]["ioda"]["data"], {"is_outage": False})
+
+    def test_run_project_metrics(self):
+        args = {"country": "CA", "asns": None, "since": "2020-01-02", "until": "2020-01-03"}
+        runs = {outcome: metrics.PROJECT_RUNS.value(project="ioda", outcome=outcome)
+                for outcome in ("ok", "error")}
+        count = metrics.PROJECT_DURATION.count(project="ioda")
+        with patch("cescout.projects.ioda.run") as mock:
+            from cescout.projects import ioda
+            mock.side_effect = [{"is_outage": False}, RuntimeError()]
+            main.run_project(ioda, "ioda", args, {})
+            with self.assertRaises(RuntimeError):
+                main.run_project(ioda, "ioda", args, {})
+        self.assertEqual(metrics.PROJECT_RUNS.value(project="ioda", outcome="ok"), runs["ok"] + 1)
+        self.assertEqual(metrics.PROJECT_RUNS.value(project="ioda", outcome="error"), runs["error"] + 1)
+        self.assertEqual(metrics.PROJECT_DURATION.count(project="ioda"), count + 2)
+
+    def test_get_batch_measurements(self):
+        args = {"countries": ["CN", "IR"], "asns": None, "since": "2020-01-02", "until": "2020-01-03",
+                "skip_ooni": False, "skip_ioda": False, "skip_ripe": True}
+        with patch("cescout.main.load_config", return_value={}) as mock_config, \
+                patch("cescout.projects.ooni.run_batch") as mock_ooni, \
+                patch("cescout.projects.ioda.run_batch") as mock_ioda:
+            mock_ooni.return_value = {"CN": {"len_all": 1, "len_blocking": 1}, "IR": None}
+            mock_ioda.return_value = {"CN": {"is_outage": False}, "IR": {"is_outage": True}}
+            all_measurements = main.get_batch_measurements(["ooni", "ioda", "ripe"], args)
+            mock_config.assert_called_once()
+            mock_ooni.assert_called_once_with(["CN", "IR"], None, "2020-01-02", "2020-01-03")
+            mock_ioda.assert_called_once_with(["CN", "IR"], None, "2020-01-02", "2020-01-03")
+
+        self.assertEqual([each["country"] for each in all_measurements], ["China", "Iran, Islamic Republic of"])
+        for each in all_measurements:
+            for project in ("ooni", "ioda"):
+                self.assertIsInstance(each["projects"][project].pop("elapsed"), float)
+        self.assertEqual(all_measurements[0]["projects"],
+                         {"ooni": {"ran_test": True, "data": {"len_all": 1, "len_blocking": 1}},
+                          "ioda": {"ran_test": True, "data": {"is_outage": False}},
+                          "ripe": {"ran_test": False}})
+        self.assertEqual(all_measurements[1]["projects"],
+                         {"ooni": {"ran_test": True, "data": None},
+                          "ioda": {"ran_test": True, "data": {"is_outage": True}},
+                          "ripe": {"ran_test": False}})
+
+    def test_get_batch_measurements_run(self):
+        # Projects without `run_batch' are run once per country.
+        args = {"countries": ["CN", "IR"], "asns": [1], "since": "2020-01-02", "until": "2020-01-03",
+                "skip_ooni": True, "skip_ioda": True, "skip_ripe": False}
+        with patch("cescout.main.load_config", return_value={}), \
+                patch("cescout.projects.ripe.run") as mock_ripe:
+            mock_ripe.side_effect = [{1: {"current": 1, "since": 1, "until": 1}}, {}]
+            all_measurements = main.get_batch_measurements(["ooni", "ioda", "ripe"], args)
+            self.assertEqual(mock_ripe.call_count, 2)
+            mock_ripe.assert_called_with("IR", [1], "2020-01-02", "2020-01-03")
+        self.assertEqual(all_measurements[0]["projects"]["ripe"]["data"], {1: {"current": 1, "since": 1, "until": 1}})
+        self.assertEqual(all_measurements[1]["projects"]["ripe"]["data"], None)
+
+    @patch("cescout.main.get_batch_measurements")
+    @patch("cescout.main.render_report")
+    def test_run_batch(self, report_mock, measurements_mock):
+        report_mock.side_effect = lambda data, f: f.write("{0} report".format(data["country"]))
+        measurements_mock.return_value = [{"country": "China"}, {"country": "Iran"}]
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            main.run("--countries CN IR --since 2020-01-01".split())
+        self.assertEqual(stdout.getvalue(), "China report\nIran report\n")
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            main.run("--countries CN IR --since 2020-01-01 --raw".split())
+        self.assertEqual(stdout.getvalue().splitlines(),
+                         [json.dumps({"country": "China"}), json.dumps({"country": "Iran"})])
+
     @patch("cescout.main.get_measurements")
-    @patch("cescout.main.generate_report")
+    @patch("cescout.main.render_report")
     def test_run(self, report_mock, measurements_mock):
-        report_output = '{"projects": {"ooni": {"ran_test": True, "data": None}}}'
-        report_mock.return_value = report_output
         measurements_mock.return_value = {"some_data": True}
-        with patch("builtins.print") as mock_print:
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
             main.run("-c CA --since 2020-01-01".split())
-            mock_print.assert_called_with(report_output)
+            report_mock.assert_called_once_with({"some_data": True}, stdout)
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
             main.run("-c CA --since 2020-01-01 --raw".split())
-            mock_print.assert_called_with(json.dumps({"some_data": True}))
+        self.assertEqual(stdout.getvalue(), json.dumps({"some_data": True}) + "\n")
+
+    @patch("cescout.main.get_measurements")
+    @patch("cescout.main.render_report")
+    def test_run_profile(self, report_mock, measurements_mock):
+        measurements_mock.return_value = {"some_data": True}
+        with patch("builtins.print") as mock_print, \
+                patch("cescout.main.load_config", return_value={}), \
+                tempfile.TemporaryDirectory() as directory:
+            main.run("-c CA --since 2020-01-01 --profile".split())
+            self.assertEqual(mock_print.call_args[1], {"file": sys.stderr})
+            self.assertTrue(mock_print.call_args[0][0].startswith("phase "))
+            path = os.path.join(directory, "cescout.prof")
+            with self.assertLogs(level="INFO"):
+                main.run("-c CA --since 2020-01-01 --profile-output {0}".format(path).split())
+            self.assertTrue(os.path.isfile(path))
+        self.assertIsNone(threading.getprofile())
+
+    @patch("cescout.daemon.run")
+    @patch("cescout.main.get_measurements")
+    def test_run_daemon(self, measurements_mock, daemon_mock):
+        main.run("daemon --once".split())
+        daemon_mock.assert_called_once_with(["--once"])
+        measurements_mock.assert_not_called()
+
+    @patch("cescout.server.run")
+    def test_run_serve(self, server_mock):
+        main.run("serve --port 8000".split())
+        server_mock.assert_called_once_with(["--port", "8000"])
 
     @patch("os.path.isdir")
     def test_config_dir(self, mock):
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cescout import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.counter = metrics.Counter("test_runs_total", "Runs.", ["project", "outcome"],
+                                       registry=self.registry)
+        self.histogram = metrics.Histogram("test_duration_seconds", "Duration.", ["project"],
+                                           registry=self.registry, buckets=(0.1, 1))
+
+    def test_counter(self):
+        self.counter.inc(project="ooni", outcome="ok")
+        self.counter.inc(2, project="ooni", outcome="ok")
+        self.assertEqual(self.counter.value(project="ooni", outcome="ok"), 3)
+        self.assertEqual(self.counter.value(project="ooni", outcome="error"), 0)
+        with self.assertRaises(ValueError):
+            self.counter.inc(project="ooni")
+
+    def test_expose(self):
+        self.counter.inc(project="ripe", outcome="ok")
+        self.counter.inc(project="ioda", outcome="error")
+        for value in (0.05, 0.1, 0.5, 2):
+            self.histogram.observe(value, project="ooni")
+        self.assertEqual(self.histogram.count(project="ooni"), 4)
+        self.assertEqual(self.registry.expose(),
+                         "# HELP test_runs_total Runs.\n"
+                         "# TYPE test_runs_total counter\n"
+                         'test_runs_total{project="ioda",outcome="error"} 1.0\n'
+                         'test_runs_total{project="ripe",outcome="ok"} 1.0\n'
+                         "# HELP test_duration_seconds Duration.\n"
+                         "# TYPE test_duration_seconds histogram\n"
+                         'test_duration_seconds_bucket{project="ooni",le="0.1"} 2.0\n'
+                         'test_duration_seconds_bucket{project="ooni",le="1.0"} 3.0\n'
+                         'test_duration_seconds_bucket{project="ooni",le="+Inf"} 4.0\n'
+                         'test_duration_seconds_sum{project="ooni"} 2.65\n'
+                         'test_duration_seconds_count{project="ooni"} 4.0\n')
+
+    def test_format_labels(self):
+        self.assertEqual(metrics.format_labels({}), "")
+        self.assertEqual(metrics.format_labels({"query": 'a"b\\c\nd'}),
+                         '{query="a\\"b\\\\c\\nd"}')
+
+    def test_timed(self):
+        with metrics.timed(self.histogram, self.counter, project="ooni"):
+            pass
+        with self.assertRaises(RuntimeError):
+            with metrics.timed(self.histogram, self.counter, project="ooni"):
+                raise RuntimeError()
+        self.assertEqual(self.counter.value(project="ooni", outcome="ok"), 1)
+        self.assertEqual(self.counter.value(project="ooni", outcome="error"), 1)
+        self.assertEqual(self.histogram.count(project="ooni"), 2)
+
+    def test_write(self):
+        self.counter.inc(project="ooni", outcome="ok")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cescout.prom")
+            self.registry.write(path)
+            with open(path) as f:
+                self.assertEqual(f.read(), self.registry.expose())
+            self.assertEqual(os.listdir(directory), ["cescout.prom"])
+
+    def test_export(self):
+        with patch.object(metrics.REGISTRY, "write") as mock:
+            metrics.export()
+            metrics.export(metrics={})
+            mock.assert_not_called()
+            metrics.export(metrics={"file": "~/cescout.prom"})
+            mock.assert_called_once_with(os.path.expanduser("~/cescout.prom"))
+            mock.side_effect = OSError()
+            with self.assertLogs(level="WARNING"):
+                metrics.export(metrics={"file": "/cescout.prom"})
@@ -1,17 +1,30 @@
 import datetime
+import os
+import tempfile
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, call, patch
 
-from psycopg2 import OperationalError
-from psycopg2.extras import RealDictRow
+from psycopg2 import DataError, OperationalError, ProgrammingError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor, RealDictRow
 
+from cescout import cache
+from cescout import metrics
+from cescout import store
 from cescout.projects import ooni
 
 
+def process_results(measurement_store, since):
+    return ooni.process_results(measurement_store.rows(["CN"], since, datetime.datetime(2020, 2, 14)))
+
+
 class TestOONI(unittest.TestCase):
     def setUp(self):
+        self.addCleanup(ooni.close_pool)
         self.date_range = (datetime.datetime.fromisoformat("2020-02-01T10:00:00"),
                            datetime.datetime.fromisoformat("2020-02-02T10:00:00"))
+        # Measurements with 0 as the ASN and with an `unknown_failure' are
+        # filtered out by the query (see DB_FILTER).
         self.query = [RealDictRow([('measurement_start_time', datetime.datetime(2020, 2, 11, 6, 53, 37)),
                                    ('report_id', '20200211T065336Z_AS4134_4M0eNXqQCp1mrHumzmR73pHhLRMyVh1dAc4VYcoICjBAkqjxlZ'),
                                    ('probe_asn', 4134),
@@ -29,25 +42,7 @@ class TestOONI(unittest.TestCase):
                                    ('test_name', 'web_connectivity'),
                                    ('input', 'https://fr.wikipedia.org/'),
                                    ('blocking', 'false'),
-                                   ('http_experiment_failure', None)]),
-                      RealDictRow([('measurement_start_time', datetime.datetime(2020, 2, 11, 6, 53, 37)),
-                                   ('report_id', '20200211T065336Z_AS4134_4M0eNXqQCp1mrHumzmR73pHhLRMyVh1dAc4VYcoICjBAkqjxlZ'),
-                                   ('probe_asn', 0),
-                                   ('probe_cc', 'VN'),
-                                   ('probe_ip', None),
-                                   ('test_name', 'web_connectivity'),
-                                   ('input', 'https://zh.wikipedia.org/'),
-                                   ('blocking', 'tcp_ip'),
-                                   ('http_experiment_failure', 'generic_timeout_error')]),
-                      RealDictRow([('measurement_start_time', datetime.datetime(2020, 2, 13, 6, 16, 19)),
-                                   ('report_id', '20200213T061554Z_AS45102_IVK2a2mfaXQTip5xHVezqfun2jnQo8auGA0D5JTEHK3ovOmrx1'),
-                                   ('probe_asn', 45102),
-                                   ('probe_cc', 'CA'),
-                                   ('probe_ip', None),
-                                   ('test_name', 'web_connectivity'),
-                                   ('input', 'https://fr.wikipedia.org/'),
-                                   ('blocking', 'false'),
-                                   ('http_experiment_failure', "unknown_failure")])]
+                                   ('http_experiment_failure', None)])]
         self.config = {"database": {"dbname": "metadb", "user": "postgres"},
                        "domains": ["wikipedia.org"]}
         self.expected_results = {'len_all': 2, 'len_blocking': 1,
@@ -61,20 +56,455 @@ class TestOONI(unittest.TestCase):
                                      {'url': 'https://explorer.ooni.io/measurement/20200213T061554Z_AS45102_IVK2a2mfaXQTip5xHVezqfun2jnQo8auGA0D5JTEHK3ovOmrx1?input=https%3A//fr.wikipedia.org/', 'blocking': 'false'}
                                    ]}
 
+    def mock_connection(self, mock):
+        conn = mock.return_value
+        conn.closed = 0
+        conn.prepared = set()
+        conn.info.transaction_status = TRANSACTION_STATUS_IDLE
+        return conn
+
     def test_run_query(self):
         with patch("cescout.projects.ooni.run_query", return_value=self.query):
             self.assertEqual(ooni.run_query("CN", *self.date_range, **self.config),
                              self.query)
         with patch("psycopg2.connect") as mock:
-            mock.return_value.cursor.return_value.fetchall.return_value = [("some_value")]
+            conn = self.mock_connection(mock)
+            cursor = conn.cursor.return_value
+            cursor.fetchone.return_value = (10, )
+            cursor.fetchall.return_value = [(3, "https://zh.wikipedia.org/"), (1, "https://fr.wikipedia.org/")]
+            cursor.__iter__.return_value = iter([("some_value")])
             self.assertEqual(ooni.run_query("CN", *self.date_range, **self.config),
                              None)
-            ooni_config = {"ooni": self.config}
-            self.assertEqual(ooni.run_query("CN", *self.date_range, **ooni_config),
+            ooni_config = {"ooni": {**self.config, "itersize": 500}}
+            result = ooni.run_query("CN", *self.date_range, **ooni_config)
+            conn.cursor.assert_called_with(name="cescout",
+                                           cursor_factory=RealDictCursor)
+            self.assertEqual(cursor.itersize, 500)
+            cursor.execute.assert_called_with(ooni.DB_QUERY, ([1, 3], "CN", *self.date_range))
+            # The connection is returned to the pool (and not closed) once all
+            # the rows are consumed.
+            cursor.close.reset_mock()
+            self.assertEqual(ooni._POOL._pool, [])
+            self.assertEqual(list(result),
                              [("some_value")])
-            mock.return_value.cursor.side_effect = OperationalError()
+            cursor.close.assert_called_once()
+            conn.close.assert_not_called()
+            self.assertEqual(ooni._POOL._pool, [conn])
+
+            # The connection is reused and the statements are only prepared
+            # once per connection.
+            cursor.reset_mock()
+            cursor.fetchone.return_value = (10, )
+            cursor.__iter__.return_value = iter([])
+            self.assertEqual(list(ooni.run_query("CN", *self.date_range, **ooni_config)), [])
+            mock.assert_called_once()
+            self.assertFalse([each for each in cursor.execute.call_args_list
+                              if each.args[0].startswith("PREPARE")])
+
+            # A broken connection is closed instead of being returned.
+            conn.cursor.side_effect = OperationalError()
             self.assertEqual(ooni.run_query("CN", *self.date_range, **ooni_config),
                              None)
+            conn.close.assert_called_once()
+            self.assertEqual(ooni._POOL._pool, [])
+
+    def test_run_query_release(self):
+        def execute(query, *args):
+            if query == ooni.DB_QUERY:
+                raise ProgrammingError()
+
+        config = {"ooni": {**self.config, "pool": {"minconn": 1, "maxconn": 1}}}
+        with patch("psycopg2.connect") as mock:
+            conn = self.mock_connection(mock)
+            cursor = conn.cursor.return_value
+            cursor.fetchone.return_value = (10, )
+            cursor.fetchall.return_value = [(1, "https://fr.wikipedia.org/")]
+            # The connection is closed and released on any database error,
+            # whether the query or the resolution of the inputs fails.
+            cursor.execute.side_effect = execute
+            self.assertIsNone(ooni.run_query(["CN"], *self.date_range, **config))
+            self.assertEqual(conn.close.call_count, 1)
+            cursor.execute.side_effect = DataError()
+            self.assertIsNone(ooni.run_query(["CN"], *self.date_range, **config))
+            self.assertIsNone(ooni.run_summary_query(["CN"], *self.date_range, **config))
+            self.assertIsNone(ooni.run_breakdown_query(["CN"], "day", *self.date_range, **config))
+            self.assertEqual(conn.close.call_count, 4)
+            # A generator that is never iterated releases the connection when
+            # it is closed, and the pool (of one connection) can be used again.
+            cursor.execute.side_effect = None
+            result = ooni.run_query(["CN"], *self.date_range, **config)
+            result.close()
+            self.assertEqual(ooni._POOL._pool, [conn])
+            result = ooni.run_query(["CN"], *self.date_range, **config)
+            self.assertIsNotNone(result)
+            result.close()
+            self.assertEqual(conn.close.call_count, 4)
+
+    def test_run_query_unavailable(self):
+        with patch("psycopg2.connect") as mock:
+            mock.side_effect = OperationalError()
+            self.assertEqual(ooni.run_query("CN", *self.date_range, **{"ooni": self.config}),
+                             None)
+        with patch("psycopg2.connect") as mock:
+            self.mock_connection(mock)
+            config = {"ooni": {**self.config, "pool": {"minconn": 0, "maxconn": 1}}}
+            self.assertIsNotNone(ooni.connect(**config))
+            # The pool is exhausted.
+            self.assertEqual(ooni.run_query("CN", *self.date_range, **config),
+                             None)
+
+    def test_get_pool(self):
+        with patch("psycopg2.connect") as mock:
+            pool = ooni.get_pool(self.config["database"])
+            self.assertIs(ooni.get_pool(self.config["database"]), pool)
+            mock.assert_called_once_with(connection_factory=ooni.PreparedConnection,
+                                         **self.config["database"])
+            # The pool is replaced if the settings change.
+            other = ooni.get_pool({**self.config["database"], "user": "ooni"})
+            self.assertIsNot(other, pool)
+            self.assertTrue(pool.closed)
+            ooni.close_pool()
+            self.assertTrue(other.closed)
+            self.assertIsNone(ooni._POOL)
+
+    def test_release(self):
+        with patch("psycopg2.connect") as mock:
+            conn = self.mock_connection(mock)
+            ooni.get_pool(self.config["database"], minconn=0)
+            self.assertIs(ooni._POOL.getconn(), conn)
+            ooni.get_pool(self.config["database"], minconn=1)
+            # The connection is from a pool that was replaced.
+            ooni.release(conn)
+            conn.close.assert_called()
+
+    def test_execute_prepared(self):
+        conn = MagicMock()
+        conn.prepared = set()
+        cursor = conn.cursor.return_value
+        ooni.execute_prepared(conn, cursor, "cescout_inputs", ooni.DB_INPUT_QUERY,
+                              (0, 10, "%wikipedia.org%"))
+        ooni.execute_prepared(conn, cursor, "cescout_inputs", ooni.DB_INPUT_QUERY,
+                              (10, 15, "%wikipedia.org%"))
+        ooni.execute_prepared(conn, cursor, "cescout_max_input", ooni.DB_MAX_INPUT)
+        self.assertEqual(cursor.execute.call_args_list,
+                         [call("PREPARE cescout_inputs AS " + ooni.DB_INPUT_QUERY % ("$1", "$2", "$3")),
+                          call("EXECUTE cescout_inputs (%s, %s, %s);", (0, 10, "%wikipedia.org%")),
+                          call("EXECUTE cescout_inputs (%s, %s, %s);", (10, 15, "%wikipedia.org%")),
+                          call("PREPARE cescout_max_input AS " + ooni.DB_MAX_INPUT),
+                          call("EXECUTE cescout_max_input;")])
+        self.assertEqual(conn.prepared, {"cescout_inputs", "cescout_max_input"})
+
+    def test_db_filter(self):
+        for query in (ooni.DB_QUERY, ooni.DB_SUMMARY_QUERY):
+            self.assertIn("report.probe_asn <> 0", query)
+            self.assertIn("NOT LIKE '%%unknown_failure%%'", query)
+        self.assertIn("GROUP BY report.probe_cc", ooni.DB_SUMMARY_QUERY)
+
+    def test_run_summary_query(self):
+        with patch("psycopg2.connect") as mock:
+            conn = self.mock_connection(mock)
+            conn.cursor.return_value.fetchone.return_value = (10, )
+            conn.cursor.return_value.fetchall.side_effect = [
+                [(4, "https://zh.wikipedia.org/")], [{"probe_cc": "CN", "len_all": 20, "len_blocking": 5}]]
+            self.assertEqual(ooni.run_summary_query(["CN"], *self.date_range, **self.config),
+                             None)
+            ooni_config = {"ooni": self.config}
+            self.assertEqual(ooni.run_summary_query(["CN", "IR"], *self.date_range, **ooni_config),
+                             {"CN": {"len_all": 20, "len_blocking": 5}})
+            conn.cursor.return_value.execute.assert_called_with(
+                "EXECUTE cescout_summary (%s, %s, %s, %s);",
+                ([4], ["CN", "IR"], *self.date_range))
+            self.assertIn("cescout_summary", conn.prepared)
+            self.assertEqual(ooni._POOL._pool, [conn])
+            conn.cursor.side_effect = OperationalError()
+            self.assertEqual(ooni.run_summary_query(["CN"], *self.date_range, **ooni_config),
+                             None)
+            conn.close.assert_called_once()
+
+    def test_db_inputs(self):
+        # Domains are matched against the inputs (see `resolve_inputs'), not
+        # in the measurements query.
+        for query in (ooni.DB_QUERY, ooni.DB_SUMMARY_QUERY):
+            self.assertIn("measurement.input_no = ANY(%s)", query)
+            self.assertNotIn("input.input LIKE", query)
+
+    def test_resolve_inputs(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        input_cache = cache.DiskCache(os.path.join(directory.name, "ooni.sqlite"))
+        self.addCleanup(input_cache.close)
+        conn = MagicMock()
+        cursor = conn.cursor.return_value
+        max_input = call(conn, cursor, "cescout_max_input", ooni.DB_MAX_INPUT)
+
+        def inputs(*params):
+            return call(conn, cursor, "cescout_inputs", ooni.DB_INPUT_QUERY, params)
+
+        with patch("cescout.projects.ooni.execute_prepared") as mock, \
+                patch("cescout.projects.ooni.INPUT_OVERLAP", 2):
+            # First run: all the inputs up to the watermark are matched, for
+            # all the domains in one query.
+            cursor.fetchone.return_value = (10, )
+            cursor.fetchall.side_effect = [[(2, "https://zh.wikipedia.org/"), (5, "https://www.wikidata.org/"),
+                                            (7, "https://fr.wikipedia.org/")]]
+            self.assertEqual(ooni.resolve_inputs(conn, ["wikipedia.org", "wikidata.org"], input_cache),
+                             {"wikipedia.org": [2, 7], "wikidata.org": [5]})
+            self.assertEqual(mock.call_args_list,
+                             [max_input, inputs(0, 10, ["%wikipedia.org%", "%wikidata.org%"])])
+
+            # New inputs: only those (and the last INPUT_OVERLAP below the
+            # watermark, such as 9 which was committed late) are matched.
+            mock.reset_mock()
+            cursor.fetchone.return_value = (15, )
+            cursor.fetchall.side_effect = [[(9, "https://www.wikidata.org/wiki/"), (12, "https://de.wikipedia.org/")]]
+            self.assertEqual(ooni.resolve_inputs(conn, ["wikipedia.org", "wikidata.org"], input_cache),
+                             {"wikipedia.org": [2, 7, 12], "wikidata.org": [5, 9]})
+            self.assertEqual(mock.call_args_list,
+                             [max_input, inputs(8, 15, ["%wikipedia.org%", "%wikidata.org%"])])
+
+            # A new domain starts from 0.
+            mock.reset_mock()
+            cursor.fetchall.side_effect = [[(12, "https://de.wikipedia.org/")], [(1, "https://wikinews.org/")]]
+            self.assertEqual(ooni.resolve_inputs(conn, ["wikipedia.org", "wikinews.org"], input_cache),
+                             {"wikipedia.org": [2, 7, 12], "wikinews.org": [1]})
+            self.assertEqual(mock.call_args_list,
+                             [max_input, inputs(13, 15, ["%wikipedia.org%"]), inputs(0, 15, ["%wikinews.org%"])])
+
+    def test_resolve_inputs_no_cache(self):
+        conn = MagicMock()
+        cursor = conn.cursor.return_value
+        cursor.fetchone.return_value = (None, )
+        with patch("cescout.projects.ooni.execute_prepared") as mock:
+            self.assertEqual(ooni.resolve_inputs(conn, ["wikipedia.org"]),
+                             {"wikipedia.org": []})
+            mock.assert_called_once_with(conn, cursor, "cescout_max_input", ooni.DB_MAX_INPUT)
+
+    def test_input_numbers(self):
+        with patch("cescout.projects.ooni.resolve_inputs") as mock:
+            mock.return_value = {"wikipedia.org": [7, 2], "wikidata.org": [5, 7]}
+            self.assertEqual(ooni.input_numbers(None, ["wikipedia.org", "wikidata.org"]),
+                             [2, 5, 7])
+            mock.assert_called_with(None, ["wikipedia.org", "wikidata.org"], None)
+
+    def test_sync_ranges(self):
+        days = [datetime.datetime(2020, 2, day) for day in range(1, 8)]
+        coverage = [(days[1], days[2], 100), (days[2], days[3], 20000), (days[4], days[5], 50)]
+        self.assertEqual(ooni.sync_ranges([], days[0], days[6]), [(days[0], days[6], 0)])
+        self.assertEqual(ooni.sync_ranges(coverage, days[0], days[6]),
+                         [(days[0], days[1], 0), (days[1], days[2], 0), (days[2], days[3], 10000),
+                          (days[3], days[4], 0), (days[4], days[5], 0), (days[5], days[6], 0)])
+        self.assertEqual(ooni.sync_ranges(coverage, datetime.datetime(2020, 2, 3, 12), days[3]),
+                         [(datetime.datetime(2020, 2, 3, 12), days[3], 10000)])
+        self.assertEqual(ooni.sync_ranges(coverage, days[5], days[5]), [(days[5], days[5], 0)])
+
+    @patch("cescout.projects.ooni.MEASUREMENT_OVERLAP", 10)
+    def test_sync_store(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        measurement_store = store.MeasurementStore(os.path.join(directory.name, "store.sqlite"))
+        self.addCleanup(measurement_store.close)
+        ooni_config = {"ooni": self.config}
+        since = datetime.datetime(2020, 2, 11)
+        until = datetime.datetime(2020, 2, 14)
+        rows = [{**row, "msm_no": i + 1, "test_start_time": row["measurement_start_time"]}
+                for i, row in enumerate(self.query)]
+
+        def sync_calls(mock):
+            return [each for each in mock.cursor.return_value.execute.call_args_list
+                    if each.args[0] == ooni.DB_SYNC_QUERY]
+
+        with patch("psycopg2.connect") as mock:
+            conn = self.mock_connection(mock)
+            cursor = conn.cursor.return_value
+            cursor.fetchall.return_value = [(1, "https://fr.wikipedia.org/")]
+
+            # First run: everything up to the watermark in the time period.
+            cursor.fetchone.side_effect = [(10, ), (100, )]
+            cursor.__iter__.side_effect = lambda: iter(rows)
+            self.assertTrue(ooni.sync_store(measurement_store, ["CN", "IR"], since, until, **ooni_config))
+            self.assertEqual(sync_calls(conn),
+                             [call(ooni.DB_SYNC_QUERY, ([1], ["CN", "IR"], since, until, 0, 100))])
+            self.assertEqual(measurement_store.coverage("CN"), [(since, until, 100)])
+            self.assertEqual(process_results(measurement_store, since), self.expected_results)
+
+            # Only the measurements added since (and the last
+            # MEASUREMENT_OVERLAP before them) are fetched.
+            cursor.reset_mock()
+            cursor.fetchone.side_effect = [(10, ), (150, )]
+            cursor.__iter__.side_effect = lambda: iter([])
+            self.assertTrue(ooni.sync_store(measurement_store, ["CN", "IR"], since, until, **ooni_config))
+            self.assertEqual(sync_calls(conn),
+                             [call(ooni.DB_SYNC_QUERY, ([1], ["CN", "IR"], since, until, 90, 150))])
+
+            # The parts of the time period that are not covered are fetched
+            # in full; a new country is fetched on its own.
+            cursor.reset_mock()
+            cursor.fetchone.side_effect = [(10, ), (150, )]
+            earlier = datetime.datetime(2020, 2, 1)
+            self.assertTrue(ooni.sync_store(measurement_store, ["CN", "US"], earlier, until, **ooni_config))
+            self.assertEqual(sync_calls(conn),
+                             [call(ooni.DB_SYNC_QUERY, ([1], ["CN"], earlier, since, 0, 150)),
+                              call(ooni.DB_SYNC_QUERY, ([1], ["CN"], since, until, 140, 150)),
+                              call(ooni.DB_SYNC_QUERY, ([1], ["US"], earlier, until, 0, 150))])
+            self.assertEqual(measurement_store.coverage("CN"), [(earlier, until, 150)])
+            self.assertEqual(measurement_store.coverage("IR"), [(since, until, 150)])
+
+            # Measurements before the time period and the retention period
+            # are pruned.
+            cursor.reset_mock()
+            cursor.fetchone.side_effect = [(10, ), (150, )]
+            later = datetime.datetime(2020, 2, 16)
+            self.assertTrue(ooni.sync_store(measurement_store, ["CN"], since, later, **ooni_config))
+            self.assertEqual(sync_calls(conn),
+                             [call(ooni.DB_SYNC_QUERY, ([1], ["CN"], since, until, 140, 150)),
+                              call(ooni.DB_SYNC_QUERY, ([1], ["CN"], until, later, 0, 150))])
+            self.assertEqual(measurement_store.coverage("CN"), [(since, later, 150)])
+            self.assertEqual(process_results(measurement_store, since), self.expected_results)
+
+            conn.cursor.side_effect = OperationalError()
+            self.assertFalse(ooni.sync_store(measurement_store, ["CN"], since, until, **ooni_config))
+        self.assertFalse(ooni.sync_store(measurement_store, ["CN"], since, until, **self.config))
+
+    def test_run_store(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "store.sqlite")
+        config = {"ooni": {**self.config, "store": path}}
+        measurement_store = store.MeasurementStore(path)
+        measurement_store.add({**row, "msm_no": i + 1, "test_start_time": row["measurement_start_time"]}
+                              for i, row in enumerate(self.query))
+        measurement_store.close()
+        date_range = (datetime.datetime(2020, 2, 11), datetime.datetime(2020, 2, 14))
+        with patch("cescout.projects.ooni.sync_store") as mock, \
+                patch("cescout.projects.ooni.run_query") as mock_query:
+            # The results are read from the store, even if it was not synced.
+            mock.side_effect = [True, False, True]
+            self.assertEqual(ooni.run("CN", None, *date_range, **config),
+                             {**self.expected_results, "backend": "metadb"})
+            self.assertEqual(ooni.run_batch(["CN", "IR"], None, *date_range, **config),
+                             {"CN": {**self.expected_results, "backend": "metadb"},
+                              "IR": {"len_all": 0, "len_blocking": 0, "backend": "metadb"}})
+            config["ooni"]["links"] = False
+            config["ooni"]["breakdown"] = "day"
+            self.assertEqual(ooni.run("CN", None, *date_range, **config),
+                             {"len_all": 2, "len_blocking": 1, "backend": "metadb",
+                              "breakdown": {"bucket": "day",
+                                            "time": [{"key": "2020-02-11", "len_all": 1, "len_blocking": 1},
+                                                     {"key": "2020-02-13", "len_all": 1, "len_blocking": 0}],
+                                            "asn": [{"key": 4134, "len_all": 1, "len_blocking": 1},
+                                                    {"key": 45102, "len_all": 1, "len_blocking": 0}],
+                                            "domain": [{"key": "wikipedia.org", "len_all": 2, "len_blocking": 1}],
+                                            "blocking": [{"key": "tcp_ip", "len_all": 1, "len_blocking": 1},
+                                                         {"key": "false", "len_all": 1, "len_blocking": 0}]}})
+            self.assertEqual(mock.call_args_list[0].args[1:], (["CN"], *date_range))
+            mock_query.assert_not_called()
+
+    def test_run_store_fallback(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config = {"ooni": {**self.config, "fallback": True,
+                           "store": os.path.join(directory.name, "store.sqlite")}}
+        date_range = (datetime.datetime(2020, 2, 11), datetime.datetime(2020, 2, 14))
+        # The store cannot be synced when `metadb' is unavailable: the API is
+        # used instead of the incomplete store.
+        with patch("cescout.projects.ooni.connect", return_value=None), \
+                patch("cescout.projects.ooni.ooni_api.fetch_measurements") as mock:
+            mock.return_value = self.query
+            self.assertEqual(ooni.run("CN", None, *date_range, **config),
+                             {**self.expected_results, "backend": "api"})
+            mock.assert_called_once_with(["CN"], *date_range, **config)
+            # Without `fallback', the report is answered from the store.
+            config["ooni"]["fallback"] = False
+            self.assertEqual(ooni.run("CN", None, *date_range, **config),
+                             {"len_all": 0, "len_blocking": 0, "backend": "metadb"})
+            mock.assert_called_once()
+
+    def test_run_breakdown_query(self):
+        self.assertIn("GROUPING SETS ((bucket), (probe_asn), (input), (blocking))",
+                      ooni.DB_BREAKDOWN_QUERY)
+        with patch("psycopg2.connect") as mock:
+            conn = self.mock_connection(mock)
+            conn.cursor.return_value.fetchone.return_value = (10, )
+            row = {"probe_cc": "CN", "bucket": None, "probe_asn": None, "input": None,
+                   "blocking": None, "len_all": 2, "len_blocking": 1}
+            conn.cursor.return_value.fetchall.side_effect = [
+                [(4, "https://zh.wikipedia.org/")],
+                [{**row, "grouping": 0b0111, "bucket": datetime.datetime(2020, 2, 11)},
+                 {**row, "grouping": 0b1011, "probe_asn": 4134},
+                 {**row, "grouping": 0b1101, "input": "https://zh.wikipedia.org/"},
+                 {**row, "grouping": 0b1110, "blocking": None}]]
+            self.assertEqual(ooni.run_breakdown_query(["CN"], "day", *self.date_range, **{"ooni": self.config}),
+                             [("time", "CN", "2020-02-11 00:00:00", 2, 1),
+                              ("asn", "CN", 4134, 2, 1),
+                              ("input", "CN", "https://zh.wikipedia.org/", 2, 1),
+                              ("blocking", "CN", None, 2, 1)])
+            conn.cursor.return_value.execute.assert_called_with(
+                "EXECUTE cescout_breakdown (%s, %s, %s, %s, %s);",
+                ("day", [4], ["CN"], *self.date_range))
+            conn.cursor.side_effect = OperationalError()
+            self.assertEqual(ooni.run_breakdown_query(["CN"], "day", *self.date_range, **{"ooni": self.config}),
+                             None)
+
+    def test_breakdowns(self):
+        rows = [("time", "CN", "2020-02-12 06:00:00", 3, 0),
+                ("time", "CN", "2020-02-11 06:00:00", 2, 2),
+                ("asn", "CN", 4134, 2, 1),
+                ("asn", "CN", 45102, 3, 1),
+                ("input", "CN", "https://zh.wikipedia.org/", 2, 1),
+                ("input", "CN", "https://fr.wikipedia.org/", 2, 0),
+                ("input", "CN", "https://www.wikidata.org/", 1, 1),
+                ("blocking", "CN", "false", 3, 0),
+                ("blocking", "CN", "dns", 2, 2),
+                ("asn", "IR", 197207, 1, 1)]
+        self.assertEqual(ooni.breakdowns(rows, ["CN", "US"], ["wikipedia.org", "wikidata.org"], "day"),
+                         {"CN": {"bucket": "day",
+                                 "time": [{"key": "2020-02-11", "len_all": 2, "len_blocking": 2},
+                                          {"key": "2020-02-12", "len_all": 3, "len_blocking": 0}],
+                                 "asn": [{"key": 45102, "len_all": 3, "len_blocking": 1},
+                                         {"key": 4134, "len_all": 2, "len_blocking": 1}],
+                                 "domain": [{"key": "wikipedia.org", "len_all": 4, "len_blocking": 1},
+                                            {"key": "wikidata.org", "len_all": 1, "len_blocking": 1}],
+                                 "blocking": [{"key": "dns", "len_all": 2, "len_blocking": 2},
+                                              {"key": "false", "len_all": 3, "len_blocking": 0}]},
+                          "US": {"bucket": "day", "time": [], "asn": [], "domain": [], "blocking": []}})
+        self.assertEqual(ooni.breakdowns(rows[:1], ["CN"], [], "hour")["CN"]["time"],
+                         [{"key": "2020-02-12 06:00", "len_all": 3, "len_blocking": 0}])
+
+    def test_run_breakdown(self):
+        config = {"ooni": {**self.config, "breakdown": "hour"}}
+        breakdown = {"bucket": "hour", "time": [], "asn": [], "domain": [], "blocking": []}
+        with patch("cescout.projects.ooni.run_query") as mock_query, \
+                patch("cescout.projects.ooni.run_breakdown_query") as mock:
+            mock_query.return_value = self.query
+            mock.return_value = []
+            self.assertEqual(ooni.run("CN", None, *self.date_range, **config),
+                             {**self.expected_results, "backend": "metadb", "breakdown": breakdown})
+            mock.assert_called_with(["CN"], "hour", *self.date_range, **config)
+            # No breakdown if the query fails or the bucket size is invalid.
+            mock.return_value = None
+            self.assertEqual(ooni.run("CN", None, *self.date_range, **config),
+                             {**self.expected_results, "backend": "metadb"})
+            config["ooni"]["breakdown"] = "week"
+            self.assertEqual(ooni.run("CN", None, *self.date_range, **config),
+                             {**self.expected_results, "backend": "metadb"})
+            self.assertEqual(mock.call_count, 2)
+
+    def test_run_summary(self):
+        config = {"ooni": {**self.config, "links": False}}
+        with patch("cescout.projects.ooni.run_summary_query") as mock, \
+                patch("cescout.projects.ooni.run_query") as mock_query:
+            mock.side_effect = [{"CN": {"len_all": 20, "len_blocking": 5}}, {}, None,
+                                {"CN": {"len_all": 20, "len_blocking": 5}}]
+            self.assertEqual(ooni.run("CN", None, *self.date_range, **config),
+                             {"len_all": 20, "len_blocking": 5, "backend": "metadb"})
+            self.assertEqual(ooni.run("CN", None, *self.date_range, **config),
+                             {"len_all": 0, "len_blocking": 0, "backend": "metadb"})
+            self.assertEqual(ooni.run("CN", None, *self.date_range, **config),
+                             None)
+            self.assertEqual(ooni.run_batch(["CN", "IR"], None, *self.date_range, **config),
+                             {"CN": {"len_all": 20, "len_blocking": 5, "backend": "metadb"},
+                              "IR": {"len_all": 0, "len_blocking": 0, "backend": "metadb"}})
+            mock_query.assert_not_called()
 
     def test_process_results(self):
         self.assertEqual(ooni.process_results(self.query),
@@ -82,11 +512,113 @@ class TestOONI(unittest.TestCase):
         self.assertNotEqual(ooni.process_results(self.query),
                             self.unexpected_results)
 
+    def test_report_link(self):
+        quoted = {}
+        measurement = ooni.Measurement("20200211T065336Z", "https://zh.wikipedia.org/", "dns")
+        self.assertEqual(ooni.report_link(measurement, quoted),
+                         "https://explorer.ooni.io/measurement/20200211T065336Z?input=https%3A//zh.wikipedia.org/")
+        self.assertEqual(quoted, {"https://zh.wikipedia.org/": "https%3A//zh.wikipedia.org/"})
+        # Inputs are only encoded once.
+        with patch("urllib.parse.quote") as mock:
+            self.assertEqual(ooni.report_link(measurement._replace(report_id="other"), quoted),
+                             "https://explorer.ooni.io/measurement/other?input=https%3A//zh.wikipedia.org/")
+            mock.assert_not_called()
+
+    def test_process_results_stream(self):
+        # Rows are consumed one at a time, so any iterable works.
+        self.assertEqual(ooni.process_results(iter(self.query)),
+                         self.expected_results)
+        self.assertEqual(ooni.process_results(iter([])),
+                         {"len_all": 0, "len_blocking": 0})
+
+    def test_process_batch_results(self):
+        self.assertEqual(ooni.process_batch_results(iter(self.query), ["IR", "CN"]),
+                         {"CN": self.expected_results,
+                          "IR": {"len_all": 0, "len_blocking": 0}})
+        # Measurements of other countries are dropped before their links are
+        # encoded.
+        with patch("urllib.parse.quote") as mock:
+            self.assertEqual(ooni.process_batch_results(iter(self.query), ["IR"]),
+                             {"IR": {"len_all": 0, "len_blocking": 0}})
+            mock.assert_not_called()
+
+    def test_process_results_metrics(self):
+        # Only the rows kept for the report are counted.
+        kept = metrics.PROCESSED_ROWS.value(project="ooni")
+        ooni.process_batch_results(iter(self.query), ["IR"])
+        ooni.process_batch_results(iter(self.query), ["CN"])
+        self.assertEqual(metrics.PROCESSED_ROWS.value(project="ooni"), kept + 2)
+        ooni.process_results(iter(self.query))
+        self.assertEqual(metrics.PROCESSED_ROWS.value(project="ooni"), kept + 4)
+
     def test_run(self):
         with patch("cescout.projects.ooni.run_query") as mock:
             mock.side_effect = [self.query, None]
             self.assertEqual(ooni.run("CN", 1, *self.date_range, **self.config),
-                             self.expected_results)
+                             {**self.expected_results, "backend": "metadb"})
             self.assertEqual(ooni.run("CN", 1, *self.date_range, **self.config),
                              None)
-            mock.assert_called_with("CN", *self.date_range, **self.config)
+            mock.assert_called_with(["CN"], *self.date_range, **self.config)
+
+    def test_run_batch(self):
+        with patch("cescout.projects.ooni.run_query") as mock:
+            mock.side_effect = [self.query, None]
+            self.assertEqual(ooni.run_batch(["CN", "CA", "US"], None, *self.date_range, **self.config),
+                             {"CN": {**self.expected_results, "backend": "metadb"},
+                              "CA": {"len_all": 0, "len_blocking": 0, "backend": "metadb"},
+                              "US": {"len_all": 0, "len_blocking": 0, "backend": "metadb"}})
+            mock.assert_called_with(["CN", "CA", "US"], *self.date_range, **self.config)
+            self.assertEqual(ooni.run_batch(["CN", "CA"], None, *self.date_range, **self.config),
+                             None)
+
+    def test_run_api(self):
+        config = {"ooni": {**self.config, "backend": "api"}}
+        with patch("cescout.projects.ooni_api.fetch_measurements") as mock, \
+                patch("cescout.projects.ooni.run_query") as mock_query:
+            mock.side_effect = [self.query, None]
+            self.assertEqual(ooni.run_batch(["CN", "IR"], None, *self.date_range, **config),
+                             {"CN": {**self.expected_results, "backend": "api"},
+                              "IR": {"len_all": 0, "len_blocking": 0, "backend": "api"}})
+            mock.assert_called_with(["CN", "IR"], *self.date_range, **config)
+            self.assertEqual(ooni.run("CN", None, *self.date_range, **config), None)
+            mock_query.assert_not_called()
+
+    def test_run_api_summary(self):
+        config = {"ooni": {**self.config, "backend": "api", "links": False, "breakdown": "day"}}
+        with patch("cescout.projects.ooni_api.fetch_measurements") as mock:
+            mock.return_value = self.query
+            all_measurements = ooni.run_batch(["CN", "IR"], None, *self.date_range, **config)
+        self.assertEqual(all_measurements["IR"],
+                         {"len_all": 0, "len_blocking": 0, "backend": "api",
+                          "breakdown": {"bucket": "day", "time": [], "asn": [], "domain": [], "blocking": []}})
+        self.assertEqual(all_measurements["CN"]["len_all"], 2)
+        self.assertEqual(all_measurements["CN"]["len_blocking"], 1)
+        self.assertNotIn("measurements", all_measurements["CN"])
+        self.assertEqual(all_measurements["CN"]["breakdown"]["time"],
+                         [{"key": "2020-02-11", "len_all": 1, "len_blocking": 1},
+                          {"key": "2020-02-13", "len_all": 1, "len_blocking": 0}])
+        self.assertEqual(all_measurements["CN"]["breakdown"]["blocking"],
+                         [{"key": "tcp_ip", "len_all": 1, "len_blocking": 1},
+                          {"key": "false", "len_all": 1, "len_blocking": 0}])
+
+    def test_run_fallback(self):
+        config = {"ooni": {**self.config, "fallback": True}}
+        with patch("cescout.projects.ooni_api.fetch_measurements") as mock, \
+                patch("cescout.projects.ooni.run_query") as mock_query:
+            mock.return_value = self.query
+            mock_query.return_value = None
+            self.assertEqual(ooni.run("CN", None, *self.date_range, **config),
+                             {**self.expected_results, "backend": "api"})
+            mock_query.assert_called_with(["CN"], *self.date_range, **config)
+            # Without `fallback', the API is not used.
+            config["ooni"]["fallback"] = False
+            self.assertEqual(ooni.run("CN", None, *self.date_range, **config), None)
+            self.assertEqual(mock.call_count, 1)
+
+    def test_run_invalid_backend(self):
+        config = {"ooni": {**self.config, "backend": "other"}}
+        with patch("cescout.projects.ooni_api.fetch_measurements") as mock, \
+                patch("cescout.projects.ooni.run_query") as mock_query:
+            self.assertEqual(ooni.run_batch(["CN"], None, *self.date_range, **config), None)
+            mock.assert_not_called()
+            mock_query.assert_not_called()
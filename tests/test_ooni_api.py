@@ -0,0 +1,146 @@
+import datetime
+import http.server
+import json
+import threading
+import unittest
+import urllib.parse
+
+from cescout.projects import ooni_api
+
+
+def api_measurement(report_id, country, domain, time, anomaly=False, blocking_type=None, asn="AS4134"):
+    return {"report_id": report_id,
+            "probe_asn": asn,
+            "probe_cc": country,
+            "input": "https://{0}/".format(domain),
+            "measurement_start_time": time,
+            "test_name": "web_connectivity",
+            "anomaly": anomaly,
+            "confirmed": False,
+            "failure": False,
+            "scores": {"analysis": {"blocking_type": blocking_type}} if blocking_type else {}}
+
+
+class APIHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for OONI's measurements API, with paging."""
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = {key: value[0] for key, value in urllib.parse.parse_qs(url.query).items()}
+        self.server.requests.append(params)
+        if params["domain"] == "error.org":
+            self.send_error(500)
+            return
+
+        results = [each for each in self.server.measurements
+                   if each["probe_cc"] == params["probe_cc"]
+                   and each["input"] == "https://{0}/".format(params["domain"])
+                   and params["since"] <= each["measurement_start_time"].rstrip("Z") < params["until"]]
+        offset, limit = int(params.get("offset", 0)), int(params["limit"])
+        next_url = None
+        if offset + limit < len(results):
+            next_url = "http://{0}:{1}{2}?{3}".format(
+                *self.server.server_address, url.path,
+                urllib.parse.urlencode({**params, "offset": offset + limit}))
+        body = json.dumps({"metadata": {"offset": offset, "limit": limit, "count": len(results),
+                                        "next_url": next_url},
+                           "results": results[offset:offset + limit]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestOONIAPI(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), APIHandler)
+        cls.server.measurements = []
+        cls.server.requests = []
+        thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        thread.start()
+        cls.api_url = "http://127.0.0.1:{0}/api/v1/measurements".format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.measurements[:] = [
+            api_measurement("r1", "CN", "zh.wikipedia.org", "2020-02-01T06:00:00Z", True, "dns"),
+            api_measurement("r2", "CN", "zh.wikipedia.org", "2020-02-01T07:00:00Z"),
+            api_measurement("r3", "CN", "zh.wikipedia.org", "2020-02-01T08:00:00Z", True),
+            api_measurement("r4", "CN", "zh.wikipedia.org", "2020-02-02T06:00:00Z", True, "tcp_ip"),
+            api_measurement("r5", "CN", "www.wikidata.org", "2020-02-01T09:00:00Z"),
+            api_measurement("r6", "IR", "zh.wikipedia.org", "2020-02-01T09:00:00Z", asn="AS0"),
+            api_measurement("r7", "IR", "zh.wikipedia.org", "2020-02-01T10:00:00Z", asn="AS197207"),
+        ]
+        self.server.requests[:] = []
+        self.since = datetime.datetime(2020, 2, 1)
+        self.until = datetime.datetime(2020, 2, 3)
+        self.config = {"ooni": {"domains": ["zh.wikipedia.org", "www.wikidata.org"],
+                                "api": {"url": self.api_url, "workers": 2, "limit": 2, "slice": 24}}}
+
+    def test_time_slices(self):
+        self.assertEqual(ooni_api.time_slices(self.since, self.until),
+                         [(self.since, datetime.datetime(2020, 2, 2)),
+                          (datetime.datetime(2020, 2, 2), self.until)])
+        self.assertEqual(ooni_api.time_slices(self.since, datetime.datetime(2020, 2, 1, 10), 4),
+                         [(self.since, datetime.datetime(2020, 2, 1, 4)),
+                          (datetime.datetime(2020, 2, 1, 4), datetime.datetime(2020, 2, 1, 8)),
+                          (datetime.datetime(2020, 2, 1, 8), datetime.datetime(2020, 2, 1, 10))])
+        self.assertEqual(ooni_api.time_slices(self.since, self.since),
+                         [(self.since, self.since)])
+
+    def test_normalize(self):
+        self.assertEqual(ooni_api.normalize(self.server.measurements[0]),
+                         {"measurement_start_time": datetime.datetime(2020, 2, 1, 6),
+                          "report_id": "r1",
+                          "probe_asn": 4134,
+                          "probe_cc": "CN",
+                          "probe_ip": None,
+                          "test_name": "web_connectivity",
+                          "input": "https://zh.wikipedia.org/",
+                          "blocking": "dns",
+                          "http_experiment_failure": None})
+        self.assertEqual(ooni_api.normalize(self.server.measurements[1])["blocking"], "false")
+        self.assertEqual(ooni_api.normalize(self.server.measurements[2])["blocking"], "anomaly")
+        self.assertEqual(ooni_api.normalize({**self.server.measurements[1], "probe_asn": 4134})["probe_asn"],
+                         4134)
+        self.assertIsNone(ooni_api.normalize(self.server.measurements[5]))
+
+    def test_fetch_measurements(self):
+        rows = ooni_api.fetch_measurements(["CN", "IR"], self.since, self.until, **self.config)
+        self.assertEqual([row["report_id"] for row in rows],
+                         ["r1", "r2", "r3", "r4", "r5", "r7"])
+        self.assertEqual(rows[-1]["probe_asn"], 197207)
+        # One request per country, domain and time slice, plus the next pages
+        # (three measurements of CN for zh.wikipedia.org on the first day).
+        self.assertEqual(len(self.server.requests), 2 * 2 * 2 + 1)
+        self.assertIn({"probe_cc": "CN", "domain": "zh.wikipedia.org", "test_name": "web_connectivity",
+                       "since": "2020-02-01T00:00:00", "until": "2020-02-02T00:00:00", "limit": "2",
+                       "order_by": "measurement_start_time", "order": "asc", "offset": "2"},
+                      self.server.requests)
+
+    def test_fetch_measurements_errors(self):
+        self.config["ooni"]["domains"].append("error.org")
+        self.config["http"] = {"retries": 0}
+        self.assertIsNone(ooni_api.fetch_measurements(["CN"], self.since, self.until, **self.config))
+        self.assertIsNone(ooni_api.fetch_measurements(["CN"], self.since, self.until))
+
+    def test_breakdown_rows(self):
+        rows = [ooni_api.normalize(each) for each in self.server.measurements[:4]]
+        self.assertEqual(sorted(ooni_api.breakdown_rows(rows, 10), key=str),
+                         sorted([("time", "CN", "2020-02-01", 3, 2),
+                                 ("time", "CN", "2020-02-02", 1, 1),
+                                 ("asn", "CN", 4134, 4, 3),
+                                 ("input", "CN", "https://zh.wikipedia.org/", 4, 3),
+                                 ("blocking", "CN", "dns", 1, 1),
+                                 ("blocking", "CN", "false", 1, 0),
+                                 ("blocking", "CN", "anomaly", 1, 1),
+                                 ("blocking", "CN", "tcp_ip", 1, 1)], key=str))
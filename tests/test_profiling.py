@@ -0,0 +1,79 @@
+import os
+import pstats
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from cescout import profiling
+
+
+def busy(n):
+    return sum(range(n))
+
+
+class TestProfiling(unittest.TestCase):
+    def tearDown(self):
+        profiling.stop()
+
+    def test_disabled(self):
+        with profiling.phase("load_config"):
+            pass
+        self.assertEqual(profiling.stop(), {})
+
+    def test_phases(self):
+        @profiling.phase("decorated")
+        def decorated():
+            pass
+
+        profiling.start()
+        decorated()
+        with self.assertRaises(RuntimeError):
+            with profiling.phase("failed"):
+                raise RuntimeError()
+        threads = [threading.Thread(target=decorated) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        phases = profiling.stop()
+        self.assertEqual(sorted(phases), ["decorated", "failed"])
+        calls, total, longest = phases["decorated"]
+        self.assertEqual(calls, 4)
+        self.assertGreaterEqual(total, longest)
+        # Phases are no longer timed once stopped.
+        decorated()
+        self.assertEqual(profiling.stop(), {})
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cescout.prof")
+            profiling.start(profile=True)
+            thread = threading.Thread(target=busy, args=(1000, ))
+            thread.start()
+            thread.join()
+            profiling.stop(path)
+            stats = pstats.Stats(path)
+        functions = [function for _, _, function in stats.stats]
+        # `busy' only ran in the thread.
+        self.assertIn("busy", functions)
+        self.assertIsNone(threading.getprofile())
+
+    def test_profile_single(self):
+        # Since Python 3.12, only the profiler of the main thread is used, as
+        # a second active profiler raises a ValueError.
+        with patch("cescout.profiling._THREAD_PROFILES", False):
+            profiling.start(profile=True)
+            self.assertIsNone(threading.getprofile())
+            thread = threading.Thread(target=busy, args=(1000, ))
+            thread.start()
+            thread.join()
+            profiling.stop()
+        self.assertIsNone(threading.getprofile())
+
+    def test_format_phases(self):
+        self.assertEqual(profiling.format_phases({"load_config": (1, 0.0012, 0.0012),
+                                                  "ripe.fetch_data": (12, 3.5, 0.75)}).splitlines(),
+                         ["phase                              calls   total (s)     max (s)",
+                          "ripe.fetch_data                       12       3.500       0.750",
+                          "load_config                            1       0.001       0.001"])
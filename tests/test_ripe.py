@@ -1,8 +1,12 @@
+import datetime
+import os
+import tempfile
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from requests.exceptions import HTTPError
 
+from cescout import cache
 from cescout.projects import ripe
 
 REQUEST_RESPONSE = {
@@ -61,6 +65,46 @@ ROUTING_RESPONSE = {
     }
 }
 
+PREFIXES_SINCE = {
+    "status": "ok",
+    "data": {
+        "prefixes": [
+            {"prefix": "192.0.2.0/24", "timelines": []},
+            {"prefix": "198.51.100.0/24", "timelines": []},
+            {"prefix": "198.51.100.0/25", "timelines": []},
+            {"prefix": "2001:db8::/32", "timelines": []},
+        ],
+    }
+}
+
+PREFIXES_UNTIL = {
+    "status": "ok",
+    "data": {
+        "prefixes": [
+            {"prefix": "192.0.2.0/24", "timelines": []},
+            {"prefix": "203.0.113.0/24", "timelines": []},
+        ],
+    }
+}
+
+HISTORY_RESPONSE = {
+    "status": "ok",
+    "data": {
+        "prefixes": [
+            {"prefix": "192.0.2.0/24",
+             "timelines": [{"starttime": "2020-02-01T10:00:00", "endtime": "2020-02-01T18:00:00"},
+                           {"starttime": "2020-02-02T02:00:00", "endtime": "2020-02-02T10:00:00"}]},
+            {"prefix": "198.51.100.0/24",
+             "timelines": [{"starttime": "2020-01-01T00:00:00", "endtime": "2020-02-01T18:00:00"},
+                           {"starttime": "2020-02-02T02:00:00", "endtime": "2020-02-02T10:00:00"}]},
+            {"prefix": "203.0.113.0/24",
+             "timelines": [{"starttime": "2020-02-01T10:00:00", "endtime": "2020-02-02T10:00:00"}]},
+            {"prefix": "2001:db8::/32",
+             "timelines": [{"starttime": "2020-02-01T10:00:00", "endtime": "2020-02-01T12:00:00"}]},
+        ],
+    }
+}
+
 
 class TestRIPE(unittest.TestCase):
     def setUp(self):
@@ -69,18 +113,18 @@ class TestRIPE(unittest.TestCase):
         self.asn_data_output = {1: {"current": 30, "since": 30, "until": 30}}
 
     def test_fetch_data(self):
-        with patch("requests.get") as mock:
+        with patch("cescout.projects.ripe.CLIENT.get") as mock:
             mock.return_value.json.return_value = REQUEST_RESPONSE
             response = ripe.fetch_data("https://some.url")
             self.assertEqual(response, {"query_time": self.since})
             mock.assert_called_with("https://some.url")
-        with patch("requests.get") as mock_error:
+        with patch("cescout.projects.ripe.CLIENT.get") as mock_error:
             mock_error.return_value.raise_for_status.side_effect = HTTPError()
             self.assertEqual(ripe.fetch_data("https://error.url"),
                              {})
             mock_error.assert_called_with("https://error.url")
 
-    @patch("requests.get")
+    @patch("cescout.projects.ripe.CLIENT.get")
     def test_fetch_country_data(self, mock):
         mock.return_value.json.return_value = COUNTRY_RESPONSE
         country_data = ripe.fetch_country_data("CA")
@@ -88,7 +132,7 @@ class TestRIPE(unittest.TestCase):
         self.assertNotEqual(country_data, 1)
         mock.assert_called_with(ripe.RIPE_COUNTRY_INFO.format("CA"))
 
-    @patch("requests.get")
+    @patch("cescout.projects.ripe.CLIENT.get")
     def test_fetch_asn_data(self, mock):
         mock.return_value.json.return_value = ROUTING_RESPONSE
         routing_data = ripe.fetch_asn_data(1)
@@ -99,7 +143,149 @@ class TestRIPE(unittest.TestCase):
         self.assertEqual(routing_data_hist, 30)
         mock.assert_called_with(ripe.RIPE_ROUTING_HIST.format(1, self.since))
 
-    @patch("requests.get")
+    def test_snapshot_ttl(self):
+        with patch("cescout.common.date_today", return_value=datetime.datetime(2020, 2, 3, 10, 0, 0)):
+            self.assertEqual(ripe.snapshot_ttl(), ripe.CURRENT_TTL)
+            self.assertEqual(ripe.snapshot_ttl(self.since), None)
+            self.assertEqual(ripe.snapshot_ttl(datetime.datetime(2020, 2, 2, 10, 0, 0)), None)
+            self.assertEqual(ripe.snapshot_ttl("2020-02-03T09:00:00"), ripe.CURRENT_TTL)
+
+    @patch("time.time")
+    @patch("cescout.projects.ripe.CLIENT.get")
+    def test_fetch_asn_data_cache(self, mock, mock_time):
+        mock.return_value.json.return_value = ROUTING_RESPONSE
+        mock_time.return_value = 1000
+        with tempfile.TemporaryDirectory() as directory:
+            routing_cache = cache.DiskCache(os.path.join(directory, "ripe.sqlite"))
+            for _ in range(2):
+                self.assertEqual(ripe.fetch_asn_data(1, self.since, routing_cache), 30)
+                self.assertEqual(ripe.fetch_asn_data(1, routing_cache=routing_cache), 30)
+            self.assertEqual(mock.call_count, 2)
+            self.assertEqual((routing_cache.hits, routing_cache.misses), (2, 2))
+            # The current routing state expires but not the past one.
+            mock_time.return_value = 1000 + ripe.CURRENT_TTL
+            ripe.fetch_asn_data(1, self.since, routing_cache)
+            ripe.fetch_asn_data(1, routing_cache=routing_cache)
+            self.assertEqual(mock.call_count, 3)
+            routing_cache.close()
+
+    def test_prefix_range(self):
+        self.assertEqual(ripe.prefix_range("192.0.2.0/24"), (3221225984, 3221226240))
+        self.assertEqual(ripe.prefix_range("192.0.2.1/24"), (3221225984, 3221226240))
+        self.assertEqual(ripe.prefix_range("192.0.2.1"), (3221225985, 3221225986))
+        self.assertEqual(ripe.prefix_range("0.0.0.0/0"), (0, 2 ** 32))
+        for prefix in ("192.0.2.0/24", "10.0.0.0/8", "192.0.2.1/32", "0.0.0.0/0"):
+            self.assertEqual(ripe.range_prefix(*ripe.prefix_range(prefix)), prefix)
+
+    def test_prefix_ranges(self):
+        ranges = ripe.prefix_ranges(["198.51.100.0/24", "192.0.2.0/24", "2001:db8::/32", "192.0.2.0/24"])
+        self.assertEqual(ranges.tolist(), [3221225984, 3221226240, 3325256704, 3325256960])
+        self.assertEqual(ripe.format_ranges(ranges), ["192.0.2.0/24", "198.51.100.0/24"])
+        self.assertEqual(len(ripe.prefix_ranges([])), 0)
+
+    def test_diff_ranges(self):
+        old = ripe.prefix_ranges(["10.0.0.0/8", "10.1.0.0/16", "192.0.2.0/24"])
+        new = ripe.prefix_ranges(["10.0.0.0/8", "198.51.100.0/24", "1.1.1.0/24"])
+        removed, added = ripe.diff_ranges(old, new)
+        self.assertEqual(ripe.format_ranges(removed), ["10.1.0.0/16", "192.0.2.0/24"])
+        self.assertEqual(ripe.format_ranges(added), ["1.1.1.0/24", "198.51.100.0/24"])
+        removed, added = ripe.diff_ranges(old, old)
+        self.assertEqual((len(removed), len(added)), (0, 0))
+
+    def test_address_space(self):
+        # Overlapping prefixes are only counted once.
+        self.assertEqual(ripe.address_space(ripe.prefix_ranges(["10.0.0.0/8", "10.1.0.0/16", "192.0.2.0/24"])),
+                         2 ** 24 + 256)
+        self.assertEqual(ripe.address_space(ripe.prefix_ranges(["192.0.2.0/25", "192.0.2.128/25"])),
+                         256)
+        self.assertEqual(ripe.address_space(ripe.prefix_ranges([])), 0)
+
+    @patch("cescout.projects.ripe.CLIENT.get")
+    def test_fetch_prefixes(self, mock):
+        mock.return_value.json.return_value = PREFIXES_SINCE
+        with tempfile.TemporaryDirectory() as directory:
+            routing_cache = cache.DiskCache(os.path.join(directory, "ripe.sqlite"))
+            for _ in range(2):
+                ranges = ripe.fetch_prefixes(1, self.since, routing_cache)
+                self.assertEqual(ripe.format_ranges(ranges),
+                                 ["192.0.2.0/24", "198.51.100.0/25", "198.51.100.0/24"])
+            mock.assert_called_once_with(ripe.RIPE_PREFIXES.format(1, self.since))
+            routing_cache.close()
+
+    def test_prefix_changes(self):
+        since = ripe.prefix_ranges(each["prefix"] for each in PREFIXES_SINCE["data"]["prefixes"])
+        until = ripe.prefix_ranges(each["prefix"] for each in PREFIXES_UNTIL["data"]["prefixes"])
+        self.assertEqual(ripe.prefix_changes(since, until),
+                         {"withdrawn": ["198.51.100.0/25", "198.51.100.0/24"],
+                          "added": ["203.0.113.0/24"],
+                          "space_since": 512, "space_until": 512})
+
+    @patch("cescout.projects.ripe.CLIENT.get")
+    def test_fetch_routing_data_prefixes(self, mock):
+        responses = {ripe.RIPE_ROUTING_CURRENT.format(1): ROUTING_RESPONSE,
+                     ripe.RIPE_ROUTING_HIST.format(1, self.since): ROUTING_RESPONSE,
+                     ripe.RIPE_ROUTING_HIST.format(1, self.until): ROUTING_RESPONSE,
+                     ripe.RIPE_PREFIXES.format(1, self.since): PREFIXES_SINCE,
+                     ripe.RIPE_PREFIXES.format(1, self.until): PREFIXES_UNTIL}
+        mock.side_effect = lambda url: Mock(**{"json.return_value": responses[url]})
+        with patch("cescout.projects.ripe.fetch_country_data", return_value=[1]):
+            asn_data = ripe.fetch_routing_data("CA", [1], self.since, self.until, prefixes=True)
+            self.assertEqual(asn_data[1]["prefixes"]["withdrawn"], ["198.51.100.0/25", "198.51.100.0/24"])
+            self.assertEqual(mock.call_count, 5)
+            asn_data = ripe.run("CA", [1], self.since, self.until, ripe={"prefixes": False})
+            self.assertEqual(asn_data, self.asn_data_output)
+
+    def test_visibility_series(self):
+        times, counts = ripe.visibility_series(HISTORY_RESPONSE["data"]["prefixes"], self.since, self.until)
+        start = ripe.epoch(self.since)
+        # Two prefixes are withdrawn 8 hours in and come back 16 hours in;
+        # the end of the time period is not a withdrawal.
+        self.assertEqual(times.tolist(), [start, start + 8 * 3600, start + 16 * 3600])
+        self.assertEqual(counts.tolist(), [3, 1, 3])
+        times, counts = ripe.visibility_series([], self.since, self.until)
+        self.assertEqual((times.tolist(), counts.tolist()), ([start], [0]))
+
+    def test_detect_drops(self):
+        self.assertEqual(ripe.detect_drops([0, 10, 20, 30, 40], [3, 1, 0, 3, 3]),
+                         [{"start": 10, "end": 30, "from": 3, "to": 0}])
+        self.assertEqual(ripe.detect_drops([0, 10, 20, 30], [10, 11, 10, 5]),
+                         [{"start": 30, "end": None, "from": 11, "to": 5}])
+        # Small changes are routine churn, not drops.
+        self.assertEqual(ripe.detect_drops([0, 10, 20], [100, 95, 100]),
+                         [])
+        self.assertEqual(ripe.detect_drops([0], [0]),
+                         [])
+
+    @patch("cescout.projects.ripe.CLIENT.get")
+    def test_fetch_prefix_history(self, mock):
+        mock.return_value.json.return_value = HISTORY_RESPONSE
+        start = ripe.epoch(self.since)
+        with tempfile.TemporaryDirectory() as directory:
+            routing_cache = cache.DiskCache(os.path.join(directory, "ripe.sqlite"))
+            for _ in range(2):
+                times, counts = ripe.fetch_prefix_history(1, self.since, self.until, routing_cache)
+                self.assertEqual(counts.tolist(), [3, 1, 3])
+            mock.assert_called_once_with(ripe.RIPE_PREFIXES_HIST.format(1, self.since, self.until))
+            routing_cache.close()
+        self.assertEqual(ripe.prefix_history(times, counts),
+                         {"times": [start, start + 8 * 3600, start + 16 * 3600],
+                          "prefixes": [3, 1, 3],
+                          "drops": [{"start": start + 8 * 3600, "end": start + 16 * 3600, "from": 3, "to": 1}]})
+
+    @patch("cescout.projects.ripe.CLIENT.get")
+    def test_fetch_routing_data_history(self, mock):
+        responses = {ripe.RIPE_ROUTING_CURRENT.format(1): ROUTING_RESPONSE,
+                     ripe.RIPE_ROUTING_HIST.format(1, self.since): ROUTING_RESPONSE,
+                     ripe.RIPE_ROUTING_HIST.format(1, self.until): ROUTING_RESPONSE,
+                     ripe.RIPE_PREFIXES_HIST.format(1, self.since, self.until): HISTORY_RESPONSE}
+        mock.side_effect = lambda url: Mock(**{"json.return_value": responses[url]})
+        with patch("cescout.projects.ripe.fetch_country_data", return_value=[1]):
+            asn_data = ripe.run("CA", [1], self.since, self.until, ripe={"history": True})
+            self.assertEqual(asn_data[1]["history"]["prefixes"], [3, 1, 3])
+            self.assertEqual(len(asn_data[1]["history"]["drops"]), 1)
+            self.assertEqual(mock.call_count, 4)
+
+    @patch("cescout.projects.ripe.CLIENT.get")
     def test_fetch_routing_data(self, mock):
         with patch("cescout.projects.ripe.fetch_country_data", return_value=[1]):
             mock.return_value.json.return_value = ROUTING_RESPONSE
@@ -108,7 +294,96 @@ class TestRIPE(unittest.TestCase):
             self.assertNotEqual(ripe.fetch_routing_data("CA", [2], self.since, self.until),
                                 self.asn_data_output)
 
-    @patch("requests.get")
+    @patch("cescout.projects.ripe.CLIENT.get")
+    def test_fetch_routing_data_order(self, mock):
+        # Each (ASN, time) gets a different answer so that we can check the
+        # results are put back in the right place, whatever order the
+        # concurrent requests finish in.
+        prefixes = {}
+        for asn in (1, 2, 3):
+            prefixes[ripe.RIPE_ROUTING_CURRENT.format(asn)] = asn * 100
+            prefixes[ripe.RIPE_ROUTING_HIST.format(asn, self.since)] = asn * 100 + 1
+            prefixes[ripe.RIPE_ROUTING_HIST.format(asn, self.until)] = asn * 100 + 2
+
+        def response(url):
+            data = {"query_time": self.since, "announced_space": {"v4": {"prefixes": prefixes[url]}}}
+            return Mock(**{"json.return_value": {"data": data}})
+
+        mock.side_effect = response
+        with patch("cescout.projects.ripe.fetch_country_data", return_value=[1, 2, 3]):
+            self.assertEqual(ripe.fetch_routing_data("CA", [3, 4, 1, 2], self.since, self.until, workers=4),
+                             {3: {"current": 300, "since": 301, "until": 302},
+                              1: {"current": 100, "since": 101, "until": 102},
+                              2: {"current": 200, "since": 201, "until": 202}})
+            self.assertEqual(mock.call_count, 9)
+            self.assertEqual(ripe.fetch_routing_data("CA", [4], self.since, self.until),
+                             {})
+
+    @patch("cescout.projects.ripe.CLIENT.get")
+    def test_sweep_routing_data(self, mock):
+        # ASN -> (current, since, until)
+        routing = {1: (0, 0, 0), 2: (10, 10, 10), 3: (10, 20, 10), 4: (5, 5, 1), 5: (30, 40, 0), 6: (0, 15, 0)}
+        responses = {}
+        for asn, prefixes in routing.items():
+            urls = (ripe.RIPE_ROUTING_CURRENT.format(asn),
+                    ripe.RIPE_ROUTING_HIST.format(asn, self.since),
+                    ripe.RIPE_ROUTING_HIST.format(asn, self.until))
+            for url, prefix in zip(urls, prefixes):
+                responses[url] = {"data": {"query_time": self.since, "announced_space": {"v4": {"prefixes": prefix}}}}
+        for asn in (3, 5, 6):
+            responses[ripe.RIPE_PREFIXES_HIST.format(asn, self.since, self.until)] = HISTORY_RESPONSE
+        mock.side_effect = lambda url: Mock(**{"json.return_value": responses[url]})
+        with patch("cescout.projects.ripe.fetch_country_data", return_value=list(routing)):
+            asn_data = ripe.sweep_routing_data("CA", self.since, self.until, top=3, history=True)
+        # ASN 1 announces nothing and is skipped; ASN 2 did not change; ASN 6
+        # went dark during the time period and is kept.
+        self.assertEqual(list(asn_data), [5, 6, 3])
+        self.assertEqual(asn_data[3], {"current": 10, "since": 20, "until": 10, "history": asn_data[3]["history"]})
+        self.assertEqual(asn_data[6], {"current": 0, "since": 15, "until": 0, "history": asn_data[6]["history"]})
+        self.assertEqual(asn_data[5]["history"]["prefixes"], [3, 1, 3])
+        requested = [call[0][0] for call in mock.call_args_list]
+        self.assertNotIn(ripe.RIPE_PREFIXES_HIST.format(1, self.since, self.until), requested)
+        self.assertNotIn(ripe.RIPE_PREFIXES_HIST.format(4, self.since, self.until), requested)
+
+    @patch("cescout.projects.ripe.CLIENT.get")
+    def test_sweep_routing_data_failure(self, mock):
+        # A failed request skips the ASN instead of ending the sweep.
+        failed = ripe.RIPE_ROUTING_HIST.format(2, self.since)
+
+        def response(url):
+            if url == failed:
+                return Mock(**{"raise_for_status.side_effect": HTTPError()})
+            data = {"query_time": self.since, "announced_space": {"v4": {"prefixes": 10 if "timestamp" in url else 5}}}
+            return Mock(**{"json.return_value": {"data": data}})
+
+        mock.side_effect = response
+        with patch("cescout.projects.ripe.fetch_country_data", return_value=[1, 2, 3]), \
+                self.assertLogs(level="WARNING") as logs:
+            self.assertEqual(ripe.sweep_routing_data("CA", self.since, self.until), {})
+        self.assertIn("Unable to fetch the routing state of 1 ASNs in CA; skipping: 2", logs.output[-1])
+        with patch("cescout.projects.ripe.fetch_data", return_value={}):
+            self.assertIsNone(ripe.fetch_asn_data(1))
+            self.assertIsNone(ripe.fetch_country_data("CA"))
+            self.assertIsNone(ripe.fetch_prefix_changes(1, self.since, self.until))
+            self.assertIsNone(ripe.fetch_history_summary(1, self.since, self.until))
+            self.assertIsNone(ripe.sweep_routing_data("CA", self.since, self.until))
+            self.assertIsNone(ripe.fetch_routing_data("CA", [1], self.since, self.until))
+
+    @patch("cescout.projects.ripe.sweep_routing_data")
+    def test_run_sweep(self, mock):
+        mock.return_value = self.asn_data_output
+        self.assertEqual(ripe.run("CA", None, self.since, self.until, ripe={"sweep": True, "top": 5, "rate": 100}),
+                         self.asn_data_output)
+        mock.assert_called_once_with("CA", self.since, self.until, routing_cache=None, top=5,
+                                     workers=ripe.MAX_WORKERS, prefixes=False, history=False)
+        self.assertEqual(ripe.RATE_LIMIT.rate, 100)
+        # The rate is only set when it changes.
+        with patch.object(ripe.RATE_LIMIT, "set_rate") as mock_rate:
+            ripe.run("CA", None, self.since, self.until, ripe={"sweep": True, "rate": 100})
+            mock_rate.assert_not_called()
+        ripe.RATE_LIMIT.set_rate(ripe.RATE)
+
+    @patch("cescout.projects.ripe.CLIENT.get")
     def test_run(self, mock):
         with patch("cescout.projects.ripe.fetch_country_data", return_value=[1]):
             mock.return_value.json.return_value = ROUTING_RESPONSE
@@ -118,3 +393,5 @@ class TestRIPE(unittest.TestCase):
                              {})
             self.assertEqual(ripe.run("CA", None, self.since, self.until),
                              None)
+            ripe.run("CA", [1], self.since, self.until, ripe={"workers": 1})
+            self.assertEqual(mock.call_count, 6)
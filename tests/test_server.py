@@ -0,0 +1,148 @@
+import datetime
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+
+from cescout import server
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.results = server.ResultCache(max_entries=2, ttl=300, clock=lambda: self.now)
+
+    def test_ttl(self):
+        self.assertEqual(self.results.get("a", lambda: 1), 1)
+        self.now = 299
+        self.assertEqual(self.results.get("a", lambda: 2), 1)
+        self.now = 300
+        self.assertEqual(self.results.get("a", lambda: 3), 3)
+        self.assertEqual((self.results.hits, self.results.misses), (1, 2))
+
+    def test_lru_eviction(self):
+        self.results.get("a", lambda: 1)
+        self.results.get("b", lambda: 2)
+        # `a' is used again, so `b' is now the least recently used result.
+        self.results.get("a", lambda: None)
+        self.results.get("c", lambda: 3)
+        self.assertEqual(self.results.get("b", lambda: 4), 4)
+        self.assertEqual(self.results.get("c", lambda: None), 3)
+        self.assertEqual(self.results.get("a", lambda: 5), 5)
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"len_all": 1}
+
+        values = []
+        threads = [threading.Thread(target=lambda: values.append(self.results.get("a", fetch)))
+                   for _ in range(10)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # Wait until all the other requests are waiting for the first one.
+        while self.results.coalesced < 9:
+            threading.Event().wait(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(values, [{"len_all": 1}] * 10)
+        self.assertEqual((self.results.misses, self.results.coalesced), (1, 9))
+
+    def test_failure(self):
+        def fail():
+            raise RuntimeError("unavailable")
+
+        with self.assertRaises(RuntimeError):
+            self.results.get("a", fail)
+        # Failures are not cached.
+        self.assertEqual(self.results.get("a", lambda: 1), 1)
+
+
+class TestServer(unittest.TestCase):
+    def test_parse_query(self):
+        self.assertEqual(server.parse_query("country=cn&since=2020-02-01&asns=4837,4134&asns=4134"),
+                         server.Query("CN", datetime.datetime(2020, 2, 1), None, (4134, 4837), frozenset()))
+        self.assertEqual(server.parse_query("country=CN&since=2020-02-01T00:00:00&asns=4134,4837"),
+                         server.parse_query("since=2020-02-01&country=cn&asns=4837&asns=4134"))
+        self.assertEqual(server.parse_query("country=IR&since=2020-02-01&until=2020-02-02T10:00:00&skip=ripe,ioda"),
+                         server.Query("IR", datetime.datetime(2020, 2, 1), datetime.datetime(2020, 2, 2, 10),
+                                      None, frozenset(["ripe", "ioda"])))
+        for query in ("since=2020-02-01", "country=CHN&since=2020-02-01", "country=CN",
+                      "country=CN&since=yesterday", "country=CN&since=2020-02-01&asns=AS4134",
+                      "country=CN&since=2020-02-01&skip=ripe,other",
+                      "country=CN&since=2020-02-01T00:00:00%2B08:00",
+                      "country=CN&since=2020-02-01&until=2020-02-02T00:00:00Z",
+                      "country=CN&since=2020-02-02&until=2020-02-01",
+                      "country=CN&since=2999-01-01"):
+            with self.assertRaises(ValueError):
+                server.parse_query(query)
+
+    @patch("cescout.main.get_measurements")
+    def test_fetch_measurements(self, mock):
+        query = server.Query("CN", datetime.datetime(2020, 2, 1), None, (4134, ), frozenset(["ripe"]))
+        with patch("cescout.common.date_today", return_value=datetime.datetime(2020, 2, 2)):
+            server.fetch_measurements(query, {"ooni": {}})
+        mock.assert_called_once_with(["ooni", "ioda", "ripe"],
+                                     {"country": "CN", "asns": [4134],
+                                      "since": datetime.datetime(2020, 2, 1),
+                                      "until": datetime.datetime(2020, 2, 2),
+                                      "skip_ooni": False, "skip_ioda": False, "skip_ripe": True},
+                                     {"ooni": {}})
+
+
+class TestReportServer(unittest.TestCase):
+    def setUp(self):
+        self.server = server.ReportServer(("127.0.0.1", 0), {"database": "secret"}, server.ResultCache())
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+
+    def get(self, path):
+        with urllib.request.urlopen(self.url + path) as response:
+            return response.headers["Content-Type"], response.read().decode()
+
+    @patch("cescout.main.generate_report")
+    @patch("cescout.server.fetch_measurements")
+    def test_endpoints(self, mock, report_mock):
+        mock.return_value = {"country": "China", "config": {"database": "secret"}}
+        report_mock.return_value = "Censorship Report for 'China'"
+        content_type, body = self.get("/measurements?country=CN&since=2020-02-01")
+        self.assertEqual(content_type, "application/json; charset=utf-8")
+        self.assertEqual(json.loads(body), {"country": "China"})
+        content_type, body = self.get("/report?country=cn&since=2020-02-01T00:00:00")
+        self.assertEqual(content_type, "text/plain; charset=utf-8")
+        self.assertEqual(body, "Censorship Report for 'China'")
+        report_mock.assert_called_once_with(mock.return_value)
+        # Both requests are answered from a single fetch.
+        mock.assert_called_once_with(server.Query("CN", datetime.datetime(2020, 2, 1), None, None, frozenset()),
+                                     {"database": "secret"})
+        self.assertEqual(self.get("/health"), ("text/plain; charset=utf-8", "ok\n"))
+        content_type, body = self.get("/metrics")
+        self.assertEqual(content_type, "text/plain; version=0.0.4; charset=utf-8")
+        self.assertIn("# TYPE cescout_project_duration_seconds histogram\n", body)
+
+    @patch("cescout.server.fetch_measurements")
+    def test_errors(self, mock):
+        mock.side_effect = RuntimeError("unavailable")
+        for path, status in (("/other", 404), ("/report?country=CN", 400),
+                             ("/report?country=CN&since=2020-02-01&until=2020-02-01T00:00:00%2B08:00", 400),
+                             ("/report?country=CN&since=2020-02-01", 500)):
+            with self.assertRaises(urllib.error.HTTPError) as cm, \
+                    self.assertLogs(level="DEBUG"):
+                self.get(path)
+            self.assertEqual(cm.exception.code, status)
+            cm.exception.close()
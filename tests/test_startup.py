@@ -0,0 +1,30 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# Modules that are slow to import and only needed by some code paths.
+DEFERRED = ["cProfile", "iso3166", "jinja2", "pkg_resources", "psycopg2", "pstats", "requests", "yaml"]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def imported_modules(code):
+    """Run :param code: in a new interpreter and return the modules it imported."""
+    script = "import json, sys\n{0}\nprint(json.dumps(sorted(sys.modules)))".format(code)
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return json.loads(output.stdout.decode().splitlines()[-1])
+
+
+class TestStartup(unittest.TestCase):
+    def test_import(self):
+        modules = imported_modules("import cescout.main")
+        self.assertEqual([name for name in DEFERRED if name in modules], [])
+
+    def test_skipped_projects(self):
+        modules = imported_modules("from cescout import main\n"
+                                   "main.run('-c CN -s 2020-02-01 --raw --skip-ooni --skip-ioda --skip-ripe'.split())")
+        self.assertNotIn("cescout.projects.ooni", modules)
+        self.assertEqual([name for name in DEFERRED if name in modules], ["iso3166", "yaml"])
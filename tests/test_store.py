@@ -0,0 +1,129 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+from cescout import store
+
+
+def measurement(msm_no, country, time, blocking):
+    return {"msm_no": msm_no,
+            "test_start_time": time,
+            "measurement_start_time": time,
+            "report_id": "report-{0}".format(msm_no),
+            "probe_asn": 4134,
+            "probe_cc": country,
+            "probe_ip": None,
+            "test_name": "web_connectivity",
+            "input": "https://zh.wikipedia.org/",
+            "blocking": blocking,
+            "http_experiment_failure": None}
+
+
+class TestMeasurementStore(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(directory.name, "measurements.sqlite")
+        self.store = store.MeasurementStore(self.path)
+        self.addCleanup(self.store.close)
+        self.since = datetime.datetime(2020, 2, 1)
+        self.until = datetime.datetime(2020, 2, 2)
+        self.rows = [measurement(1, "CN", datetime.datetime(2020, 2, 1, 6), "tcp_ip"),
+                     measurement(2, "CN", datetime.datetime(2020, 2, 1, 7), "false"),
+                     measurement(3, "IR", datetime.datetime(2020, 2, 1, 8), None),
+                     measurement(4, "CN", datetime.datetime(2020, 2, 3, 8), "dns")]
+
+    def test_rows(self):
+        self.assertEqual(self.store.add(iter(self.rows)), 4)
+        # Adding the same measurements again replaces them.
+        self.assertEqual(self.store.add(self.rows[:1]), 1)
+        rows = list(self.store.rows(["CN"], self.since, self.until))
+        self.assertEqual([row["report_id"] for row in rows],
+                         ["report-1", "report-2"])
+        self.assertEqual(rows[0]["measurement_start_time"], "2020-02-01 06:00:00")
+        self.assertEqual(set(rows[0]), set(store.COLUMNS))
+        self.assertEqual(len(list(self.store.rows(["CN", "IR"], self.since,
+                                                  datetime.datetime(2020, 2, 4)))), 4)
+
+    def test_summary(self):
+        self.store.add(self.rows)
+        self.assertEqual(self.store.summary(["CN", "IR", "US"], self.since, self.until),
+                         {"CN": {"len_all": 2, "len_blocking": 1},
+                          "IR": {"len_all": 1, "len_blocking": 1}})
+
+    def test_breakdown(self):
+        self.store.add(self.rows)
+        self.assertEqual(sorted(self.store.breakdown(["CN", "IR"], self.since, self.until, "hour"), key=str),
+                         sorted([("time", "CN", "2020-02-01 06:00:00", 1, 1),
+                                 ("time", "CN", "2020-02-01 07:00:00", 1, 0),
+                                 ("time", "IR", "2020-02-01 08:00:00", 1, 1),
+                                 ("asn", "CN", 4134, 2, 1),
+                                 ("asn", "IR", 4134, 1, 1),
+                                 ("input", "CN", "https://zh.wikipedia.org/", 2, 1),
+                                 ("input", "IR", "https://zh.wikipedia.org/", 1, 1),
+                                 ("blocking", "CN", "tcp_ip", 1, 1),
+                                 ("blocking", "CN", "false", 1, 0),
+                                 ("blocking", "IR", None, 1, 1)], key=str))
+        self.assertEqual([row for row in self.store.breakdown(["CN"], self.since,
+                                                              datetime.datetime(2020, 2, 4))
+                          if row[0] == "time"],
+                         [("time", "CN", "2020-02-01 00:00:00", 2, 1),
+                          ("time", "CN", "2020-02-03 00:00:00", 1, 1)])
+
+    def test_coverage(self):
+        self.assertEqual(self.store.coverage("CN"), [])
+        self.store.set_coverage(["CN", "IR"], self.since, self.until, 100)
+        self.assertEqual(self.store.coverage("CN"), [(self.since, self.until, 100)])
+        self.assertEqual(self.store.coverage("IR"), [(self.since, self.until, 100)])
+        # Periods are cut where they overlap; the rest keeps its watermark.
+        later = datetime.datetime(2020, 2, 4)
+        self.store.set_coverage(["CN"], datetime.datetime(2020, 2, 1, 12), later, 150)
+        self.assertEqual(self.store.coverage("CN"),
+                         [(self.since, datetime.datetime(2020, 2, 1, 12), 100),
+                          (datetime.datetime(2020, 2, 1, 12), later, 150)])
+        self.store.set_coverage(["CN"], datetime.datetime(2020, 2, 1, 6),
+                                datetime.datetime(2020, 2, 1, 18), 200)
+        self.assertEqual(self.store.coverage("CN"),
+                         [(self.since, datetime.datetime(2020, 2, 1, 6), 100),
+                          (datetime.datetime(2020, 2, 1, 6), datetime.datetime(2020, 2, 1, 18), 200),
+                          (datetime.datetime(2020, 2, 1, 18), later, 150)])
+        self.assertEqual(self.store.coverage("IR"), [(self.since, self.until, 100)])
+
+    def test_prune(self):
+        self.store.add(self.rows)
+        self.store.set_coverage(["CN"], self.since, self.until, 100)
+        self.store.set_coverage(["CN"], datetime.datetime(2020, 2, 3), datetime.datetime(2020, 2, 4), 150)
+        self.assertEqual(self.store.prune(datetime.datetime(2020, 2, 1, 7)), 1)
+        self.assertEqual([row["report_id"] for row in self.store.rows(["CN", "IR"], self.since,
+                                                                      datetime.datetime(2020, 2, 4))],
+                         ["report-2", "report-3", "report-4"])
+        self.assertEqual(self.store.coverage("CN"),
+                         [(datetime.datetime(2020, 2, 1, 7), self.until, 100),
+                          (datetime.datetime(2020, 2, 3), datetime.datetime(2020, 2, 4), 150)])
+        self.assertEqual(self.store.prune(datetime.datetime(2020, 2, 3)), 2)
+        self.assertEqual(self.store.coverage("CN"),
+                         [(datetime.datetime(2020, 2, 3), datetime.datetime(2020, 2, 4), 150)])
+
+    def test_check_domains(self):
+        self.assertFalse(self.store.check_domains(["wikipedia.org", "wikidata.org"]))
+        self.store.add(self.rows)
+        self.store.set_coverage(["CN"], self.since, self.until, 100)
+        self.assertFalse(self.store.check_domains(["wikidata.org", "wikipedia.org"]))
+        self.assertEqual(self.store.coverage("CN"), [(self.since, self.until, 100)])
+        # The store is emptied if the domains change.
+        self.assertTrue(self.store.check_domains(["wikipedia.org"]))
+        self.assertEqual(self.store.coverage("CN"), [])
+        self.assertEqual(list(self.store.rows(["CN"], self.since, self.until)), [])
+
+    def test_open_store(self):
+        self.assertIsNone(store.open_store())
+        self.assertIsNone(store.open_store(ooni={"store": None}))
+        path = os.path.join(self.directory, "store", "measurements.sqlite")
+        measurement_store = store.open_store(ooni={"store": path})
+        self.assertIsInstance(measurement_store, store.MeasurementStore)
+        measurement_store.close()
+        self.assertTrue(os.path.exists(path))
+        # The path is a directory.
+        self.assertIsNone(store.open_store(ooni={"store": self.directory}))